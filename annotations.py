@@ -0,0 +1,519 @@
+import sys
+import json
+from bisect import bisect_left, bisect_right, insort
+from operator import itemgetter
+
+# Nodes of the tree with this many annotations or fewer are
+#   just scanned, since most annotations are short and would
+#   each end up in a node of their own
+_LEAF = 64
+
+# Annotations are kept in blocks of about this many, and a
+#   block is split in two once it has twice as many
+_BLOCK = 512
+
+_MAX = sys.maxint
+
+
+# Annotation is a note on the bytes [start, end) of a file,
+#   shown by coloring the rows of the lines they are on.
+#   Ones without a color are bookmarks.
+# While in an index, where it is is kept relative to the
+#   block of the index holding it, so an edit can move every
+#   annotation in a block at once.
+class Annotation(object):
+    def __init__(self, start, end, color=None, note=""):
+        self._start = start
+        self._end = end
+        self._block = None
+        self.color = color
+        self.note = note
+
+    @property
+    def start(self):
+        if self._block is None:
+            return self._start
+        return self._start + self._block.shift
+
+    @property
+    def end(self):
+        if self._block is None:
+            return self._end
+        return self._end + self._block.shift
+
+    def is_bookmark(self):
+        return self.color is None
+
+
+# AnnotationIndex finds the annotations over a window of the
+#   file, out of however many there are, in O(log n + k).
+# They are kept sorted by where they start, in blocks that
+#   each have their own offset, so the ones that start inside
+#   the window are a bisect away, and an edit only shifts the
+#   blocks after it rather than every annotation.
+# The ones that start before the window and run into it are
+#   found with a tree over the blocks of the furthest any of
+#   their annotations reach, and then with a centered interval
+#   tree in each block that reaches the window: each node holds
+#   the annotations over its center, sorted both by start and
+#   by end, with the ones wholly before and after it in the
+#   nodes below. A block's tree is built when it is first
+#   needed after the block changes.
+class AnnotationIndex(object):
+    def __init__(self, blocksize=_BLOCK):
+        self.blocksize = blocksize
+        self.clear()
+
+    def add(self, annotation):
+        start, end = annotation.start, annotation.end
+        if len(self._blocks) == 0:
+            self._blocks.append(_Block([ (start, end, annotation) ]))
+            self._firsts.append(start)
+            self._reach = None
+            self._count = 1
+            return
+
+        # Annotations level with the start of a block can belong in
+        #   the one before it, if they end sooner
+        i = max(bisect_right(self._firsts, start) - 1, 0)
+        while i > 0 and self._firsts[i] == start and (
+                self._blocks[i].items[0][1] + self._blocks[i].shift > end):
+            i -= 1
+        block = self._blocks[i]
+        item = (start - block.shift, end - block.shift, annotation)
+        insort(block.items, item)
+        _place(item, block)
+        block.tree = None
+        self._count += 1
+        if start < self._firsts[i]:
+            self._firsts[i] = start
+
+        if len(block.items) > 2 * self.blocksize:
+            half = len(block.items) // 2
+            self._blocks[i:i + 1] = [ _Block(block.items[:half], block.shift),
+                _Block(block.items[half:], block.shift) ]
+            self._firsts.insert(i + 1, block.items[half][0] + block.shift)
+            self._reach = None
+        elif item[1] > block.maxend:
+            block.maxend = item[1]
+            self._reached(i)
+
+    # Adds many annotations at once, such as from import
+    def extend(self, annotations):
+        annotations = list(annotations)
+        if len(annotations) <= self.blocksize:
+            for annotation in annotations:
+                self.add(annotation)
+            return
+
+        items = [ (annotation.start, annotation.end, annotation)
+            for annotation in annotations ]
+        items.extend((annotation.start, annotation.end, annotation)
+            for annotation in self)
+        items.sort()
+        self._blocks = [ _Block(items[i:i + self.blocksize])
+            for i in xrange(0, len(items), self.blocksize) ]
+        self._firsts = [ block.items[0][0] for block in self._blocks ]
+        self._reach = None
+        self._count = len(items)
+
+    # Returns False if the annotation isn't in the index
+    def remove(self, annotation):
+        block = annotation._block
+        if block is None:
+            return False
+        start = annotation.start
+        lo = max(bisect_left(self._firsts, start) - 1, 0)
+        hi = bisect_right(self._firsts, start)
+        for i in xrange(lo, hi):
+            if self._blocks[i] is block:
+                break
+        else:
+            return False
+
+        items = block.items
+        j = bisect_left(items, (annotation._start, annotation._end))
+        while items[j][2] is not annotation:
+            j += 1
+        item = items.pop(j)
+        annotation._start += block.shift
+        annotation._end += block.shift
+        annotation._block = None
+        block.tree = None
+        self._count -= 1
+
+        if len(items) == 0:
+            del self._blocks[i]
+            del self._firsts[i]
+            self._reach = None
+            return True
+        if j == 0:
+            self._firsts[i] = items[0][0] + block.shift
+        if item[1] == block.maxend:
+            block.maxend = max(item[1] for item in items)
+            self._reached(i)
+        return True
+
+    def clear(self):
+        self._blocks = []
+        # Where the first annotation of each block starts
+        self._firsts = []
+        # The tree of how far the blocks reach, or None until
+        #   it is needed
+        self._reach = None
+        self._count = 0
+
+    # The annotations that overlap [start, end), in order
+    def overlapping(self, start, end):
+        if start >= end:
+            return []
+        return self.covering(start) + self.starting(start, end)
+
+    # The annotations that start in [start, end), in order
+    def starting(self, start, end):
+        blocks, firsts = self._blocks, self._firsts
+        found = []
+        i = max(bisect_left(firsts, start) - 1, 0)
+        while i < len(blocks) and firsts[i] < end:
+            block = blocks[i]
+            items = block.items
+            lo = bisect_left(items, (start - block.shift,))
+            hi = bisect_left(items, (end - block.shift,))
+            found.extend(item[2] for item in items[lo:hi])
+            i += 1
+        return found
+
+    # The first annotation that starts after the offset, or
+    #   None
+    def next_after(self, offset):
+        i = max(bisect_right(self._firsts, offset) - 1, 0)
+        for block in self._blocks[i:i + 2]:
+            items = block.items
+            j = bisect_right(items, (offset - block.shift, _MAX))
+            if j < len(items):
+                return items[j][2]
+        return None
+
+    # The last annotation that starts before the offset, or
+    #   None
+    def prev_before(self, offset):
+        i = bisect_left(self._firsts, offset) - 1
+        if i < 0:
+            return None
+        block = self._blocks[i]
+        j = bisect_left(block.items, (offset - block.shift,))
+        return block.items[j - 1][2]
+
+    # Moves the annotations along with their bytes, after
+    #   'length' bytes at 'offset' were replaced with
+    #   'newlength' bytes. Annotations over the replaced bytes
+    #   shrink with them, and are dropped if nothing is left.
+    # Only the blocks with annotations over the offset or in
+    #   the replaced bytes are gone through. The ones after
+    #   those just move.
+    def edited(self, offset, length, newlength):
+        delta = newlength - length
+        if delta == 0 or len(self._blocks) == 0:
+            return
+
+        def move(pos):
+            if pos <= offset:
+                return pos
+            if pos >= offset + length:
+                return pos + delta
+            return offset + min(pos - offset, newlength)
+
+        blocks, firsts = self._blocks, self._firsts
+        # The blocks wholly before the offset only have ends to move
+        first = max(bisect_left(firsts, offset) - 1, 0)
+        for i in self._reaching(offset, first):
+            items = self._moved(blocks[i], move)
+            blocks[i] = _Block(items)
+
+        stop = first
+        while stop < len(blocks) and (firsts[stop] <= offset
+                or firsts[stop] < offset + length):
+            stop += 1
+        for i in xrange(stop, len(blocks)):
+            blocks[i].shift += delta
+            firsts[i] += delta
+
+        # Annotations from the replaced bytes can end up starting
+        #   level with ones in the blocks after them, so those are
+        #   sorted in with them until there is a block they don't
+        #   reach
+        items = []
+        for block in blocks[first:stop]:
+            items.extend(self._moved(block, move))
+        items.sort()
+        while stop < len(blocks) and items and firsts[stop] <= items[-1][0]:
+            # These have already been moved with their blocks
+            block = blocks[stop]
+            items.extend((start + block.shift, end + block.shift, annotation)
+                for start, end, annotation in block.items)
+            items.sort()
+            stop += 1
+        chunks = [ _Block(items[i:i + self.blocksize])
+            for i in xrange(0, len(items), self.blocksize) ]
+        blocks[first:stop] = chunks
+        firsts[first:stop] = [ block.items[0][0] for block in chunks ]
+        self._reach = None
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for block in self._blocks:
+            for item in block.items:
+                yield item[2]
+
+    # The annotations that start before the offset and end
+    #   after it, in order
+    def covering(self, offset):
+        found = []
+        for i in self._reaching(offset, bisect_left(self._firsts, offset)):
+            block = self._blocks[i]
+            if block.tree is None:
+                block.tree = _build(block.items)
+            at = offset - block.shift
+            items = [ item for item in _stab(block.tree, at, [])
+                if item[0] < at ]
+            items.sort()
+            found.extend(item[2] for item in items)
+        return found
+
+    # The indexes of the blocks before 'count' with annotations
+    #   that end after the offset, in order
+    def _reaching(self, offset, count):
+        reach = self._reach_tree()
+        size = len(reach) // 2
+        found = []
+        stack = [ (1, 0, size) ]
+        while stack:
+            node, first, width = stack.pop()
+            if first >= count or reach[node] <= offset:
+                continue
+            if width == 1:
+                found.append(first)
+                continue
+            width //= 2
+            stack.append((2 * node + 1, first + width, width))
+            stack.append((2 * node, first, width))
+        return found
+
+    # The reach of each block is at slot 'size + i', and each
+    #   slot below that holds the most of the two above it
+    def _reach_tree(self):
+        if self._reach is None:
+            size = 1
+            while size < len(self._blocks):
+                size *= 2
+            reach = [ -_MAX ] * (2 * size)
+            for i, block in enumerate(self._blocks):
+                reach[size + i] = block.maxend + block.shift
+            for i in xrange(size - 1, 0, -1):
+                reach[i] = max(reach[2 * i], reach[2 * i + 1])
+            self._reach = reach
+        return self._reach
+
+    # Updates the tree after block i's reach changed
+    def _reached(self, i):
+        reach = self._reach
+        if reach is None:
+            return
+        block = self._blocks[i]
+        i += len(reach) // 2
+        reach[i] = block.maxend + block.shift
+        while i > 1:
+            i //= 2
+            reach[i] = max(reach[2 * i], reach[2 * i + 1])
+
+    # The items of a block moved by 'move', less the ones left
+    #   empty, which are dropped from the index
+    def _moved(self, block, move):
+        items = []
+        for start, end, annotation in block.items:
+            start = move(start + block.shift)
+            end = move(end + block.shift)
+            if start < end:
+                items.append((start, end, annotation))
+            else:
+                annotation._start, annotation._end = start, end
+                annotation._block = None
+                self._count -= 1
+        return items
+
+
+# Block of annotations, as (start, end, annotation) items
+#   sorted and relative to 'shift'
+class _Block(object):
+    def __init__(self, items, shift=0):
+        self.items = items
+        self.shift = shift
+        # The furthest any of them reach
+        self.maxend = max(item[1] for item in items)
+        self.tree = None
+        for item in items:
+            _place(item, self)
+
+def _place(item, block):
+    annotation = item[2]
+    annotation._start, annotation._end = item[0], item[1]
+    annotation._block = block
+
+
+# Node: (center, items over it by start, by end, before, after)
+#   or a leaf list of items, sorted by start
+def _build(items):
+    if len(items) <= _LEAF:
+        # A copy, since this may be a block's own list
+        return list(items)
+    center = items[len(items) // 2][0]
+    split = bisect_right(items, (center, _MAX))
+    head = items[:split]
+    before = [ item for item in head if item[1] <= center ]
+    over = [ item for item in head if item[1] > center ]
+    byend = sorted(over, key=itemgetter(1), reverse=True)
+    return (center, over, byend, _build(before), _build(items[split:]))
+
+# Appends the items that contain the offset to 'out'
+def _stab(node, offset, out):
+    while isinstance(node, tuple):
+        center, over, byend, before, after = node
+        if offset < center:
+            # Every item here ends after the offset
+            for item in over:
+                if item[0] > offset:
+                    break
+                out.append(item)
+            node = before
+        else:
+            # Every item here starts before the offset
+            for item in byend:
+                if item[1] <= offset:
+                    break
+                out.append(item)
+            node = after
+
+    for item in node:
+        if item[0] > offset:
+            break
+        if item[1] > offset:
+            out.append(item)
+    return out
+
+
+# Annotations are imported and exported as one JSON object a
+#   line, such as
+#
+#       {"start": 4096, "end": 4160, "color": "red", "note": "header"}
+#
+#   where only start and end are needed. Raises ValueError if
+#   a line can't be read.
+def load(infile):
+    annotations = []
+    for line in infile:
+        if not line.strip():
+            continue
+        try:
+            fields = json.loads(line)
+            start, end = int(fields["start"]), int(fields["end"])
+        except (KeyError, TypeError):
+            raise ValueError("Bad annotation: %s" % line.strip())
+        if start < 0 or end <= start:
+            raise ValueError("Bad annotation range: %s" % line.strip())
+        annotations.append(Annotation(start, end, fields.get("color"),
+            fields.get("note", "")))
+    return annotations
+
+def dump(annotations, outfile):
+    for annotation in annotations:
+        fields = { "start": annotation.start, "end": annotation.end }
+        if annotation.color is not None:
+            fields["color"] = annotation.color
+        if annotation.note:
+            fields["note"] = annotation.note
+        outfile.write(json.dumps(fields, sort_keys=True) + "\n")
+
+
+####### Checks ########
+# Runs random adds, removes and edits on an index with tiny
+#   blocks and on a plain list, and checks that they agree.
+#   Starts are drawn from a few values, so many annotations
+#   are level with each other across block boundaries.
+#
+#   python annotations.py [seeds]
+def _check(seed, steps=300):
+    import random
+    rng = random.Random(seed)
+    index = AnnotationIndex(blocksize=rng.choice([2, 3, 4, 8]))
+    live = []
+
+    def new():
+        start = rng.randrange(0, 400, rng.choice([1, 10, 50]))
+        return Annotation(start, start + rng.choice([1, 5, 10, 60, 300]))
+
+    for step in xrange(steps):
+        action = rng.random()
+        if action < 0.3:
+            annotation = new()
+            if index._firsts and rng.random() < 0.3:
+                # Level with the start of a block
+                start = rng.choice(index._firsts)
+                annotation = Annotation(start, start + rng.randrange(1, 50))
+            index.add(annotation)
+            live.append(annotation)
+        elif action < 0.4:
+            annotations = [ new() for i in xrange(rng.choice([1, 20])) ]
+            index.extend(annotations)
+            live.extend(annotations)
+        elif action < 0.6 and live:
+            annotation = live.pop(rng.randrange(len(live)))
+            assert index.remove(annotation)
+            assert not index.remove(annotation)
+        elif action < 0.9:
+            offset = rng.choice([ rng.randrange(500) ] + index._firsts)
+            length = rng.choice([0, 1, 10, 60])
+            newlength = rng.choice([0, 1, 10, 40])
+            expected = {}
+            for annotation in live:
+                start, end = [ _moved(pos, offset, length, newlength)
+                    for pos in (annotation.start, annotation.end) ]
+                if length == newlength:
+                    start, end = annotation.start, annotation.end
+                if start < end:
+                    expected[id(annotation)] = (start, end)
+            index.edited(offset, length, newlength)
+            live = [ annotation for annotation in live
+                if id(annotation) in expected ]
+            for annotation in live:
+                assert (annotation.start, annotation.end) == expected[
+                    id(annotation)], (seed, step)
+
+        key = lambda annotation: (annotation.start, annotation.end)
+        assert len(index) == len(live)
+        assert sorted(map(key, index)) == map(key, index) == sorted(
+            map(key, live)), (seed, step)
+        start = rng.randrange(-10, 600)
+        end = start + rng.choice([1, 10, 100])
+        found = index.overlapping(start, end)
+        assert map(key, found) == sorted(key(annotation) for annotation
+            in live if annotation.start < end and annotation.end > start)
+        after = index.next_after(start)
+        assert (after and after.start) == min([ annotation.start
+            for annotation in live if annotation.start > start ] or [ None ])
+        before = index.prev_before(start)
+        assert (before and before.start) == max([ annotation.start
+            for annotation in live if annotation.start < start ] or [ None ])
+
+def _moved(pos, offset, length, newlength):
+    if pos <= offset:
+        return pos
+    if pos >= offset + length:
+        return pos + newlength - length
+    return offset + min(pos - offset, newlength)
+
+if __name__ == "__main__":
+    for seed in xrange(int(sys.argv[1]) if len(sys.argv) > 1 else 200):
+        _check(seed)
+    print "ok"
@@ -0,0 +1,295 @@
+import os
+import sys
+import gc
+import json
+import time
+import random
+import shutil
+import binascii
+import argparse
+import platform
+import tempfile
+
+import headless
+headless.install()
+
+from editpad import EditPad
+from editconfig import CreateDefaultConfig
+import editconfig
+
+
+# Runs EditPads on a headless screen over generated files,
+#   and writes how long each operation took as JSON, so runs
+#   can be compared to find regressions.
+#
+#   python benchmark.py -o results.json
+#   python benchmark.py --baseline results.json
+#
+# Each benchmark is run 'repeat' times on a fresh EditPad,
+#   and the best and median times are kept.
+
+####### Plugins ########
+# Plugins the benchmarks switch between. One gives every
+#   line the same height, the other changes height with the
+#   data, which is the harder case for layout.
+
+def plugin_checksum(token):
+    return "%02x" % (sum(bytearray(token)) & 0xff)
+
+def plugin_words(token):
+    data = bytearray(token)
+    return [ "%02x%02x" % (data[i], data[i + 1] if i + 1 < len(data) else 0)
+        for i in xrange(0, len(data), 2) if data[i] & 1 ] or [ "" ]
+
+PLUGINS = [ plugin_checksum, plugin_words ]
+
+
+####### Files ########
+_CHUNK = 1024 * 1024
+
+def _write(path, size, chunk):
+    with open(path, "wb") as outfile:
+        written = 0
+        while written < size:
+            data = chunk(min(_CHUNK, size - written))
+            outfile.write(data)
+            written += len(data)
+
+def make_zeros(path, size):
+    _write(path, size, lambda length: "\0" * length)
+
+def make_random(path, size):
+    rng = random.Random(size)
+    _write(path, size, lambda length:
+        binascii.unhexlify("%0*x" % (2 * length, rng.getrandbits(8 * length))))
+
+def make_text(path, size):
+    rng = random.Random(size)
+    words = [ "the", "hex", "editor", "line", "offset", "plugin",
+        "byte", "window", "pad", "stream", "buffer", "\n" ]
+    def chunk(length):
+        out = []
+        total = 0
+        while total < length:
+            word = rng.choice(words) + " "
+            out.append(word)
+            total += len(word)
+        return "".join(out)[:length]
+    _write(path, size, chunk)
+
+# Mostly holes, with a little data every megabyte
+def make_sparse(path, size):
+    with open(path, "wb") as outfile:
+        for offset in xrange(0, size, _CHUNK):
+            outfile.seek(offset)
+            outfile.write("sparse %d\n" % offset)
+        outfile.truncate(size)
+
+FILES = [
+    ("zeros", make_zeros),
+    ("random", make_random),
+    ("text", make_text),
+    ("sparse", make_sparse),
+]
+
+
+####### Benchmarks ########
+# Each takes a loaded EditPad and a random generator, and
+#   returns how many operations it timed
+
+def bench_scroll(editpad, rng, count):
+    for i in xrange(count):
+        editpad.scroll(1)
+        editpad.refresh()
+    return count
+
+def bench_page(editpad, rng, count):
+    for i in xrange(count):
+        editpad.scroll(40)
+        editpad.refresh()
+    return count
+
+def bench_goto(editpad, rng, count):
+    length = len(editpad.filedata)
+    for i in xrange(count):
+        editpad.goto("%x" % rng.randrange(max(length, 1)))
+        editpad.refresh()
+    return count
+
+def bench_plugin(editpad, rng, count):
+    for i in xrange(count):
+        editpad.activate_plugin((i + 1) % (len(PLUGINS) + 1))
+        editpad.refresh()
+    return count
+
+def bench_preview(editpad, rng, count):
+    editpad.activate_plugin(1)
+    for i in xrange(count):
+        editpad.scroll(rng.randint(1, 20))
+        editpad.set_preview()
+        editpad.refresh()
+        editpad.unset_preview()
+        editpad.refresh()
+    return count
+
+BENCHMARKS = [
+    ("scroll", bench_scroll, 2000),
+    ("page", bench_page, 200),
+    ("goto", bench_goto, 200),
+    ("plugin", bench_plugin, 20),
+    ("preview", bench_preview, 50),
+]
+
+
+def new_editpad(args):
+    config = CreateDefaultConfig()
+    config.virtualpad = args.virtualpad
+    config.memobudget = args.memo
+    config.pluginpool = "thread"
+    window = headless.HeadlessWindow(args.height, args.width)
+    return EditPad(window, 1, config, PLUGINS)
+
+def time_open(path, args):
+    editpad = new_editpad(args)
+    start = time.time()
+    editpad.loadfile(open(path, "rb"))
+    editpad.refresh()
+    elapsed = time.time() - start
+    return editpad, elapsed
+
+def run_file(name, path, args):
+    results = []
+    size = os.path.getsize(path)
+
+    opens = []
+    for i in xrange(args.repeat):
+        editpad, elapsed = time_open(path, args)
+        editpad.closefile()
+        opens.append(elapsed)
+    results.append(_result(name, size, "open", 1, opens, None, None))
+
+    for bench, function, count in BENCHMARKS:
+        if args.only and bench not in args.only:
+            continue
+        count = max(int(count * args.scale), 1)
+        times = []
+        cells = None
+        memo = None
+        for i in xrange(args.repeat):
+            editpad, elapsed = time_open(path, args)
+            pad = editpad.padmanager
+            before = pad.cellswritten
+            gc.collect()
+
+            start = time.time()
+            ops = function(editpad, random.Random(i), count)
+            times.append(time.time() - start)
+
+            cells = pad.cellswritten - before
+            memo = editpad.memo_stats()
+            editpad.closefile()
+        results.append(_result(name, size, bench, ops, times, cells, memo))
+        _progress(results[-1])
+    return results
+
+def _result(name, size, bench, ops, times, cells, memo):
+    times = sorted(times)
+    return {
+        "file": name,
+        "size": size,
+        "benchmark": bench,
+        "ops": ops,
+        "best": times[0],
+        "median": times[len(times) // 2],
+        "per_op": times[0] / ops,
+        "cells": cells,
+        "memo_hitrate": memo["hitrate"] if memo else None,
+    }
+
+def _progress(result):
+    sys.stderr.write("%-8s %-8s %10.6fs/op\n" % (result["file"],
+        result["benchmark"], result["per_op"]))
+
+# Results that are slower than in the baseline by more than
+#   'tolerance' (a fraction)
+def regressions(results, baseline, tolerance):
+    old = dict(((r["file"], r["benchmark"]), r) for r in baseline["results"])
+    slower = []
+    for result in results:
+        before = old.get((result["file"], result["benchmark"]))
+        if before is None or before["per_op"] <= 0:
+            continue
+        ratio = result["per_op"] / before["per_op"]
+        if ratio > 1 + tolerance:
+            slower.append((result["file"], result["benchmark"], ratio))
+    return slower
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Times EditPad operations")
+    parser.add_argument("-o", "--output", help="write the JSON here")
+    parser.add_argument("--size", type=int, default=16 * 1024 * 1024,
+        help="bytes in each generated file")
+    parser.add_argument("--huge", action="store_true",
+        help="also run on a sparse 10GB file")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--scale", type=float, default=1.0,
+        help="multiplies how many operations each benchmark runs")
+    parser.add_argument("--only", action="append",
+        help="run only this benchmark (can be given more than once)")
+    parser.add_argument("--virtualpad", action="store_true")
+    parser.add_argument("--memo", type=int, default=0,
+        help="bytes for the content cache, which is off by default")
+    parser.add_argument("--height", type=int, default=40)
+    parser.add_argument("--width", type=int, default=120)
+    parser.add_argument("--baseline",
+        help="a previous output to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--dir", help="where to generate the files")
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    tempdir = tempfile.mkdtemp(prefix="hexbench", dir=args.dir)
+    try:
+        files = [ (name, make, args.size) for name, make in FILES ]
+        if args.huge:
+            files.append(("huge", make_sparse, 10 * 1024 ** 3))
+
+        results = []
+        for name, make, size in files:
+            path = os.path.join(tempdir, name)
+            make(path, size)
+            results.extend(run_file(name, path, args))
+            os.remove(path)
+    finally:
+        shutil.rmtree(tempdir)
+
+    output = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "bytesPerLine": editconfig.bytesPerLine,
+        "virtualpad": args.virtualpad,
+        "memobudget": args.memo,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(output, outfile, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as infile:
+            slower = regressions(results, json.load(infile), args.tolerance)
+        for name, bench, ratio in slower:
+            sys.stderr.write("REGRESSION %s %s %.2fx slower\n"
+                % (name, bench, ratio))
+        if slower:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,105 +1,560 @@
 import os
+import sys
+import errno
+import mmap
+import shutil
+import tempfile
+import threading
+from itertools import imap
+from bisect import bisect_left, bisect_right
+from piecetable import PieceTable
+from compressed import open_source
+from previewstore import PreviewStore
+from plugin import tobytes
+from debugger import profiled
+
+# Bytes copied at a time when saving
+_SAVE_CHUNK = 4 * 1024 * 1024
+
+# lseek whences for finding the holes in sparse files, which
+#   the os module only has from Python 3.3. They are swapped
+#   around on macOS.
+if hasattr(os, "SEEK_DATA"):
+    _SEEK_DATA = os.SEEK_DATA
+elif sys.platform.startswith(("linux", "freebsd", "sunos")):
+    _SEEK_DATA = 3
+elif sys.platform == "darwin":
+    _SEEK_DATA = 4
+else:
+    _SEEK_DATA = None
 
 # BufferStream represents a push-based stream of data.
 # A bufferstream is given a processing function that
 #   turns the flow of input tokens into output tokens
 # A bufferstream has at least one output stream that it
 #   pushes its data into
+# Tokens can be pushed one at a time, or as a batch: a
+#   list of (token, index) pairs, which is how whole file
+#   windows are sent through the pipeline
 class BufferStream(object):
     def __init__(self, token_processor):
-        self.processor = token_processor
         self.streams = []
+        self.cache = None
+        self.memo = None
+        self.pool = None
+        self.reader = None
+        self.set_processor(token_processor)
 
     def addOutputStream(self, stream):
         self.streams.append(stream)
 
+    # Processor capabilities are looked up here once, rather
+    #   than for every token
+    def set_processor(self, processor):
+        self.processor = processor
+        self.want_index = getattr(processor, "want_index", False)
+        self.batch_processor = getattr(processor, "batch", None)
+        self.window_processor = getattr(processor, "window", None)
+        self.pure = getattr(processor, "pure", False)
+        self.memoize = getattr(processor, "memoize", True)
+
+    # Output for batches is looked up in (and stored into)
+    #   the given RenderCache before running the processor
+    def set_cache(self, cache):
+        self.cache = cache
+
+    # Lines that aren't in the RenderCache are looked up by
+    #   their bytes in the given ContentCache, so only tokens
+    #   it hasn't seen before are processed
+    def set_memo(self, memo):
+        self.memo = memo
+
+    # Batches for processors that declare themselves pure are
+    #   spread across the given PluginPool
+    def set_pool(self, pool):
+        self.pool = pool
+
+    # Window processors (see plugin.py) are given their bytes
+    #   straight from reader(start, end), with the context they
+    #   ask for, rather than put back together from the tokens
+    def set_reader(self, reader):
+        self.reader = reader
+
     def push_token(self, token, index):
         new_token = self._get_new_token(token, index)
         if new_token is not None:
             for s in self.streams:
                 s.push_token(new_token, index)
 
-    @staticmethod
-    def do_process(processor, token, index):
-        if hasattr(processor, "want_index"):
-            want_index = processor.want_index
-        else:
-            want_index = False
-
-        if want_index:
-            return processor(token, index)
+    def push_batch(self, batch):
+        new_batch = self._get_new_batch(batch)
+        if len(new_batch) > 0:
+            for s in self.streams:
+                s.push_batch(new_batch)
+
+    # Runs a batch through this stream and the ones after it
+    #   without pushing anything into the column buffers. This
+    #   only has an effect when the streams have a cache.
+    def warm_batch(self, batch):
+        new_batch = self._get_new_batch(batch)
+        for s in self.streams:
+            if isinstance(s, BufferStream):
+                s.warm_batch(new_batch)
+
+    def do_process(self, token, index):
+        if self.want_index:
+            return self.processor(token, index)
         else:
-            return processor(token)
+            return self.processor(token)
 
     def _get_new_token(self, token, index):
-        return BufferStream.do_process(
-                self.processor, token, index)
+        return self.do_process(token, index)
+
+    def _get_new_batch(self, batch):
+        return _drop_none(self._process_batch(batch))
+
+    # Runs the processor over the batch, without dropping
+    #   tokens that it turned into None
+    def _process_batch(self, batch):
+        compute = self._compute_batch
+        if self.memo is not None and self.memoize:
+            compute = self._memo_batch
+        if self.cache is None:
+            return compute(batch)
+        return self.cache.process_batch(self, self.processor,
+            batch, compute)
+
+    def _memo_batch(self, batch):
+        return self.memo.process_batch(self.processor, batch,
+            self._compute_batch)
+
+    @profiled(lambda self, batch: "stream " + _name(self.processor))
+    def _compute_batch(self, batch):
+        if self.window_processor is not None:
+            return self._compute_windows(batch)
+        if self.pure and self.pool is not None:
+            return self.pool.process_batch(self.processor,
+                self.want_index, batch)
+
+        if self.batch_processor is not None:
+            new_tokens = self.batch_processor(batch)
+            return zip(new_tokens, [ index for token, index in batch ])
+
+        processor = self.processor
+        if self.want_index:
+            return [ (processor(token, index), index)
+                for token, index in batch ]
+        else:
+            return [ (processor(token), index)
+                for token, index in batch ]
+
+
+    # Each run of consecutive lines in the batch is given to
+    #   the processor as one window
+    def _compute_windows(self, batch):
+        output = []
+        for run in _runs(batch):
+            start = run[0][1]
+            end = run[-1][1] + len(run[-1][0])
+            width = max(len(token) for token, index in run)
+            view, base = self._window(run, start, end)
+
+            if self.pure and self.pool is not None:
+                lines = self.pool.process_window(self.processor,
+                    view, base, start, end, width)
+            else:
+                lines = self.window_processor(view, base, start, end, width)
+            output.extend(zip(lines, [ index for token, index in run ]))
+        return output
+
+    # The bytes for a run of lines and its context, and the
+    #   offset they start at
+    def _window(self, run, start, end):
+        if self.reader is None:
+            return memoryview(b''.join([ tobytes(token)
+                for token, index in run ])), start
+        before, after = getattr(self.processor, "context", (0, 0))
+        base = max(start - before, 0)
+        return self.reader(base, end + after), base
 
 
 # The same as BufferStream, but only supports a single
 #   output stream, and can change its processor
 class MutableBufferStream(BufferStream):
     def __init__(self):
-        self.processor = None
-        self.streams = []
+        super(MutableBufferStream, self).__init__(None)
 
     def set_stream(self, stream):
         self.streams = [ stream ]
 
-    def set_processor(self, processor):
-        self.processor = processor
-
     def addOutputStream(self, stream):
         raise RuntimeError("Function has been deleted")
 
 
-# The same as Bufferstream but pulls from a cache if it can
+# The same as BufferStream, but the lines in the ranges of
+#   'overrides' (see previewstore.py) show the output of the
+#   processor pinned over them instead. Each pinned processor
+#   gets a stream of its own with the same cache, pool and
+#   reader, so its output is only worked out for the lines
+#   that are shown, and is cached like any other.
 class CachedBufferStream(BufferStream):
     def __init__(self, default_processor, bpl):
         super(CachedBufferStream, self).__init__(default_processor)
 
         self.bpl = bpl
-        self.mapping = {}
-
-    def _get_new_token(self, token, index):
-        line = index // self.bpl
-        if line in self.mapping:
-            return self.mapping[line]
-        return BufferStream.do_process(
-            self.processor, token, index)
+        self.overrides = PreviewStore()
+        # processor -> BufferStream
+        self._pinned = {}
 
-    def add(self, line, val):
-        self.mapping[line] = val
+    def set_reader(self, reader):
+        super(CachedBufferStream, self).set_reader(reader)
+        for stream in self._pinned.itervalues():
+            stream.set_reader(reader)
 
-    def remove(self, line):
-        if line in self.mapping:
-            del self.mapping[line]
+    def _get_new_token(self, token, index):
+        processor = self.overrides.at(index)
+        if processor is None:
+            return self.do_process(token, index)
+        return _shown(self._pinned_stream(processor).do_process(token, index))
+
+    def _process_batch(self, batch):
+        processed = super(CachedBufferStream, self)._process_batch(batch)
+        if len(self.overrides) == 0 or len(processed) == 0:
+            return processed
+
+        # The batch is in order, so the lines under each range
+        #   are found with a bisect
+        indexes = [ index for token, index in batch ]
+        ranges = self.overrides.overlapping(indexes[0],
+            indexes[-1] + len(batch[-1][0]))
+        if len(ranges) == 0:
+            return processed
+
+        pinned = {}
+        for start, end, processor in ranges:
+            lo = bisect_right(indexes, start - self.bpl)
+            hi = bisect_left(indexes, end)
+            pinned.setdefault(processor, []).extend(xrange(lo, hi))
+
+        processed = list(processed)
+        for processor, lines in pinned.iteritems():
+            lines = sorted(set(lines))
+            stream = self._pinned_stream(processor)
+            output = stream._process_batch([ batch[i] for i in lines ])
+            for i, (token, index) in zip(lines, output):
+                processed[i] = (_shown(token), index)
+        return processed
+
+    def _pinned_stream(self, processor):
+        stream = self._pinned.get(processor)
+        if stream is None:
+            stream = BufferStream(processor)
+            stream.set_cache(self.cache)
+            stream.set_memo(self.memo)
+            stream.set_pool(self.pool)
+            stream.set_reader(self.reader)
+            self._pinned[processor] = stream
+        return stream
+
+
+# A pinned line always takes up its row in the column, even
+#   where the processor shows nothing
+def _shown(token):
+    return '' if token is None else token
+
+def _drop_none(batch):
+    return [ pair for pair in batch if pair[0] is not None ]
+
+# Splits a batch where a token doesn't start where the last
+#   one ended
+def _runs(batch):
+    runs = []
+    run = []
+    end = None
+    for token, index in batch:
+        if index != end and run:
+            runs.append(run)
+            run = []
+        run.append((token, index))
+        end = index + len(token)
+    if run:
+        runs.append(run)
+    return runs
 
 
 # Currently doesn't do much. This is an abstraction so
 #   that it is easy to change how file access works in
 #   the future
+# If the file can be memory mapped, tokens are handed out
+#   as memoryview slices of the mapping rather than being
+#   read and copied out of the file. Pipes and other
+#   unmappable files fall back to seek + read.
+# Edits go into a PieceTable on top of the file, and reads
+#   go through it, so the file is only changed by save().
+# gzip, xz and zstd files are read decompressed through a
+#   CompressedSource, with checkpoints every 'checkpoint'
+#   bytes and 'pagecache' bytes of decompressed data cached.
+#   They can be edited but not saved. The first time one is
+#   opened, its length grows (see grow) as it is gone through,
+#   and the first edit waits until that is done.
 class FileBuffer(object):
-    def __init__(self, infile):
+    def __init__(self, infile, use_mmap=True, checkpoint=4*1024*1024,
+            pagecache=8*1024*1024):
         self.infile = infile
         self._flen = None
+        self._map = None
+        self._view = None
+        self._lock = threading.Lock()
+        self._pieces = None
+        # Set when save() had to reopen the file
+        self._owned = False
+
+        self._source = None
+        if checkpoint is not None:
+            self._source = open_source(infile, checkpoint, pagecache)
+        self._use_mmap = use_mmap and self._source is None
+        if self._use_mmap:
+            self._open_map()
+
+    def _open_map(self):
+        try:
+            self._map = mmap.mmap(self.infile.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        except (AttributeError, ValueError, EnvironmentError):
+            # Not a real file, an empty file, a pipe, etc.
+            self._map = None
+            return
+        self._view = _mapview(self._map)
+
+    def is_mapped(self):
+        return self._view is not None
+
+    # The path of the file on disk, if it has one and it
+    #   holds the same bytes as this buffer
+    def path(self):
+        if self.is_dirty():
+            return None
+        return self._diskpath()
+
+    def _diskpath(self):
+        if self._source is not None:
+            return None
+        name = getattr(self.infile, "name", None)
+        if isinstance(name, str) and os.path.isfile(name):
+            return name
+        return None
+
+    def is_dirty(self):
+        return self._pieces is not None and self._pieces.dirty
+
+    # The compression format the file is read through, if any
+    def compression(self):
+        if self._source is None:
+            return None
+        return self._source.format
+
+    # Whether grow() can still find more of the file by itself,
+    #   as it can while a compressed file is first gone through
+    def loading(self):
+        with self._lock:
+            return (self._source is not None and self._pieces is None
+                and (not self._source.complete()
+                    or self._source.length() != self._original_length()))
+
+    # Whether reads far into the file have to decompress it
+    #   from the start, or from long before them
+    def slow_reads(self):
+        return self._source is not None and self._source.slow
+
+    def close(self):
+        self._view = None
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._owned:
+            self.infile.close()
+            self._owned = False
+
+    # Picks up bytes written to the end of the file since it
+    #   was opened, or decompressed since the last call, and
+    #   returns the new length. Edited files keep the length
+    #   they had.
+    def grow(self):
+        with self._lock:
+            if self._pieces is not None:
+                return len(self)
+            if self._source is not None:
+                self._flen = self._source.length()
+                return self._flen
+            try:
+                size = os.fstat(self.infile.fileno()).st_size
+            except (AttributeError, EnvironmentError):
+                return len(self)
+            if size > self._original_length():
+                self._flen = None
+                if self._use_mmap:
+                    # The old mapping isn't closed, since lines
+                    #   that are loaded still point into it. It
+                    #   goes once they are all dropped.
+                    self._map = None
+                    self._view = None
+                    self._open_map()
+            return self._original_length()
+
+    def overwrite(self, offset, data):
+        with self._lock:
+            self._edits().overwrite(offset, data)
+
+    def insert(self, offset, data):
+        with self._lock:
+            self._edits().insert(offset, data)
+
+    def delete(self, offset, length):
+        with self._lock:
+            self._edits().delete(offset, length)
+
+    def replace(self, offset, length, data):
+        with self._lock:
+            self._edits().replace(offset, length, data)
+
+    def _edits(self):
+        if self._pieces is None:
+            if self._source is not None:
+                # Edits go on top of the whole file
+                self._flen = self._source.full_length()
+            self._pieces = PieceTable(self._read_original,
+                self._original_length())
+        return self._pieces
+
+    # Writes the edits to the file. If every original byte
+    #   is still at its old offset, only the edited bytes are
+    #   written, in place. Otherwise the whole file is copied
+    #   once, in order, into a new file that replaces it.
+    def save(self):
+        if not self.is_dirty():
+            return
+        if self._source is not None:
+            raise IOError("Can't save a compressed file")
+        path = self._diskpath()
+        if path is None:
+            raise IOError("Can't save a file that isn't on disk")
+
+        with self._lock:
+            if self._pieces.aligned():
+                self._save_in_place()
+            else:
+                self._save_copy(path)
+            self._pieces = None
+
+    def _save_in_place(self):
+        pieces = self._pieces
+        pos = 0
+        for added, start, length in pieces.pieces():
+            if added:
+                self.infile.seek(pos)
+                self.infile.write(pieces.added_bytes(start, length))
+            pos += length
+        self.infile.flush()
+        os.fsync(self.infile.fileno())
+
+    def _save_copy(self, path):
+        pieces = self._pieces
+        directory, name = os.path.split(os.path.abspath(path))
+        fd, temp = tempfile.mkstemp(prefix="." + name + ".", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as outfile:
+                for added, start, length in pieces.pieces():
+                    for i in xrange(start, start + length, _SAVE_CHUNK):
+                        end = min(i + _SAVE_CHUNK, start + length)
+                        if added:
+                            outfile.write(pieces.added_bytes(i, end - i))
+                        else:
+                            outfile.write(self._read_original(i, end))
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            shutil.copymode(path, temp)
+        except:
+            os.remove(temp)
+            raise
+
+        mapped = self._map is not None
+        self.close()
+        os.rename(temp, path)
+
+        self.infile = open(path, "r+b")
+        self._owned = True
+        self._flen = None
+        if mapped:
+            self._open_map()
 
+    @profiled("FileBuffer.dumpToStream")
     def dumpToStream(self, stream, start, end, width=8):
+        stream.push_batch(self.tokens(start, end, width))
+
+    # Splits the bytes in [start, end) into a batch of
+    #   (token, index) pairs, width bytes per token
+    def tokens(self, start, end, width=8):
+        window = self.read(start, end)
+        return [ (window[i:i+width], start + i)
+            for i in xrange(0, len(window), width) ]
+
+    # Returns the bytes in [start, end) as a memoryview. This
+    #   is a single slice of the mapping, or a single read
+    #   if the file couldn't be mapped.
+    def read(self, start, end):
+        if self._pieces is None and self._view is not None:
+            return self._view[start:end]
+
+        if end <= start:
+            return memoryview(b'')
+        with self._lock:
+            if self._pieces is not None:
+                return self._pieces.read(start, end)
+            return self._read_original(start, end)
+
+    # Reads the file itself, ignoring edits
+    def _read_original(self, start, end):
+        if self._source is not None:
+            return memoryview(self._source.read(start, end))
+        if self._view is not None:
+            return self._view[start:end]
         self.infile.seek(start)
-        remaining = end - start
-
-        toread = width if remaining > width else remaining
-        val = self.infile.read(toread)
-        while val != '' and remaining > 0:
-            ind = end - remaining
-            stream.push_token(bytes(val), ind)
-
-            remaining -= len(val)
-
-            toread = width if remaining > width else remaining
-            val = self.infile.read(toread)
+        return memoryview(self.infile.read(end - start))
+
+    # The offset of the first byte at or after 'offset' that
+    #   is stored on disk, skipping over the holes of a sparse
+    #   file, or the length of the file if there are only holes
+    #   left. Where holes can't be told apart, such as in an
+    #   edited file, it is 'offset'.
+    def next_data(self, offset):
+        if (self._pieces is not None or self._source is not None
+                or _SEEK_DATA is None):
+            return offset
+        with self._lock:
+            try:
+                return os.lseek(self.infile.fileno(), offset, _SEEK_DATA)
+            except (AttributeError, ValueError):
+                return offset
+            except EnvironmentError as e:
+                if e.errno == errno.ENXIO:
+                    return self._original_length()
+                return offset
 
     def __len__(self):
+        if self._pieces is not None:
+            return len(self._pieces)
+        return self._original_length()
+
+    def _original_length(self):
+        if self._view is not None:
+            return len(self._view)
+        if self._flen is None and self._source is not None:
+            # Only grow() moves it on, so the file doesn't change
+            #   length under the view
+            self._flen = self._source.length()
         if self._flen is None:
             temp = self.infile.tell()
             self.infile.seek(0, os.SEEK_END)
@@ -108,17 +563,75 @@ class FileBuffer(object):
         return self._flen
 
 
+# Slicing a memoryview doesn't copy. Python 2's mmap only
+#   exposes the old buffer interface, so go through buffer()
+def _mapview(mapped):
+    try:
+        return memoryview(mapped)
+    except TypeError:
+        return memoryview(buffer(mapped))
+
+
+# Alongside each line is its width (the length of its
+#   longest string), so that the width of the column is
+#   known without going back over every line
 class ColumnBuffer(object):
     def __init__(self):
         self.lines = []
+        self.widths = []
 
     def push_token(self, token, index):
         if isinstance(token, str):
             token = [ token ]
         self.lines.append(token)
+        self.widths.append(_width(token))
+
+    def push_batch(self, batch):
+        lines = self.lines
+        widths = self.widths
+        for token, index in batch:
+            if isinstance(token, str):
+                token = [ token ]
+            lines.append(token)
+            widths.append(_width(token))
 
     def clear(self):
         self.lines = []
+        self.widths = []
+
+    # Removes every line, and returns them in a new buffer
+    def take(self):
+        taken = ColumnBuffer()
+        taken.lines, taken.widths = self.lines, self.widths
+        self.clear()
+        return taken
+
+    # Replaces the 'count' lines at 'index' with the lines of
+    #   another buffer
+    def splice(self, index, count, other):
+        self.lines[index:index + count] = other.lines
+        self.widths[index:index + count] = other.widths
+
+    # Takes over the lines of another buffer
+    def restore(self, other):
+        self.lines, self.widths = other.lines, other.widths
+
+    # Adds empty lines until there are 'count'
+    def pad(self, count):
+        missing = count - len(self.lines)
+        self.lines.extend([] for i in xrange(missing))
+        self.widths.extend(0 for i in xrange(missing))
+
+    def width(self):
+        return max(self.widths) if self.widths else 0
+
+    def drop_front(self, count):
+        del self.lines[:count]
+        del self.widths[:count]
+
+    def drop_back(self, count):
+        del self.lines[len(self.lines) - count:]
+        del self.widths[len(self.widths) - count:]
 
     def __len__(self):
         return len(self.lines)
@@ -131,3 +644,16 @@ class ColumnBuffer(object):
     def __iter__(self):
         return iter(self.lines)
 
+    # Roughly how many bytes the lines take up
+    def memory(self):
+        size = sys.getsizeof(self.lines) + sys.getsizeof(self.widths)
+        for lines in self.lines:
+            size += sys.getsizeof(lines) + sum(imap(sys.getsizeof, lines))
+        return size
+
+
+def _name(processor):
+    return getattr(processor, "__name__", None) or type(processor).__name__
+
+def _width(lines):
+    return max(len(line) for line in lines) if lines else 0
@@ -1,6 +1,7 @@
-from itertools import izip_longest, imap
+from itertools import izip, izip_longest, imap
 from buffer import ColumnBuffer
 from bisect import bisect_left, bisect_right
+from debugger import profiled
 
 class BufferManager(object):
     def __init__(self, columngaps):
@@ -9,48 +10,58 @@ class BufferManager(object):
         self.buffers = [ ColumnBuffer() for i in xrange(numcolumns) ]
         self.lens = [ 0 for i in xrange(numcolumns) ]
 
+        # screenpos and linepos hold absolute positions, which
+        #   don't change as lines are added to or dropped from
+        #   either end. The first buffer line is always drawn
+        #   at pad row 0, which is absolute row 'rowbase'.
         self.screenpos = []
         self.linepos = {}
+        self.rowbase = 0
+        self.linebase = 0
+
+        self._held = None
 
     def clear(self):
         for buff in self.buffers:
             buff.clear()
-        self.screenpos = []
-        self.linepos.clear()
+        self._clear_positions()
 
     def clear_plugin(self):
         self.buffers[-1].clear()
-        self.screenpos = []
-        self.linepos.clear()
+        self._clear_positions()
 
     def clear_preview(self):
         self.buffers[2].clear()
+        self._clear_positions()
+
+    def _clear_positions(self):
         self.screenpos = []
         self.linepos.clear()
+        self.rowbase = 0
+        self.linebase = 0
 
     def lineToScreen(self, line):
         if line >= len(self.screenpos):
             raise IndexError("Cannot get screen index for line: %s" % str(line))
-        return self.screenpos[line]
+        return self.screenpos[line] - self.rowbase
 
     def screenToScreenRange(self, screenLine):
         line = self.screenToLine(screenLine)
         if line >= len(self.screenpos) - 1:
             raise IndexError("Cannot get screen range for the last line in buffers. Input: %s, Line: %s" % (screenLine, line))
-        return self.screenpos[line], self.screenpos[line+1]
+        return (self.screenpos[line] - self.rowbase,
+            self.screenpos[line+1] - self.rowbase)
 
     def screenToLine(self, screenLine):
-        return _largest_lt(self.screenpos, screenLine)
+        return _largest_lt(self.screenpos, screenLine + self.rowbase)
 
     def getBuffers(self):
         return self.buffers
 
     def _computemaxlen(self, index):
-        buff = self.buffers[index]
-        lines = _flatten(buff)
-        maxlen = max(imap(len, lines))
-        self.lens[index] = maxlen
+        self.lens[index] = self.buffers[index].width()
 
+    @profiled("BufferManager.computelens")
     def computelens(self):
         for i in xrange(len(self.buffers)):
             self._computemaxlen(i)
@@ -61,42 +72,190 @@ class BufferManager(object):
             self.columns.append(val)
             val += self.lens[i] + self.columngaps[i]
 
+    @profiled("BufferManager.draw")
     def draw(self, editpad):
+        self._clear_positions()
         zipiter = izip_longest(*self.buffers)
-        curline = 0
-        for linenum, alllines in enumerate(zipiter):
-            #alllines is a tuple of each buffer's line
-            maxlen = max(imap(len, alllines))
+        self._record(self._drawrows(editpad, zipiter, 0), 0)
+
+    # Sets the buffers aside, so that new lines can be pushed
+    #   into them and then attached to either end of the
+    #   current lines with append or prepend
+    def stage(self):
+        self._held = [ buff.take() for buff in self.buffers ]
+
+    # Adds the staged lines after the current ones and draws
+    #   only them, unless they don't fit in the current
+    #   column widths
+    def append(self, editpad):
+        new, count = self._take_staged()
+        for buff, held, lines in zip(self.buffers, self._held, new):
+            held.splice(len(held), 0, lines)
+            buff.restore(held)
+        self._held = None
+
+        if self._widen(new):
+            self._relayout(editpad)
+            return
+
+        endrow = self.screenend()
+        self.screenpos.pop()
+        positions = self._drawrows(editpad, izip(*new), endrow)
+        self._record(positions, len(self.screenpos))
+
+    # Adds the staged lines before the current ones, and
+    #   returns the number of rows that the current lines
+    #   were pushed down by
+    def prepend(self, editpad):
+        new, count = self._take_staged()
+        for buff, held, lines in zip(self.buffers, self._held, new):
+            held.splice(0, 0, lines)
+            buff.restore(held)
+        self._held = None
+
+        rows = sum(_rowheight(alllines) for alllines in izip(*new))
+
+        if self._widen(new):
+            self._relayout(editpad)
+            return rows
+
+        editpad.shift(-rows)
+        self.rowbase -= rows
+        self.linebase -= count
+        positions = self._drawrows(editpad, izip(*new), 0)
+        self.screenpos[0:0] = [ row + self.rowbase
+            for row in positions[:-1] ]
+        for line in xrange(count):
+            self.linepos[self.screenpos[line]] = line + self.linebase
+        return rows
+
+    # Drops the first 'count' lines and shifts the pad up to
+    #   match. Returns the number of rows removed.
+    def drop_front(self, count, editpad):
+        if count <= 0:
+            return 0
+        rows = self.screenpos[count] - self.screenpos[0]
+
+        for buff in self.buffers:
+            buff.drop_front(count)
+        for row in self.screenpos[:count]:
+            self.linepos.pop(row, None)
+        del self.screenpos[:count]
+
+        self.rowbase += rows
+        self.linebase += count
+        editpad.shift(rows)
+        return rows
+
+    # Drops the last 'count' lines and blanks their rows
+    def drop_back(self, count, editpad):
+        if count <= 0:
+            return
+        oldend = self.screenend()
+        newlen = len(self.screenpos) - count
+
+        for buff in self.buffers:
+            buff.drop_back(count)
+        for row in self.screenpos[newlen - 1:-1]:
+            self.linepos.pop(row, None)
+        del self.screenpos[newlen:]
+
+        editpad.clearrows(self.screenend(), oldend)
+
+    # Swaps the staged lines in for the 'count' lines starting
+    #   at 'first'. Only their rows are redrawn, unless the
+    #   lines don't take up the same space they did before.
+    def replace(self, first, count, editpad):
+        new, newcount = self._take_staged()
+        for buff, held, lines in zip(self.buffers, self._held, new):
+            held.splice(first, count, lines)
+            buff.restore(held)
+        self._held = None
+
+        heights = [ _rowheight(alllines) for alllines in izip(*new) ]
+        if self._widen(new) or heights != self.heights(first, count):
+            self._relayout(editpad)
+            return
+
+        row = self.lineToScreen(first)
+        editpad.clearrows(row, row + sum(heights))
+        self._drawrows(editpad, izip(*new), row)
+
+    def _take_staged(self):
+        new = [ buff.take() for buff in self.buffers ]
+        count = max(imap(len, new))
+        for lines in new:
+            lines.pad(count)
+        return new, count
+
+    # Grows the column widths to fit the new lines. Returns
+    #   True if anything had to be moved
+    def _widen(self, new):
+        widened = False
+        for i, lines in enumerate(new):
+            maxlen = lines.width()
+            if maxlen > self.lens[i]:
+                self.lens[i] = maxlen
+                widened = True
+        return widened
+
+    def _relayout(self, editpad):
+        self.computelens()
+        editpad.clear()
+        self.draw(editpad)
+
+    # Draws every line in 'rows' (an iter of a tuple of each
+    #   buffer's line) starting at the given pad row. Returns
+    #   the pad row of each line, plus where the last one ends
+    def _drawrows(self, editpad, rows, row):
+        positions = []
+        columns = self.columns
+        for alllines in rows:
+            positions.append(row)
 
             # Draw everything
             for col, lines in enumerate(alllines):
+                if lines is None:
+                    continue
                 for lineoffset, line in enumerate(lines):
-                    yval = curline + lineoffset
-                    xval = self.columns[col]
-                    editpad.drawstr(yval, xval, line)
+                    editpad.drawstr(row + lineoffset, columns[col], line)
 
-            # Record the screen position
-            self.screenpos.append(curline)
-            self.linepos[curline] = linenum
-
-            curline += maxlen
+            row += _rowheight(alllines)
         # Add the end, so the difference can be told between
         #   the last line and off the screen
-        self.screenpos.append(curline)
-        self.linepos[curline] = linenum
+        positions.append(row)
+        return positions
+
+    # Stores pad row positions for lines starting at 'first'
+    def _record(self, positions, first):
+        rowbase = self.rowbase
+        linebase = self.linebase
+        for offset, row in enumerate(positions[:-1]):
+            self.linepos[row + rowbase] = first + offset + linebase
+        self.screenpos.extend(row + rowbase for row in positions)
+
+    # The number of rows each of the 'count' lines starting
+    #   at 'first' takes up
+    def heights(self, first, count):
+        screenpos = self.screenpos
+        return [ screenpos[line + 1] - screenpos[line]
+            for line in xrange(first, first + count) ]
 
     def screenend(self):
-        return self.screenpos[-1]
+        return self.screenpos[-1] - self.rowbase
 
     def lineend(self):
         return len(self.screenpos)
 
+    def memory(self):
+        return sum(buff.memory() for buff in self.buffers)
+
 
-# takes iter<iter<thing>> and flattens to iter<thing>
-def _flatten(iterable):
-    for inner in iterable:
-        for val in inner:
-            yield val
+# The number of rows a line takes up, which is the most
+#   rows that any buffer needs for it
+def _rowheight(alllines):
+    return max(len(lines) if lines is not None else 0
+        for lines in alllines)
 
 def _largest_lt(array, val):
     x = bisect_left(array, val)
@@ -0,0 +1,429 @@
+import os
+import json
+import zlib
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from searchindex import sidecar_path
+import debugger
+
+# xz and zstd are only read if their modules are installed
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compressed bytes read at a time
+_CHUNK = 64 * 1024
+# Most bytes decompressed from one call, so a run of zeros
+#   can't decompress into one huge string
+_MAXOUT = 1024 * 1024
+# xz and zstd decompressors can't be told to stop early, so
+#   they are given this many compressed bytes at a time
+_FEED = 4096
+# Decompressed bytes are cached in pages of this many bytes
+_PAGE = 64 * 1024
+
+# Kept apart from the search index's sidecar, which is beside
+#   the same file
+_SUFFIX = ".hexzidx"
+_VERSION = 1
+
+
+####### Formats ########
+# Each format starts decompressors, and feeds one some data,
+#   returning (output, unconsumed, ended): the input it hasn't
+#   used yet, and whether it got to the end of its gzip member
+#   or xz/zstd frame. Formats whose decompressors can be
+#   copied can be checkpointed partway through a member.
+
+class _Gzip(object):
+    name = "gzip"
+    magic = "\x1f\x8b"
+    copyable = True
+    errors = (zlib.error,)
+
+    def new(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def feed(self, decomp, data):
+        output = decomp.decompress(data, _MAXOUT)
+        if decomp.unused_data:
+            return output, decomp.unused_data, True
+        return output, decomp.unconsumed_tail, False
+
+class _Xz(object):
+    name = "xz"
+    magic = "\xfd7zXZ\x00"
+    copyable = False
+
+    def __init__(self):
+        self.errors = (lzma.LZMAError,)
+
+    def new(self):
+        return lzma.LZMADecompressor()
+
+    def feed(self, decomp, data):
+        output = decomp.decompress(data[:_FEED])
+        if decomp.eof:
+            return output, decomp.unused_data + data[_FEED:], True
+        return output, data[_FEED:], False
+
+class _Zstd(object):
+    name = "zstd"
+    magic = "\x28\xb5\x2f\xfd"
+    copyable = False
+
+    def __init__(self):
+        self.errors = (zstandard.ZstdError,)
+
+    def new(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    def feed(self, decomp, data):
+        output = decomp.decompress(data[:_FEED])
+        if getattr(decomp, "eof", False):
+            return output, decomp.unused_data + data[_FEED:], True
+        return output, data[_FEED:], False
+
+def _formats():
+    formats = [ _Gzip() ]
+    if lzma is not None:
+        formats.append(_Xz())
+    if zstandard is not None:
+        formats.append(_Zstd())
+    return formats
+
+
+# Returns a started CompressedSource for the file if it is on
+#   disk and starts with a compressed format that can be read
+#   here, otherwise None. The magic bytes alone aren't enough,
+#   since any file can start with them, so the start of the
+#   file has to decompress too.
+def open_source(infile, interval, cachesize):
+    name = getattr(infile, "name", None)
+    if not isinstance(name, str) or not os.path.isfile(name):
+        return None
+    with open(name, "rb") as header:
+        head = header.read(_CHUNK)
+    for codec in _formats():
+        if head.startswith(codec.magic) and _parses(codec, head):
+            source = CompressedSource(name, codec, interval, cachesize)
+            source.start()
+            return source
+    return None
+
+def _parses(codec, head):
+    try:
+        codec.feed(codec.new(), head)
+    except codec.errors:
+        return False
+    return True
+
+
+# CompressedSource reads the decompressed bytes of a file at
+#   any offset, without decompressing the file to disk.
+# A background pass goes through the whole file once, which
+#   finds its length and leaves checkpoints every 'interval'
+#   decompressed bytes, so a read only decompresses from the
+#   checkpoint before it. A checkpoint is either the start of
+#   a gzip member or xz/zstd frame, or (for gzip) a copy of
+#   the decompressor partway through a member.
+# Until the pass is done, the length is how far it has got,
+#   and reads past that wait for it.
+# The length and the starts of the members are saved beside
+#   the file. If the members are no further apart than
+#   'interval', that is all the checkpoints, and the file
+#   opens without a pass next time. Python 2's zlib can't
+#   start partway through a member (there is no way to give
+#   it the bits and window to start from), so the checkpoints
+#   inside members can't be saved, and a file of one big
+#   member is gone through again every time it is opened.
+#   Only its length is known straight away.
+# xz and zstd decompressors can't be copied at all, so the
+#   only checkpoints are the starts of frames. Each page of a
+#   file of one big frame is decompressed from the start of
+#   the file, and 'slow' is set once that is found.
+# Up to 'cachesize' bytes of decompressed pages are kept.
+class CompressedSource(object):
+    def __init__(self, path, codec, interval, cachesize):
+        self.path = path
+        self.codec = codec
+        self.format = codec.name
+        self.interval = interval
+
+        # Parallel lists of each checkpoint's decompressed
+        #   offset, compressed offset and decompressor state
+        #   (None at the start of a member)
+        self._offsets = []
+        self._coffsets = []
+        self._states = []
+        # How far through the decompressed bytes the pass is
+        self.indexed = 0
+        self.done = False
+        self._length = None
+        # Set when reads have to decompress from further back
+        #   than 'interval'
+        self.slow = False
+
+        self._pages = OrderedDict()
+        self._maxpages = max(cachesize // _PAGE, 1)
+
+        self._changed = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self._readfile = open(path, "rb")
+
+    def start(self):
+        if self._load_sidecar():
+            self._check_slow(self._length)
+            if not self._needs_pass():
+                self.indexed = self._length
+                self.done = True
+                return
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._stopped = True
+        with self._changed:
+            self._changed.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._readfile.close()
+
+    # The decompressed length, or as much of it as the pass has
+    #   found so far, until complete() is True
+    def length(self):
+        with self._changed:
+            if self._length is not None:
+                return self._length
+            return self.indexed
+
+    def complete(self):
+        return self._length is not None
+
+    # The whole decompressed length, waiting for the pass to
+    #   get to the end if it has to
+    def full_length(self):
+        with self._changed:
+            while self._length is None and not self._stopped:
+                self._changed.wait()
+            return self.length()
+
+    # The decompressed bytes in [start, end)
+    def read(self, start, end):
+        end = min(end, self.length())
+        if start >= end:
+            return ""
+        first = start // _PAGE
+        data = "".join(self._page(page)
+            for page in xrange(first, (end - 1) // _PAGE + 1))
+        offset = start - first * _PAGE
+        return data[offset:offset + end - start]
+
+    def _page(self, page):
+        data = self._pages.pop(page, None)
+        if data is None:
+            self._decode(page)
+            data = self._pages.pop(page, "")
+        self._pages[page] = data
+        return data
+
+    # Decompresses from the checkpoint before 'page' up to the
+    #   end of it, caching every whole page on the way
+    def _decode(self, page):
+        target = page * _PAGE
+        with self._changed:
+            while not (self.done or self._stopped or self.indexed > target
+                    or self._near(target)):
+                self._changed.wait()
+            i = bisect_right(self._offsets, target) - 1
+            pos = self._offsets[i]
+            cpos = self._coffsets[i]
+            state = self._states[i]
+
+        decomp = self.codec.new() if state is None else state.copy()
+        # The checkpoint may be partway through a page, which
+        #   can't be cached since its start isn't known
+        bufstart = pos
+        buf = ""
+        used = 0
+        for output, pos, cpos, decomp, started in self._stream(
+                self._readfile, decomp, cpos, pos):
+            buf = buf[used:] + output
+            used = 0
+            while len(buf) - used >= _PAGE or (decomp is None and used < len(buf)):
+                step = _PAGE - bufstart % _PAGE
+                if bufstart % _PAGE == 0:
+                    self._cache(bufstart // _PAGE, buf[used:used + _PAGE])
+                    if bufstart // _PAGE >= page:
+                        return
+                used += step
+                bufstart += step
+
+    def _near(self, target):
+        i = bisect_right(self._offsets, target) - 1
+        return i >= 0 and target - self._offsets[i] < self.interval
+
+    def _cache(self, page, data):
+        self._pages[page] = data
+        while len(self._pages) > self._maxpages:
+            self._pages.popitem(last=False)
+
+    # Decompresses the file from the given offsets, yielding
+    #   (output, decompressed offset after it, compressed
+    #   offset after it, decompressor, started) where 'started'
+    #   is set when a new member starts at those offsets. The
+    #   decompressor is None after the last output.
+    def _stream(self, infile, decomp, cpos, pos):
+        codec = self.codec
+        infile.seek(cpos)
+        data = ""
+        while not self._stopped:
+            if not data:
+                data = infile.read(_CHUNK)
+                if not data:
+                    yield "", pos, cpos, None, False
+                    return
+            readend = cpos + len(data)
+            try:
+                output, rest, ended = codec.feed(decomp, data)
+            except codec.errors:
+                # Junk after the last member
+                yield "", pos, cpos, None, False
+                return
+            if not output and not ended and len(rest) == len(data):
+                # It needs more input before it can go on
+                more = infile.read(_CHUNK)
+                if not more:
+                    yield "", pos, cpos, None, False
+                    return
+                data = rest + more
+                continue
+
+            data = rest
+            cpos = readend - len(data)
+            pos += len(output)
+            if ended:
+                if not data:
+                    data = infile.read(_CHUNK)
+                if not data:
+                    yield output, pos, cpos, None, False
+                    return
+                decomp = codec.new()
+            yield output, pos, cpos, decomp, ended
+
+    # The pass over the whole file
+    def _run(self):
+        infile = open(self.path, "rb")
+        pos = 0
+        try:
+            self._add(0, 0, None)
+            nextcheck = self.interval
+            for output, pos, cpos, decomp, started in self._stream(
+                    infile, self.codec.new(), 0, 0):
+                if started:
+                    self._add(pos, cpos, None)
+                    nextcheck = pos + self.interval
+                elif (decomp is not None and self.codec.copyable
+                        and pos >= nextcheck):
+                    self._add(pos, cpos, decomp.copy())
+                    nextcheck = pos + self.interval
+                elif (not self.slow and not self.codec.copyable
+                        and pos - self._offsets[-1] > self.interval):
+                    self._check_slow(pos)
+                with self._changed:
+                    self.indexed = pos
+                    self._changed.notify_all()
+            if not self._stopped:
+                self._length = pos
+                self._save_sidecar()
+        finally:
+            infile.close()
+            with self._changed:
+                if self._length is None:
+                    self._length = pos
+                self.indexed = self._length
+                self.done = True
+                self._changed.notify_all()
+
+    def _add(self, pos, cpos, state):
+        with self._changed:
+            i = bisect_right(self._offsets, pos)
+            if i > 0 and self._offsets[i - 1] == pos:
+                return
+            self._offsets.insert(i, pos)
+            self._coffsets.insert(i, cpos)
+            self._states.insert(i, state)
+            self._changed.notify_all()
+
+    # Whether the members are too far apart to read from
+    #   without checkpoints in between
+    def _needs_pass(self):
+        return self.codec.copyable and self._sparse(self._length)
+
+    # Whether any checkpoint up to 'end' is more than 'interval'
+    #   from the next
+    def _sparse(self, end):
+        ends = self._offsets[1:] + [ end ]
+        return any(end - start > self.interval
+            for start, end in zip(self._offsets, ends))
+
+    # Sets 'slow' and logs it if this can't be checkpointed
+    #   within a frame and the frames up to 'end' are too far
+    #   apart
+    def _check_slow(self, end):
+        if self.codec.copyable or not self._sparse(end):
+            return
+        self.slow = True
+        debugger.logCont("%s is %s with frames over %d bytes apart, so "
+            "reads decompress from the start of their frame"
+            % (self.path, self.format, self.interval))
+
+    def _sidecar(self):
+        return sidecar_path(self.path, _SUFFIX)
+
+    def _stamp(self):
+        stat = os.stat(self.path)
+        return stat.st_size, int(stat.st_mtime)
+
+    def _load_sidecar(self):
+        try:
+            with open(self._sidecar()) as infile:
+                index = json.load(infile)
+            size, mtime = self._stamp()
+            if (index["version"] != _VERSION or index["format"] != self.format
+                    or index["size"] != size or index["mtime"] != mtime):
+                return False
+            for pos, cpos in index["starts"]:
+                self._add(pos, cpos, None)
+            self._length = index["length"]
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    # Saving is skipped if neither the directory nor the cache
+    #   can be written to
+    def _save_sidecar(self):
+        size, mtime = self._stamp()
+        starts = [ [ pos, cpos ] for pos, cpos, state
+            in zip(self._offsets, self._coffsets, self._states)
+            if state is None ]
+        index = { "version": _VERSION, "format": self.format,
+            "size": size, "mtime": mtime, "length": self._length,
+            "starts": starts }
+        try:
+            with open(self._sidecar(), "w") as outfile:
+                json.dump(index, outfile)
+        except EnvironmentError:
+            pass
@@ -1,3 +1,8 @@
+import os
+import json
+import time
+import threading
+from collections import deque
 from contextlib import contextmanager
 
 _debug = False
@@ -21,11 +26,109 @@ def logCont(message):
         _debug_log.append(message)
 
 
+####### Profiling ########
+# Profiling is switched on by setting HEXPROFILE to the file
+#   the trace should be written to on exit. Without it,
+#   profiled() hands functions back as they are, so the
+#   instrumented code costs nothing.
+_trace_path = os.environ.get("HEXPROFILE") or None
+profiling = _trace_path is not None
+
+# The most trace events kept. The oldest are dropped first.
+_MAX_EVENTS = 500000
+
+_lock = threading.Lock()
+_start = time.time()
+# name -> [calls, total seconds, most seconds]
+_timers = {}
+# name -> { field -> value }, the latest of each counter
+_counters = {}
+_events = deque(maxlen=_MAX_EVENTS)
+
+# Times every call of the decorated function under 'name',
+#   which can also be a function of the call's arguments
+#   that returns the name
+def profiled(name):
+    def decorate(function):
+        if not profiling:
+            return function
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                end = time.time()
+                label = name(*args, **kwargs) if callable(name) else name
+                _record(label, start, end)
+        timed.__name__ = function.__name__
+        return timed
+    return decorate
+
+def _record(name, start, end):
+    elapsed = end - start
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            timer = _timers[name] = [ 0, 0.0, 0.0 ]
+        timer[0] += 1
+        timer[1] += elapsed
+        timer[2] = max(timer[2], elapsed)
+        _events.append({ "name": name, "ph": "X",
+            "ts": (start - _start) * 1e6, "dur": elapsed * 1e6,
+            "pid": os.getpid(), "tid": threading.current_thread().ident })
+
+# Records the current values of a counter, such as cache
+#   hits. Callers check 'profiling' first.
+def counter(name, **values):
+    with _lock:
+        _counters[name] = values
+        _events.append({ "name": name, "ph": "C",
+            "ts": (time.time() - _start) * 1e6,
+            "pid": os.getpid(), "args": values })
+
+def reset_profile():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _events.clear()
+
+# Lines describing the timers (slowest total first) and the
+#   counters, for showing on screen
+def profile_summary():
+    with _lock:
+        timers = sorted(_timers.iteritems(), key=lambda item: -item[1][1])
+        counters = sorted(_counters.iteritems())
+
+    lines = [ "%-32s %7s %9s %8s %8s" % ("stage", "calls", "total ms",
+        "mean ms", "max ms") ]
+    for name, (calls, total, most) in timers:
+        lines.append("%-32s %7d %9.1f %8.3f %8.2f" % (name[:32], calls,
+            total * 1000, total * 1000 / calls, most * 1000))
+    for name, values in counters:
+        lines.append("%s: %s" % (name, ", ".join("%s=%s" % item
+            for item in sorted(values.iteritems()))))
+    return lines
+
+# Writes what has been recorded as a Chrome trace, which can
+#   be opened in chrome://tracing or Perfetto
+def write_trace(path):
+    with _lock:
+        events = list(_events)
+        timers = dict((name, { "calls": calls, "total": total, "max": most })
+            for name, (calls, total, most) in _timers.iteritems())
+    with open(path, "w") as outfile:
+        json.dump({ "traceEvents": events, "displayTimeUnit": "ms",
+            "otherData": { "timers": timers } }, outfile)
+
+
 @contextmanager
 def debug_context():
     try:
         yield
     finally:
+        if profiling:
+            write_trace(_trace_path)
         if len(_debug_log) > 0:
             print "==== DEBUG OUTPUT ===="
             for message in _debug_log:
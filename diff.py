@@ -0,0 +1,191 @@
+import mmap
+import time
+import zlib
+import threading
+import multiprocessing
+from bisect import bisect_left, bisect_right
+
+# How many blocks each worker job covers
+_BLOCKS_PER_JOB = 64
+
+# Blocks that differ are compared in pieces of this many
+#   bytes. A differing piece adds the span from its first to
+#   its last differing byte, so regions have exact ends but
+#   can take in equal bytes shorter than a piece.
+_PIECE = 256
+
+
+# Diff finds the regions where two files on disk differ, on
+#   a background thread. Both files are split into blocks
+#   whose checksums are compared across a process pool, with
+#   each worker mapping the files itself. Only the blocks
+#   that don't match are compared byte by byte.
+# Regions (start, end) are added to 'regions' in file order
+#   as they're found, so they can be used before the diff is
+#   done. Where one file is longer, its extra bytes are the
+#   last region.
+class Diff(object):
+    def __init__(self, patha, pathb, workers=1, blocksize=64*1024,
+            maxregions=1000000):
+        self.patha = patha
+        self.pathb = pathb
+        self.workers = workers
+        self.blocksize = blocksize
+        self.maxregions = maxregions
+
+        self.regions = []
+        self.starts = []
+        self.scanned = 0
+        self.done = False
+
+        self._cancelled = False
+        self._changed = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # The start of the first region after 'offset', waiting
+    #   up to 'timeout' seconds for the diff to get to one.
+    #   None if there isn't one (yet).
+    def next_diff(self, offset, timeout=None):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        with self._changed:
+            i = bisect_right(self.starts, offset)
+            while i >= len(self.starts) and not self.done:
+                if deadline is None:
+                    self._changed.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._changed.wait(remaining)
+                i = bisect_right(self.starts, offset)
+
+            if i < len(self.starts):
+                return self.starts[i]
+            return None
+
+    # The start of the last region before 'offset'
+    def prev_diff(self, offset):
+        i = bisect_left(self.starts, offset)
+        if i > 0:
+            return self.starts[i - 1]
+        return None
+
+    def _run(self):
+        try:
+            lena = _filesize(self.patha)
+            lenb = _filesize(self.pathb)
+            for regions, end in self._scan(min(lena, lenb)):
+                if self._cancelled:
+                    return
+                if not self._add(regions, end):
+                    return
+            if lena != lenb:
+                self._add([ (min(lena, lenb), max(lena, lenb)) ],
+                    max(lena, lenb))
+        finally:
+            with self._changed:
+                self.done = True
+                self._changed.notify_all()
+
+    # Yields (regions, end) for each job, in file order
+    def _scan(self, size):
+        step = self.blocksize * _BLOCKS_PER_JOB
+        jobs = [ (self.patha, self.pathb, start, min(start + step, size),
+            self.blocksize) for start in xrange(0, size, step) ]
+
+        if self.workers <= 1:
+            for job in jobs:
+                if self._cancelled:
+                    return
+                yield _diff_range(job), job[3]
+            return
+
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            for i, regions in enumerate(pool.imap(_diff_range, jobs)):
+                if self._cancelled:
+                    return
+                yield regions, jobs[i][3]
+        finally:
+            pool.terminate()
+
+    # Returns False once there are too many regions
+    def _add(self, regions, end):
+        with self._changed:
+            for start, stop in regions:
+                if len(self.regions) >= self.maxregions:
+                    return False
+                _join(self.regions, start, stop)
+                if len(self.starts) < len(self.regions):
+                    self.starts.append(start)
+            self.scanned = end
+            self._changed.notify_all()
+        return True
+
+
+def _filesize(path):
+    with open(path, "rb") as infile:
+        infile.seek(0, 2)
+        return infile.tell()
+
+# Adds [start, end) to the regions, joining it onto the last
+#   one if they touch
+def _join(regions, start, end):
+    if regions and regions[-1][1] >= start:
+        regions[-1] = (regions[-1][0], max(regions[-1][1], end))
+    else:
+        regions.append((start, end))
+
+# Runs in the worker processes
+def _diff_range(job):
+    patha, pathb, start, end, blocksize = job
+    with open(patha, "rb") as filea:
+        with open(pathb, "rb") as fileb:
+            a = mmap.mmap(filea.fileno(), 0, access=mmap.ACCESS_READ)
+            b = mmap.mmap(fileb.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        regions = []
+        for block in xrange(start, end, blocksize):
+            stop = min(block + blocksize, end)
+            if _digest(a, block, stop) != _digest(b, block, stop):
+                _refine(a, b, block, stop, regions)
+        return regions
+    finally:
+        a.close()
+        b.close()
+
+# A crc32 and an adler32 together make a 64 bit digest,
+#   several times faster to compute than md5
+def _digest(mapped, start, end):
+    data = buffer(mapped, start, end - start)
+    return zlib.crc32(data), zlib.adler32(data)
+
+def _refine(a, b, start, end, regions):
+    for piece in xrange(start, end, _PIECE):
+        stop = min(piece + _PIECE, end)
+        x = a[piece:stop]
+        y = b[piece:stop]
+        if x == y:
+            continue
+
+        first = 0
+        while x[first] == y[first]:
+            first += 1
+        last = len(x) - 1
+        while x[last] == y[last]:
+            last -= 1
+        _join(regions, piece + first, piece + last + 1)
@@ -1,5 +1,8 @@
 import curses
+import binascii
+import multiprocessing
 from buffer import BufferStream, CachedBufferStream
+from plugin import tobytes
 
 ########## Configurable variables ##############
 
@@ -10,9 +13,46 @@ class EditPadConfig(object):
     def __init__(self):
         self.bytesPerLine = 8
         self.heightcapacity = 100
+        self.cachebudget = 8 * 1024 * 1024
+        # Bytes of output kept for each distinct line, so that
+        #   repeated lines are only formatted once. 0 turns it off.
+        self.memobudget = 0
+        self.prefetchdepth = 3
+        self.prefetchmemory = 2 * 1024 * 1024
+        self.pluginworkers = multiprocessing.cpu_count()
+        self.pluginpool = "process"
+        self.plugintimeout = 1.0
+        self.searchworkers = multiprocessing.cpu_count()
+        self.searchwait = 2.0
+        self.indexthreshold = 256 * 1024 * 1024
+        self.undomemory = 16 * 1024 * 1024
+        self.diffworkers = multiprocessing.cpu_count()
+        self.diffblocksize = 64 * 1024
+        # Compressed files are checkpointed every this many
+        #   decompressed bytes. None reads them as they are.
+        self.compressedcheckpoint = 4 * 1024 * 1024
+        self.compressedcache = 8 * 1024 * 1024
+        # Draw only the visible rows, rather than keeping every
+        #   loaded row on a curses pad
+        self.virtualpad = False
+        # Most screen updates per second. Keys that come in
+        #   faster than this are handled together.
+        self.framerate = 60
+        # Seconds between checks for a followed file growing
+        self.followinterval = 0.1
+        # Show each run of identical lines as its first line and
+        #   a '*' marker, like hexdump does
+        self.collapse = False
+        # Seconds between showing the runs found so far, while
+        #   the rest of the file is still being scanned
+        self.collapseinterval = 0.5
+        self.undocoalesce = 1.0
         self.columns = []
         self.columngaps = []
         self.streams = []
+        # The IndexToLineNum of the offset column, sized by the
+        #   EditPad for the file it shows
+        self.offsets = None
 
     def addcolumn(self, gap):
         self.columngaps.append(gap)
@@ -32,7 +72,8 @@ def CreateDefaultConfig():
     config.addcolumn(4)
     config.addcolumn(4)
 
-    st1 = BufferStream(IndexToLineNum)
+    config.offsets = IndexToLineNum()
+    st1 = BufferStream(config.offsets)
     st2 = BufferStream(BytesToByteLine)
     st3 = CachedBufferStream(BytesToNormalStr, bytesPerLine)
 
@@ -43,37 +84,91 @@ def CreateDefaultConfig():
     return config
 
 ####### Stream Functions ########
+# Each formatter also has a 'batch' version, which takes a
+#   whole window of (token, index) pairs and returns the
+#   list of output lines. BufferStream uses it when pushing
+#   a batch. They all take memoryviews, so they say so for
+#   when they are used as plugins (see plugin.py).
 def BytesToByteLine(token):
-    byteList = memoryview(token).tolist()
-    byteStrs = map(_bytesToHex, byteList)
-    return ' '.join(byteStrs)
+    return _hexLines([ token ])[0]
 
 def BytesToNormalStr(token):
-    byteList = memoryview(token).tolist()
-    byteStrs = map(curses.unctrl, byteList)
-    padded = map(_padTo3, byteStrs)
-    return ''.join(padded)
+    table = _asciiTable()
+    return ''.join(map(table.__getitem__, bytearray(token)))
+
+def _batchBytesToByteLine(batch):
+    return _hexLines([ token for token, index in batch ])
+BytesToByteLine.batch = _batchBytesToByteLine
+BytesToByteLine.memoryviews = True
+
+def _batchBytesToNormalStr(batch):
+    lookup = _asciiTable().__getitem__
+    return [ ''.join(map(lookup, bytearray(token)))
+        for token, index in batch ]
+BytesToNormalStr.batch = _batchBytesToNormalStr
+BytesToNormalStr.memoryviews = True
+
+# Each line's offset, printed with the same width for every
+#   line of the file. Each EditPad has its own, since files
+#   shown side by side can have different lengths.
+class IndexToLineNum(object):
+    want_index = True
+    # Every line's offset is different, and their width changes
+    #   with the file's length
+    memoize = False
+    memoryviews = True
 
-# Helper for BytesToByteLine
-def _bytesToHex(val):
-    if val > 255 or val < 0:
-        return "XX"
-
-    val = hex(val)[2:] # Chop off the inital '0x'
-    val = val.upper()
-    if len(val) == 1:
-        val = '0' + val
-
-    return val
-
-# Helper for BytesToNormalStr
+    def __init__(self):
+        self.format = '0X%X'
+
+    def __call__(self, val, index):
+        return self.format % index
+
+    def batch(self, batch):
+        fmt = self.format
+        return [ fmt % index for token, index in batch ]
+
+    # Sizes the offsets for a file of 'flen' bytes. Returns
+    #   True if their width changed.
+    def setFileLength(self, flen):
+        old = self.format
+        digits = len('%X' % max(flen - 1, 0))
+        self.format = '0X%%0%iX' % digits
+        return self.format != old
+
+############### Lookup Tables ##################
+# Hex values for the whole window are produced by a single
+#   hexlify call, then spread out to 'XX XX XX' with
+#   slice assignment, so no per byte python code is run
+def _hexLines(tokens):
+    data = b''.join([ tobytes(token) for token in tokens ])
+    hexed = binascii.hexlify(data).upper()
+
+    spaced = bytearray(b' ' * (3 * len(data)))
+    spaced[0::3] = hexed[0::2]
+    spaced[1::3] = hexed[1::2]
+    spaced = str(spaced)
+
+    lines = []
+    pos = 0
+    for token in tokens:
+        width = 3 * len(token)
+        lines.append(spaced[pos:pos + width - 1])
+        pos += width
+    return lines
+
+# curses.unctrl can't be called before initscr(), so this
+#   table is built the first time it is needed
+_asciiTableCache = []
+
+def _asciiTable():
+    if len(_asciiTableCache) == 0:
+        _asciiTableCache.extend(
+            _padTo3(curses.unctrl(val)) for val in xrange(256))
+    return _asciiTableCache
+
+# Helper for the ascii table
 def _padTo3(word):
     while len(word) < 3:
         word += ' '
     return word
-
-def IndexToLineNum(val, index):
-    return hex(index).upper()
-IndexToLineNum.want_index = True
-
-
@@ -1,9 +1,13 @@
 import curses
 import curses.ascii
+import binascii
 from editpad import EditPad
 from editconfig import EditPadConfig, CreateDefaultConfig
 from textbox import Textbox, popup
+from diff import Diff
+from plugin import adapt
 from debugger import debug_context
+import debugger
 
 
 class Editor(object):
@@ -42,6 +46,8 @@ class StartWin(object):
         self.window.addstr(2,4,"q - quit")
         self.window.addstr(3,4,"o - open file")
         self.window.addstr(4,4,"n - new file")
+        self.window.addstr(5,4,"d - diff two files")
+        self.window.addstr(6,4,"r - open file without decompressing")
         self.window.refresh()
 
     def exit(self):
@@ -54,17 +60,24 @@ class StartWin(object):
         if char == ord('o'):
             selectfile = SelectFileWin()
             editor.SetActive(selectfile)
+        if char == ord('r'):
+            editor.SetActive(SelectFileWin(raw=True))
+        if char == ord('d'):
+            editor.SetActive(SelectDiffWin())
         return True
 
 
+# 'raw' opens compressed files as the bytes on disk, so they
+#   can be seen and patched as they are
 class SelectFileWin(object):
-    def __init__(self):
+    def __init__(self, raw=False):
         window = unbedwin(editor.mainwin, 5, 10)
         self.textbox = Textbox(window, "File Path: ")
+        self.raw = raw
 
     def process(self):
         val = self.textbox.gettext()
-        f = FileWin(val)
+        f = FileWin(val, self.raw)
         editor.SetActive(f)
         return True
 
@@ -72,11 +85,28 @@ class SelectFileWin(object):
         self.textbox.clear()
 
 
+class SelectDiffWin(object):
+    def __init__(self):
+        self.window = unbedwin(editor.mainwin, 5, 10)
+        self.textbox = Textbox(self.window, "First File: ")
+
+    def process(self):
+        first = self.textbox.gettext()
+        self.textbox = Textbox(self.window, "Second File: ")
+        second = self.textbox.gettext()
+        editor.SetActive(DiffWin(first, second))
+        return True
+
+    def exit(self):
+        self.textbox.clear()
+
+
 class FileWin(object):
-    def __init__(self, filename):
+    def __init__(self, filename, raw=False):
         self.f = None
+        self.warned = False
 
-        self.initwins(filename)
+        self.initwins(filename, raw)
 
         try:
             self.f = open(filename, "r+b")
@@ -90,20 +120,35 @@ class FileWin(object):
             editor.SetActive(editor.mainmenu)
             return True
 
+        self.editpad.poll()
+        if not self.warned and self.editpad.filedata.slow_reads():
+            self.warned = True
+            popup(self.textwin, ["This file's compressed frames are far apart,",
+                "so reading far into it can be slow",
+                "Push any key to continue"])
         self.editpad.refresh()
-        char = self.editpad.getch()
-
+        frametime = 1.0 / self.editpad.config.framerate
+        for char, count in _actions(self.editpad.getkeys(frametime)):
+            self.handle(char, count)
+        return True
 
+    def handle(self, char, count):
         if char == ord('q'):
             editor.SetActive(editor.mainmenu)
-        elif char == curses.KEY_UP:
-            self.editpad.scroll(-1)
-        elif char == curses.KEY_DOWN:
-            self.editpad.scroll(1)
+        elif char == _SCROLL:
+            self.editpad.scroll(count)
+        elif char == ord('F'):
+            self.editpad.set_follow(not self.editpad.following)
+        elif char == ord('*'):
+            self.editpad.set_collapse(self.editpad.runindex is None)
         elif char == ord('g'):
             t = Textbox(self.textwin, "Goto Line: ")
             val = t.gettext()
             self.editpad.goto(val)
+        elif char == ord('%'):
+            t = Textbox(self.textwin, "Goto Percent: ")
+            val = t.gettext()
+            self.editpad.goto_percent(val)
         elif char >= ord('0') and char <= ord('9'):
             val = char - ord('0')
             self.editpad.activate_plugin(val)
@@ -113,15 +158,109 @@ class FileWin(object):
             self.editpad.set_preview()
         elif char == ord('x'):
             self.editpad.unset_preview()
-        return True
+        elif char == ord('v'):
+            t = Textbox(self.textwin, "Pin preview (offset length): ")
+            self.edited(self.editpad.pin_preview(t.gettext()))
+        elif char == ord('V'):
+            t = Textbox(self.textwin, "Unpin preview (offset length): ")
+            self.edited(self.editpad.unpin_preview(t.gettext()))
+        elif char == ord('b'):
+            self.editpad.bookmark()
+        elif char == ord('a'):
+            t = Textbox(self.textwin, "Annotate (offset length color note): ")
+            self.edited(self.editpad.annotate(t.gettext()))
+        elif char == ord(']'):
+            self.editpad.next_annotation()
+        elif char == ord('['):
+            self.editpad.prev_annotation()
+        elif char == ord('A'):
+            t = Textbox(self.textwin, "Import annotations from: ")
+            if not self.editpad.import_annotations(t.gettext()):
+                popup(self.textwin, ["*** ERROR ***: Could not read annotations",
+                    "Push any key to continue"])
+        elif char == ord('E'):
+            t = Textbox(self.textwin, "Export annotations to: ")
+            if not self.editpad.export_annotations(t.gettext()):
+                popup(self.textwin, ["*** ERROR ***: Could not write annotations",
+                    "Push any key to continue"])
+        elif char == ord('/'):
+            t = Textbox(self.textwin, "Search: ")
+            val = t.gettext()
+            if not self.editpad.search(val):
+                self.notfound()
+        elif char == ord('n'):
+            if not self.editpad.next_hit():
+                self.notfound()
+        elif char == ord('N'):
+            if not self.editpad.prev_hit():
+                self.notfound()
+        elif char == ord('I'):
+            self.showindex()
+        elif char == ord('P'):
+            self.showprofile()
+        elif char == ord('w'):
+            t = Textbox(self.textwin, "Write (offset bytes): ")
+            self.edited(self.editpad.write_bytes(t.gettext()))
+        elif char == ord('i'):
+            t = Textbox(self.textwin, "Insert (offset bytes): ")
+            self.edited(self.editpad.insert_bytes(t.gettext()))
+        elif char == ord('d'):
+            t = Textbox(self.textwin, "Delete (offset length): ")
+            self.edited(self.editpad.delete_bytes(t.gettext()))
+        elif char == ord('u'):
+            self.editpad.undo()
+        elif char == ord('r'):
+            self.editpad.redo()
+        elif char == ord('s'):
+            if not self.editpad.save():
+                popup(self.textwin, ["*** ERROR ***: Could not save file",
+                    "Push any key to continue"])
+
+    def edited(self, ok):
+        if not ok:
+            popup(self.textwin, ["Couldn't read that edit",
+                "Push any key to continue"])
+
+    def showindex(self):
+        stats = self.editpad.index_stats()
+        if stats is None:
+            message = [ "This file has no search index" ]
+        else:
+            latency = stats["query_latency"]
+            message = [
+                "Index: %s/%s blocks%s" % (stats["built"], stats["blocks"],
+                    "" if stats["ready"] else " (building)"),
+                "Build rate: %.1f MB/s" % (stats["build_rate"] / 2**20),
+                "Size: %.1f MB" % (stats["index_size"] / 2.0**20),
+                "Last query: %s" % ("-" if latency is None
+                    else "%.1f ms" % (latency * 1000)),
+            ]
+        popup(self.textwin, message + [ "Push any key to continue" ])
+
+    def showprofile(self):
+        if not debugger.profiling:
+            message = [ "Profiling is off. Set HEXPROFILE to a trace",
+                "file to turn it on." ]
+        else:
+            height = self.textwin.getmaxyx()[0]
+            message = debugger.profile_summary()[:height - 3]
+        popup(self.textwin, message + [ "Push any key to continue" ])
+
+    def notfound(self):
+        if self.editpad.search_done():
+            message = "No more matches"
+        else:
+            message = "Still searching..."
+        popup(self.textwin, [message, "Push any key to continue"])
 
     def exit(self):
         if self.f != None:
+            self.editpad.closefile()
             self.f.close()
         self.fullwin.clear()
         self.fullwin.refresh()
 
-    def initwins(self, filename):
+    def initwins(self, filename, raw):
         self.fullwin = unbedwin(editor.mainwin, 2, 5)
         self.fullwin.clear()
         self.fullwin.addstr(0,0, filename)
@@ -130,6 +269,8 @@ class FileWin(object):
         self.boxwin.box()
 
         config = CreateDefaultConfig()
+        if raw:
+            config.compressedcheckpoint = None
         self.editpad = EditPad(self.boxwin, 1, config, _plugins)
 
         self.fullwin.refresh()
@@ -138,6 +279,156 @@ class FileWin(object):
         self.textwin = unbedwin(editor.mainwin, 7, 12)
 
 
+# DiffWin shows two files side by side, scrolling together,
+#   with keys to jump between the regions where they differ.
+#   The files are compared as the bytes on disk, so compressed
+#   files are shown that way too, for the regions to line up.
+class DiffWin(object):
+    def __init__(self, filea, fileb):
+        self.files = []
+        self.diff = None
+
+        self.initwins(filea, fileb)
+
+        try:
+            for filename, editpad in zip((filea, fileb), self.editpads):
+                f = open(filename, "rb")
+                self.files.append(f)
+                editpad.loadfile(f)
+        except IOError:
+            popup(self.textwin, ["*** ERROR ***: Could not open file", "Push any key to quit to the main menu"])
+            return
+
+        config = self.editpads[0].config
+        self.diff = Diff(filea, fileb, config.diffworkers,
+            config.diffblocksize)
+        self.diff.start()
+
+    def process(self):
+        if self.diff == None: # Failed to open a file
+            editor.SetActive(editor.mainmenu)
+            return True
+
+        for editpad in self.editpads:
+            editpad.refresh()
+        first = self.editpads[0]
+        frametime = 1.0 / first.config.framerate
+        for char, count in _actions(first.getkeys(frametime)):
+            self.handle(char, count)
+        return True
+
+    def handle(self, char, count):
+        first = self.editpads[0]
+        if char == ord('q'):
+            editor.SetActive(editor.mainmenu)
+        elif char == _SCROLL:
+            self.scroll(count)
+        elif char == ord('g'):
+            t = Textbox(self.textwin, "Goto Line: ")
+            val = t.gettext()
+            for editpad in self.editpads:
+                editpad.goto(val)
+        elif char >= ord('0') and char <= ord('9'):
+            for editpad in self.editpads:
+                editpad.activate_plugin(char - ord('0'))
+        elif char == ord('`'):
+            for editpad in self.editpads:
+                editpad.activate_plugin(-1)
+        elif char == ord('n'):
+            offset = first.current_offset() + first.config.bytesPerLine - 1
+            self.jump(self.diff.next_diff(offset, first.config.searchwait))
+        elif char == ord('N'):
+            self.jump(self.diff.prev_diff(first.current_offset()))
+
+    def scroll(self, val):
+        first, second = self.editpads
+        first.scroll(val)
+        second.scroll(val)
+
+        # Line heights can differ between the two, so keep the
+        #   second one on the same line as the first
+        if second.current_offset() != first.current_offset():
+            second.show_offset(first.current_offset())
+
+    def jump(self, offset):
+        if offset is None:
+            if self.diff.done:
+                message = "No more differences"
+            else:
+                message = "Still comparing..."
+            popup(self.textwin, [message, "Push any key to continue"])
+            return
+        for editpad in self.editpads:
+            editpad.show_offset(offset)
+
+    def exit(self):
+        if self.diff != None:
+            self.diff.cancel()
+        for editpad in self.editpads:
+            if editpad.filedata != None:
+                editpad.closefile()
+        for f in self.files:
+            f.close()
+        self.fullwin.clear()
+        self.fullwin.refresh()
+
+    def initwins(self, filea, fileb):
+        self.fullwin = unbedwin(editor.mainwin, 2, 5)
+        self.fullwin.clear()
+        height, width = self.fullwin.getmaxyx()
+        half = width // 2
+
+        self.fullwin.addstr(0,0, filea[:width - half - 1])
+        self.fullwin.addstr(0,width - half, fileb[:half - 1])
+
+        self.boxwins = [ embedwin(self.fullwin, 1, 0, 1, half),
+            embedwin(self.fullwin, 1, width - half, 1, 0) ]
+        self.editpads = []
+        for boxwin in self.boxwins:
+            boxwin.box()
+            config = CreateDefaultConfig()
+            config.compressedcheckpoint = None
+            self.editpads.append(EditPad(boxwin, 1, config, _plugins))
+
+        self.fullwin.refresh()
+        for editpad in self.editpads:
+            editpad.refresh()
+
+        self.textwin = unbedwin(editor.mainwin, 7, 12)
+
+
+# Stands in for the key of a scroll made up of several arrow
+#   keys
+_SCROLL = None
+
+_SCROLLKEYS = { curses.KEY_UP: -1, curses.KEY_DOWN: 1 }
+
+# Keys that open a prompt, which the keys typed after them go to
+_PROMPTKEYS = set(map(ord, "g/%widvVaAE"))
+
+# Turns the keys read in one frame into (key, count) actions.
+#   Runs of arrow keys become one (_SCROLL, net lines) action.
+#   Keys that open a prompt or leave the window end the frame,
+#   and the keys after them are put back for what comes next.
+def _actions(keys):
+    actions = []
+    for i, char in enumerate(keys):
+        if char in _SCROLLKEYS:
+            step = _SCROLLKEYS[char]
+            if actions and actions[-1][0] == _SCROLL:
+                actions[-1] = (_SCROLL, actions[-1][1] + step)
+            else:
+                actions.append((_SCROLL, step))
+            continue
+
+        actions.append((char, 1))
+        if char in _PROMPTKEYS or char == ord('q'):
+            for key in reversed(keys[i+1:]):
+                curses.ungetch(key)
+            break
+    return actions
+
+
 def embedwin(window, vgap, hgap, vgap2=None, hgap2=None):
     height, width = window.getmaxyx()
     if hgap2 == None:
@@ -170,7 +461,7 @@ def launch(plugins):
         raise TypeError("plugins cannot be None. Use an empty list if no plugins are desired.")
 
     global _plugins
-    _plugins = plugins
+    _plugins = [ adapt(plugin) for plugin in plugins ]
 
     with debug_context():
         curses.wrapper(main)
@@ -181,6 +472,23 @@ def temp(token):
 def temp2(token):
     return ["Yo - ", "  bleh"]
 
+# A window plugin that shows the 3 byte RGB pixels starting on
+#   each line, so most lines need a byte or two of the next
+class RGBPixels(object):
+    pure = True
+    cost = 0.00001
+    context = (0, 2)
+
+    def window(self, view, base, start, end, width):
+        hexed = binascii.hexlify(view.tobytes()).upper()
+        stop = base + len(view) - 2
+        lines = []
+        for line in xrange(start, end, width):
+            first = line + (-line) % 3
+            lines.append(" ".join("#" + hexed[2*(pos - base):2*(pos - base) + 6]
+                for pos in xrange(first, min(line + width, stop), 3)))
+        return lines
+
 if __name__ == "__main__":
-    launch([ temp, temp2 ])
+    launch([ temp, temp2, RGBPixels() ])
 
@@ -1,10 +1,23 @@
+import re
+import time
 import curses
 import curses.ascii
 from buffer import BufferStream, MutableBufferStream, FileBuffer
-from padmanager import PadManager
+from padmanager import PadManager, VirtualPadManager
 from buffermanager import BufferManager
 from linewindow import LineWindowManager
+from rendercache import RenderCache, ContentCache
+from prefetch import Prefetcher
+from pluginpool import PluginPool
+from search import Pattern, Search
+from searchindex import SearchIndex
+from journal import Journal
+from plugin import adapt
+from runs import RunIndex
+from annotations import Annotation, AnnotationIndex
+import annotations
 import editconfig
+import debugger
 
 
 """
@@ -14,25 +27,75 @@ It keeps track of data, scrolls, and draws it to the screen
 class EditPad(object):
     def __init__(self, refwin, padding, config, plugins):
         self.config = config
-        self.plugins = plugins
+        self.plugins = [ adapt(plugin) for plugin in plugins ]
+        self.noplugin = adapt(drop_stream)
+        self.asciiplugin = adapt(editconfig.BytesToNormalStr)
         editconfig.bytesPerLine = config.bytesPerLine
 
-        self.padmanager = PadManager(refwin, padding, config.heightcapacity)
+        if config.virtualpad:
+            self.padmanager = VirtualPadManager(refwin, padding,
+                config.heightcapacity)
+        else:
+            self.padmanager = PadManager(refwin, padding,
+                config.heightcapacity)
 
         self.buffers = BufferManager(self.config.columngaps)
+        self.rendercache = RenderCache(config.cachebudget,
+            config.bytesPerLine)
+        self.contentcache = None
+        if config.memobudget > 0:
+            self.contentcache = ContentCache(config.memobudget)
+        self.pluginpool = PluginPool(config.pluginworkers,
+            config.pluginpool, config.plugintimeout)
 
         self._init_streams()
 
         self.windowmanager = None
+        self.filedata = None
+        self.prefetcher = None
+        self.searcher = None
+        self.searchindex = None
+        self.lastframe = 0
+        self.following = False
+        # Runs of identical lines are collapsed while there is
+        #   a RunIndex. The view shows the RunMap that was last
+        #   taken from it, or every line if that is None.
+        self.runindex = None
+        self.runmap = None
+        self._runsversion = None
+        self._runstime = 0
+        self.journal = Journal(config.undomemory, config.undocoalesce)
+        self.annotations = AnnotationIndex()
 
     def refresh(self):
+        self._mark_annotations()
         self.padmanager.refresh()
-
+        self.lastframe = time.time()
+        if debugger.profiling:
+            self._count()
+
+    # Records the cache and memory counters for the profile
+    def _count(self):
+        stats = self.rendercache.stats()
+        debugger.counter("rendercache", hits=stats["hits"],
+            misses=stats["misses"], hitrate=round(stats["hitrate"], 3),
+            size=stats["size"])
+        debugger.counter("memory", buffers=self.buffers.memory(),
+            cache=stats["size"])
+        memo = self.memo_stats()
+        if memo is not None:
+            debugger.counter("contentcache", hits=memo["hits"],
+                misses=memo["misses"], hitrate=round(memo["hitrate"], 3),
+                size=memo["size"])
+        debugger.counter("pad", cells=self.padmanager.cellswritten,
+            plugintimeouts=self.pluginpool.timeouts)
+
+    # Moves the cursor by 'val' lines
     def scroll(self, val):
-        if val == 1:
-            self.windowmanager.incr_cursor()
-        elif val == -1:
-            self.windowmanager.decr_cursor()
+        if val == 0:
+            return
+        self.windowmanager.move_cursor_by(val)
+        self.prefetcher.scrolled(1 if val > 0 else -1, abs(val))
 
     def goto(self, val):
         try:
@@ -42,50 +105,648 @@ class EditPad(object):
 
         line = byte // editconfig.bytesPerLine
 
-        self.windowmanager.move_cursor(line)
+        self.prefetcher.cancel()
+        self.windowmanager.move_cursor(self._view_line(line))
 
-    def unset_preview(self):
-        current_line = self.windowmanager.current_line()
+    # Jumps to a percentage of the way through the file's rows
+    def goto_percent(self, val):
+        try:
+            percent = float(val)
+        except ValueError:
+            return
 
-        # Add the value to the preview stream
-        self.previewstream.remove(current_line)
+        self.prefetcher.cancel()
+        self.windowmanager.move_fraction(percent / 100)
 
-        # Refresh
-        self._do_preview_redump(current_line)
+    def current_offset(self):
+        line = self._file_lines(self.windowmanager.current_line())[0]
+        return line * editconfig.bytesPerLine
 
-    def set_preview(self):
-        current_line = self.windowmanager.current_line()
+    # Jumps the view to the line the byte is on, centering it
+    def show_offset(self, offset):
+        self.prefetcher.cancel()
+        line = offset // editconfig.bytesPerLine
+        self.windowmanager.move_vwindow(self._view_line(line))
 
-        # Get the plugin value
-        screen_line = self.windowmanager.current_bufferline()
-        plugin_buff = self.buffers.getBuffers()[-1]
-        plugin_val = plugin_buff[screen_line]
+    # Starts a search (see search.Pattern for the syntax) and
+    #   jumps to the first hit after the cursor. Returns False
+    #   if the query is invalid or nothing was found.
+    def search(self, query):
+        try:
+            pattern = Pattern(query)
+        except (ValueError, re.error):
+            return False
+
+        self._stop_search()
+        self._start_search(pattern)
+        return self.next_hit()
+
+    def next_hit(self):
+        if self.searcher is None:
+            return False
+
+        # After every line of a marker
+        line = self._file_lines(self.windowmanager.current_line())[1]
+        offset = line * editconfig.bytesPerLine - 1
+        hit = self.searcher.next_hit(offset, self.config.searchwait)
+        return self._goto_hit(hit)
+
+    def prev_hit(self):
+        if self.searcher is None:
+            return False
+
+        line = self._file_lines(self.windowmanager.current_line())[0]
+        hit = self.searcher.prev_hit(line * editconfig.bytesPerLine)
+        return self._goto_hit(hit)
+
+    def search_done(self):
+        return self.searcher is None or self.searcher.done
+
+    # Build rate, size and query latency of the search index,
+    #   or None if the file doesn't have one
+    def index_stats(self):
+        if self.searchindex is None:
+            return None
+        return self.searchindex.stats()
+
+    # Hit rate and size of the ContentCache, or None if it
+    #   is turned off
+    def memo_stats(self):
+        if self.contentcache is None:
+            return None
+        return self.contentcache.stats()
+
+    # Moves the cursor to the next or previous annotation, or
+    #   returns False if there isn't one
+    def next_annotation(self):
+        line = self._file_lines(self.windowmanager.current_line())[1]
+        found = self.annotations.next_after(line * editconfig.bytesPerLine - 1)
+        if found is None or found.start >= len(self.filedata):
+            return False
+        return self._goto_hit(found.start)
+
+    def prev_annotation(self):
+        line = self._file_lines(self.windowmanager.current_line())[0]
+        found = self.annotations.prev_before(line * editconfig.bytesPerLine)
+        return self._goto_hit(found.start if found is not None else None)
+
+    def _goto_hit(self, hit):
+        if hit is None:
+            return False
+        self.prefetcher.cancel()
+        line = hit // editconfig.bytesPerLine
+        self.windowmanager.move_cursor(self._view_line(line))
+        return True
+
+    def _start_search(self, pattern):
+        self.searcher = Search(self.filedata, pattern,
+            self.config.searchworkers, index=self.searchindex)
+        self.searcher.start()
+
+    def _stop_search(self):
+        if self.searcher is not None:
+            self.searcher.cancel()
+            self.searcher = None
+
+    # Edits are typed as a hex offset followed by hex bytes,
+    #   such as "1f0 de ad be ef", or for delete a hex offset
+    #   and a hex length. They return False if 'val' can't be
+    #   read.
+    def write_bytes(self, val):
+        parsed = _parse_bytes(val)
+        if parsed is None:
+            return False
+        offset, data = parsed
+        return self._edit(offset, len(data), data)
+
+    def insert_bytes(self, val):
+        parsed = _parse_bytes(val)
+        if parsed is None:
+            return False
+        offset, data = parsed
+        return self._edit(offset, 0, data)
+
+    def delete_bytes(self, val):
+        parsed = _parse_length(val)
+        if parsed is None:
+            return False
+        offset, length = parsed
+        return self._edit(offset, length, "")
+
+    # Return False if there is nothing to undo or redo
+    def undo(self):
+        return self._replay(self.journal.undo())
+
+    def redo(self):
+        return self._replay(self.journal.redo())
+
+    def is_dirty(self):
+        return self.filedata.is_dirty()
+
+    # Returns False if the file couldn't be written
+    def save(self):
+        # Saving can close the file's mapping, so nothing may be
+        #   reading it until it is done
+        self.prefetcher.stop()
+        pattern = None
+        if self.searcher is not None:
+            pattern = self.searcher.pattern
+            self._stop_search()
+        if self.runindex is not None:
+            self.runindex.stop()
+        try:
+            self.filedata.save()
+        except EnvironmentError:
+            return False
+        finally:
+            if self.runindex is not None:
+                self.runindex.start()
+            if pattern is not None:
+                self._start_search(pattern)
+            self.prefetcher.start()
+        self._save_preview()
+        return True
+
+    # Replaces 'length' bytes at offset with data, and records
+    #   it in the journal
+    def _edit(self, offset, length, data):
+        flen = len(self.filedata)
+        if offset > flen:
+            return False
+        old = self.filedata.read(offset, offset + length).tobytes()
+        self.journal.record(offset, old, data)
+        self._apply(offset, len(old), data)
+        return True
+
+    def _replay(self, step):
+        if step is None:
+            return False
+        offset, before, after = step
+        self._apply(offset, len(before), after)
+        return True
+
+    def _apply(self, offset, length, data):
+        # The prefetcher mustn't cache lines from before the edit
+        self.prefetcher.stop()
+        self._stop_search()
+
+        flen = len(self.filedata)
+        self.filedata.replace(offset, length, data)
+        self.previewstream.overrides.edited(offset, length, len(data))
+        self.annotations.edited(offset, length, len(data))
+        if len(self.filedata) == flen:
+            self._changed(offset, offset + len(data), False)
+        else:
+            self._changed(offset, max(flen, len(self.filedata)), True)
 
-        # Add the value to the preview stream
-        self.previewstream.add(current_line, plugin_val)
+        self.prefetcher.start()
 
-        # Refresh
-        self._do_preview_redump(current_line)
+    # Formats and draws the loaded lines that the bytes in
+    #   [start, end) are on again, leaving the rest alone.
+    #   If the file was resized, every line after start moved.
+    def _changed(self, start, end, resized):
+        bpl = editconfig.bytesPerLine
+        wm = self.windowmanager
+        first = start // bpl
+        last = (end - 1) // bpl + 1
+        # Plugins that look past their own lines change too
+        before, after = self.pluginstream.processor.reach(bpl)
+        first = max(first - before, 0)
+        last += after
+
+        if resized:
+            if self._size_offsets():
+                self.rendercache.clear()
+                first = 0
+            else:
+                self.rendercache.invalidate_lines(first, last)
+            wm.set_flen(self._lastdataline())
+        else:
+            self.rendercache.invalidate_lines(first, last)
+
+        if self.runindex is not None:
+            # Runs can start or stop anywhere the bytes changed,
+            #   so the whole view is taken from the runs again
+            self.runindex.changed(start // bpl, (end - 1) // bpl + 1,
+                resized, self._lastdataline() + 1)
+            self._apply_runs(reload=True)
+            return
 
-    def _do_preview_redump(self, current_line):
-        self.buffers.clear_preview()
-        self._redump_data(self.previewstream)
+        current_line = wm.current_line()
+        if wm.fit_fwindow():
+            first = max(first, wm.fwin.start)
+            last = min(last, wm.fwin.end)
+            if first < last:
+                count = last - first
+                if resized:
+                    # Every line up to the end of the window
+                    count = self.buffers.lineend() - 1 - (first - wm.fwin.start)
+                self.buffers.stage()
+                self.filedata.dumpToStream(self.forkstream,
+                    first * bpl, last * bpl,
+                    width=bpl)
+                self.buffers.replace(first - wm.fwin.start, count,
+                    self.padmanager)
+                wm.measure()
+        wm.move_cursor(current_line)
+
+    # The preview column shows the output of the plugin that
+    #   was pinned over a line, rather than its own. These pin
+    #   or unpin the current plugin over the cursor's line.
+    def set_preview(self):
+        first, last = self._file_lines(self.windowmanager.current_line())
+        bpl = editconfig.bytesPerLine
+        self._pin(first * bpl, last * bpl, self.pluginstream.processor)
 
-        # Return highlighting
-        self.windowmanager.move_cursor(current_line)
+    def unset_preview(self):
+        first, last = self._file_lines(self.windowmanager.current_line())
+        bpl = editconfig.bytesPerLine
+        self._pin(first * bpl, last * bpl, None)
+
+    # Pins the current plugin over a range of bytes, typed as
+    #   a hex offset and length. Returns False if 'val' can't
+    #   be read.
+    def pin_preview(self, val):
+        parsed = _parse_length(val)
+        if parsed is None:
+            return False
+        offset, length = parsed
+        self._pin(offset, offset + length, self.pluginstream.processor)
+        return True
+
+    def unpin_preview(self, val):
+        parsed = _parse_length(val)
+        if parsed is None:
+            return False
+        offset, length = parsed
+        self._pin(offset, offset + length, None)
+        return True
+
+    # Pins the plugin over [start, end), or unpins it if None,
+    #   and draws the lines that changed
+    def _pin(self, start, end, plugin):
+        overrides = self.previewstream.overrides
+        if plugin is None:
+            changed = overrides.unpin(start, end)
+        else:
+            changed = overrides.pin(start, end, plugin)
+        if changed:
+            bpl = editconfig.bytesPerLine
+            self._redraw_lines(start // bpl, (end - 1) // bpl + 1)
+
+    # Puts a bookmark on the cursor's line, or takes off the
+    #   bookmarks that start on it
+    def bookmark(self):
+        first, last = self._file_lines(self.windowmanager.current_line())
+        bpl = editconfig.bytesPerLine
+        start, end = first * bpl, last * bpl
+        found = [ annotation for annotation
+            in self.annotations.overlapping(start, end)
+            if annotation.is_bookmark() and annotation.start >= start ]
+        for annotation in found:
+            self.annotations.remove(annotation)
+        if len(found) == 0:
+            self.annotations.add(Annotation(start, end))
+
+    # Annotates a range of bytes, typed as a hex offset and
+    #   length, then a color (see padmanager._COLORS) and a
+    #   note, which can both be left off. Returns False if
+    #   'val' can't be read or starts past the end of the file.
+    def annotate(self, val):
+        parts = val.split(None, 2)
+        parsed = _parse_length(" ".join(parts[:2]))
+        if parsed is None or parsed[0] >= len(self.filedata):
+            return False
+        offset, length = parsed
+        color, note = None, ""
+        if len(parts) > 2:
+            color = parts[2].split(None, 1)[0]
+            note = parts[2][len(color):].strip()
+        self.annotations.add(Annotation(offset, offset + length, color, note))
+        return True
+
+    # Adds the annotations in a file written by
+    #   export_annotations. Returns False if it can't be read.
+    def import_annotations(self, path):
+        try:
+            with open(path, "rb") as infile:
+                loaded = annotations.load(infile)
+        except (EnvironmentError, ValueError):
+            return False
+        self.annotations.extend(loaded)
+        return True
+
+    def export_annotations(self, path):
+        try:
+            with open(path, "wb") as outfile:
+                annotations.dump(self.annotations, outfile)
+        except EnvironmentError:
+            return False
+        return True
+
+    # Marks the rows of the lines in view that have annotations
+    #   on them with their colors. Where annotations overlap,
+    #   the one that starts last is shown.
+    def _mark_annotations(self):
+        wm = self.windowmanager
+        buffers = self.buffers
+        if (len(self.annotations) == 0 or wm is None
+                or buffers.screenend() <= 0):
+            self.padmanager.set_marks({})
+            return
+
+        end = buffers.screenend()
+        first = buffers.screenToLine(min(wm.vwin.start, end - 1))
+        last = buffers.screenToLine(min(wm.vwin.end, end) - 1) + 1
+        base = wm.fwin.start
+        bpl = editconfig.bytesPerLine
+        start = self._file_lines(base + first)[0] * bpl
+        stop = self._file_lines(base + last - 1)[1] * bpl
+
+        # The annotation shown on each line in view. The ones
+        #   that start above it cover it from the top down, so
+        #   going back from the one that starts last, each is
+        #   only shown past where the ones after it reach.
+        shown = [ None ] * (last - first)
+        reach = first
+        for annotation in reversed(self.annotations.covering(start)):
+            bottom = self._view_line((annotation.end - 1) // bpl) + 1 - base
+            bottom = min(bottom, last)
+            if bottom > reach:
+                shown[reach - first:bottom - first] = (
+                    [ annotation ] * (bottom - reach))
+                reach = bottom
+                if reach == last:
+                    break
+        for annotation in self.annotations.starting(start, stop):
+            top = self._view_line(annotation.start // bpl) - base
+            bottom = self._view_line((annotation.end - 1) // bpl) + 1 - base
+            bottom = min(bottom, last)
+            shown[top - first:bottom - first] = [ annotation ] * (bottom - top)
+
+        marks = {}
+        for line, annotation in enumerate(shown, first):
+            if annotation is not None:
+                for row in xrange(buffers.lineToScreen(line),
+                        buffers.lineToScreen(line + 1)):
+                    marks[row] = annotation.color
+        self.padmanager.set_marks(marks)
+
+    # The plugin that was pinned under the name in a sidecar
+    def _plugin_named(self, name):
+        for plugin in [ self.noplugin, self.asciiplugin ] + self.plugins:
+            if plugin.name == name:
+                return plugin
+        return None
+
+    # Writes out the pinned plugins, unless the file has edits
+    #   that aren't saved, since the ranges have moved with them
+    def _save_preview(self):
+        overrides = self.previewstream.overrides
+        path = self.filedata.path()
+        if (path is None or not overrides.dirty
+                or self.filedata.is_dirty()):
+            return
+        try:
+            overrides.save(path, lambda plugin: plugin.name)
+        except EnvironmentError:
+            pass
 
 
     def getch(self):
         return self.padmanager.pad.getch()
 
+    # Waits for a key, letting the prefetcher run meanwhile.
+    #   Then, no sooner than 'frametime' after the last frame,
+    #   returns it with every key that is queued behind it.
+    #   While following a file, going through a compressed one
+    #   or finding runs to collapse, it gives up waiting after
+    #   a while (see _poll_interval) and returns no keys.
+    def getkeys(self, frametime):
+        pad = self.padmanager.pad
+        if self.prefetcher is not None:
+            self.prefetcher.resume()
+
+        interval = self._poll_interval()
+        if interval is not None:
+            pad.timeout(int(interval * 1000))
+        keys = [ pad.getch() ]
+        if interval is not None:
+            pad.timeout(-1)
+            if keys[0] == -1:
+                if self.prefetcher is not None:
+                    self.prefetcher.pause()
+                return []
+
+        wait = self.lastframe + frametime - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+        if self.prefetcher is not None:
+            self.prefetcher.pause()
+        pad.nodelay(True)
+        try:
+            key = pad.getch()
+            while key != -1:
+                keys.append(key)
+                key = pad.getch()
+        finally:
+            pad.nodelay(False)
+        return keys
+
+    # How long getkeys waits before giving up, so poll can
+    #   run, or None if there is nothing to poll for
+    def _poll_interval(self):
+        if self.following or self.filedata.loading():
+            return self.config.followinterval
+        index = self.runindex
+        if index is not None and (not index.done
+                or index.version != self._runsversion):
+            return self.config.collapseinterval
+        return None
+
+    # Follow mode keeps checking the file for bytes written to
+    #   its end, and keeps the cursor on the last line if it is
+    #   already there
+    def set_follow(self, following):
+        self.following = following
+        if following:
+            self.poll()
+
+    # Shows the runs found since the last call, then whatever
+    #   has been added to the end of the file, or decompressed
+    #   from it. Returns True if the file grew.
+    def poll(self):
+        if self.filedata is None:
+            return False
+        self._poll_runs()
+        if not self.following and not self.filedata.loading():
+            return False
+        flen = len(self.filedata)
+        if self.filedata.grow() <= flen:
+            return False
+
+        self.prefetcher.stop()
+        if self.runindex is not None:
+            self._grow_runs(flen)
+            self.prefetcher.start()
+            return True
+
+        # Only the old last line and the new lines that come
+        #   into view are drawn
+        wm = self.windowmanager
+        at_end = wm.at_end()
+        oldlast = wm.flen
+        loaded = wm.fwin.end >= wm.full_win.end
+        if self._size_offsets():
+            # Every offset got wider
+            self.rendercache.clear()
+            wm.grow_flen(self._lastdataline())
+            current_line = wm.current_line()
+            wm.move_fwindow(current_line)
+            wm.move_cursor(current_line)
+            loaded = False
+        else:
+            wm.grow_flen(self._lastdataline())
+            # The old last line, and any lines whose plugin
+            #   output can see past it
+            bpl = editconfig.bytesPerLine
+            before = self.pluginstream.processor.reach(bpl)[0]
+            if flen % bpl or before:
+                first = max(oldlast - before, 0)
+                self.rendercache.invalidate_lines(first, oldlast + 1)
+                self._redraw_lines(first, oldlast + 1)
+
+        # Up to a window of new lines are added onto the loaded
+        #   ones, otherwise the end is loaded on its own
+        if at_end and self.following:
+            lines = wm.flen - oldlast
+            if loaded and lines <= wm.capacity:
+                wm.slide_fwindow(lines)
+                wm.show_end()
+            else:
+                wm.move_cursor(wm.flen)
+        self.prefetcher.start()
+        return True
+
+    # For when a file with collapsed runs grew from 'flen'
+    #   bytes. Its runs are found again from the old last line
+    #   on, and the view is loaded again.
+    def _grow_runs(self, flen):
+        bpl = editconfig.bytesPerLine
+        at_end = self.windowmanager.at_end()
+        oldlast = max(flen - 1, 0) // bpl
+        if self._size_offsets():
+            self.rendercache.clear()
+        else:
+            before = self.pluginstream.processor.reach(bpl)[0]
+            self.rendercache.invalidate_lines(max(oldlast - before, 0),
+                oldlast + 1)
+
+        nlines = self._lastdataline() + 1
+        self.runindex.changed(oldlast, nlines, True, nlines)
+        self._apply_runs(reload=True)
+        if at_end and self.following:
+            self.windowmanager.move_cursor(self.windowmanager.flen)
+
+    # Switches to the runs found so far, once they have been
+    #   found or config.collapseinterval has passed since the
+    #   last time, so the view doesn't jump on every block
+    def _poll_runs(self):
+        index = self.runindex
+        if index is None or index.version == self._runsversion:
+            return
+        waited = time.time() - self._runstime
+        if index.done or waited >= self.config.collapseinterval:
+            self._apply_runs()
+
+    # Turns collapsing runs of identical lines on or off. The
+    #   runs are found on a background thread, and shown as
+    #   they come in (see poll).
+    def set_collapse(self, collapse):
+        if collapse == (self.runindex is not None):
+            return
+        self.prefetcher.stop()
+        if collapse:
+            self.runindex = RunIndex(self.filedata,
+                editconfig.bytesPerLine, self._lastdataline() + 1)
+            self.runindex.start()
+        else:
+            self.runindex.stop()
+            self.runindex = None
+        self._apply_runs()
+        self.prefetcher.start()
+
+    # Shows the runs of the RunIndex, keeping the cursor on
+    #   the same line of the file. Unless 'reload', nothing is
+    #   loaded again if the runs are the same as before.
+    def _apply_runs(self, reload=False):
+        index = self.runindex
+        runmap = None
+        if index is not None:
+            self._runsversion = index.version
+            runmap = index.runmap()
+        self._runstime = time.time()
+        if not reload and _same_runs(runmap, self.runmap):
+            return
+
+        wm = self.windowmanager
+        line = self._file_lines(wm.current_line())[0]
+        self.runmap = runmap
+        self.prefetcher.set_runmap(runmap)
+
+        current_line = self._view_line(line)
+        wm.set_flen(self._lastline())
+        wm.move_fwindow(current_line)
+        wm.move_cursor(current_line)
+
+    # The file lines [first, last) shown on the view line,
+    #   which is more than one for a marker
+    def _file_lines(self, line):
+        if self.runmap is None:
+            return line, line + 1
+        return self.runmap.to_file(line)
+
+    # The view line that the file line is shown on
+    def _view_line(self, line):
+        if self.runmap is None:
+            return line
+        return self.runmap.to_view(line)
+
+    # Draws the loaded lines that show the file lines in
+    #   [first, last) again, for when their output changed
+    #   without any line moving
+    def _redraw_lines(self, first, last):
+        wm = self.windowmanager
+        first = max(self._view_line(first), wm.fwin.start)
+        last = min(self._view_line(last - 1) + 1, wm.fwin.end)
+        if first >= last:
+            return
+        current_line = wm.current_line()
+        self.buffers.stage()
+        self._dump(self.forkstream, first, last)
+        self.buffers.replace(first - wm.fwin.start, last - first,
+            self.padmanager)
+        wm.measure(first, last)
+        wm.move_cursor(current_line)
+
     def loadfile(self, infile):
-        self.filedata = FileBuffer(infile)
+        self.filedata = FileBuffer(infile,
+            checkpoint=self.config.compressedcheckpoint,
+            pagecache=self.config.compressedcache)
+        self.pluginstream.set_reader(self.filedata.read)
+        self.previewstream.set_reader(self.filedata.read)
+        if self.filedata.path() is not None:
+            self.previewstream.overrides.load(self.filedata.path(),
+                self._plugin_named)
+        self._size_offsets()
 
         self.buffers.clear()
 
         self.windowmanager = LineWindowManager(
             self._lastdataline(),
             self.load_file_piece,
+            self.extend_file_piece,
             self.buffers,
             self.padmanager)
 
@@ -93,19 +754,74 @@ class EditPad(object):
         self.padmanager.set_line(0)
         self.padmanager.highlight_lines([0], 0)
 
+        self.prefetcher = Prefetcher(
+            self.windowmanager,
+            self.filedata,
+            self.forkstream,
+            self.rendercache,
+            self.config.prefetchdepth,
+            self.config.prefetchmemory)
+        self.prefetcher.start()
+
+        path = self.filedata.path()
+        threshold = self.config.indexthreshold
+        if (path is not None and threshold is not None
+                and len(self.filedata) >= threshold):
+            self.searchindex = SearchIndex(path,
+                workers=self.config.searchworkers)
+            self.searchindex.open()
+
+        if self.config.collapse:
+            self.set_collapse(True)
+
+    def closefile(self):
+        self._stop_search()
+        if self.searchindex is not None:
+            self.searchindex.close()
+            self.searchindex = None
+        if self.runindex is not None:
+            self.runindex.stop()
+            self.runindex = None
+            self.runmap = None
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+        if self.filedata is not None:
+            self._save_preview()
+            self.previewstream.overrides.clear()
+            self.annotations.clear()
+            self.filedata.close()
+            self.filedata = None
+        self.pluginpool.close()
+        self.journal.close()
+
 
     def load_file_piece(self, start, end):
-        # start, end are in bytes
+        # start, end are in bytes of view lines
         self.padmanager.clear()
         self.buffers.clear()
 
-        self.filedata.dumpToStream(self.forkstream,
-            start, end,
-            width=editconfig.bytesPerLine)
+        bpl = editconfig.bytesPerLine
+        self._dump(self.forkstream, start // bpl, end // bpl)
 
         self.buffers.computelens()
         self.buffers.draw(self.padmanager)
 
+    # Loads a piece of file onto one end of what is already
+    #   loaded, and draws only the new lines. Returns how many
+    #   rows the existing lines moved down by.
+    def extend_file_piece(self, start, end, front):
+        # start, end are in bytes of view lines
+        self.buffers.stage()
+
+        bpl = editconfig.bytesPerLine
+        self._dump(self.forkstream, start // bpl, end // bpl)
+
+        if front:
+            return self.buffers.prepend(self.padmanager)
+        self.buffers.append(self.padmanager)
+        return 0
+
     def activate_plugin(self, index):
         # Validate
         if index < -1 or index > len(self.plugins):
@@ -115,13 +831,16 @@ class EditPad(object):
         # The 0'th plugin is just empty
         # The -1'th plugin is ascii preview
         if index == 0:
-            plugin = drop_stream
+            plugin = self.noplugin
         elif index == -1:
-            plugin = editconfig.BytesToNormalStr
+            plugin = self.asciiplugin
         else:
             plugin = self.plugins[index - 1]
 
-        # Push the plugin into the stream
+        # Push the plugin into the stream. The prefetcher has to
+        #   finish first, or a batch it is in the middle of would
+        #   cache the new plugin's output under the old one.
+        self.prefetcher.stop()
         self.pluginstream.set_processor(plugin)
 
         # Store current line
@@ -129,11 +848,30 @@ class EditPad(object):
 
         # Stream the file through the plugin
         self.buffers.clear_plugin()
-        self._redump_data(self.pluginstream)
+        self._redump_data(self.pluginstream, -1)
+
+        # Every line's height can change with the plugin
+        self.windowmanager.layout.clear()
+        self.windowmanager.measure()
 
         # Adjust the view window
         self.windowmanager.move_cursor(current_line)
+        self.prefetcher.start()
+
 
+    # The last line of the view
+    def _lastline(self):
+        last = self._lastdataline()
+        if self.runmap is None:
+            return last
+        return self.runmap.to_view(last)
+
+    # Sizes the offset column for the file's length, if the
+    #   config has one. Returns True if its width changed.
+    def _size_offsets(self):
+        if self.config.offsets is None:
+            return False
+        return self.config.offsets.setFileLength(len(self.filedata))
 
     def _lastdataline(self):
         last_byte = len(self.filedata)
@@ -158,28 +896,99 @@ class EditPad(object):
             self.config.streams, bufferstreams[:-1]):
             stfork.addOutputStream(stin)
             stout.addOutputStream(buff)
+            stin.set_cache(self.rendercache)
+            stout.set_cache(self.rendercache)
+            stin.set_memo(self.contentcache)
+            stout.set_memo(self.contentcache)
 
         # Setup Plugin Stream
         stfork.addOutputStream(stplugin)
-        stplugin.set_processor(drop_stream)
+        stplugin.set_processor(self.noplugin)
+        stplugin.set_cache(self.rendercache)
+        stplugin.set_memo(self.contentcache)
+        stplugin.set_pool(self.pluginpool)
         plugin_buff = bufferstreams[-1]
         stplugin.set_stream(plugin_buff)
 
-        # Grab the preview stream
+        # Grab the preview stream, whose pinned plugins run
+        #   like the plugin stream does
         self.previewstream = self.config.streams[2][0]
+        self.previewstream.set_pool(self.pluginpool)
 
-    def _redump_data(self, stream):
-        # Redump the file through the stream
-        fwin = self.windowmanager.fwin
+    # Dumps the view lines [start, end) through the stream.
+    #   Markers don't go through it, and are pushed straight
+    #   into the buffers of 'columns', or every buffer.
+    def _dump(self, stream, start, end, columns=None):
         bpl = editconfig.bytesPerLine
-        self.filedata.dumpToStream(stream,
-            fwin.start * bpl, fwin.end * bpl,
-            width=editconfig.bytesPerLine)
+        if self.runmap is None:
+            self.filedata.dumpToStream(stream,
+                start * bpl, end * bpl, width=bpl)
+            return
+
+        buffers = self.buffers.getBuffers()
+        if columns is None:
+            columns = range(len(buffers))
+        for first, last, collapsed in self.runmap.segments(start, end):
+            if not collapsed:
+                self.filedata.dumpToStream(stream,
+                    first * bpl, last * bpl, width=bpl)
+                continue
+            for column in columns:
+                buffers[column].push_token(_marker(column, first, last),
+                    first * bpl)
+
+    # Redumps the file window through a stream that feeds the
+    #   buffer of 'column'
+    def _redump_data(self, stream, column):
+        fwin = self.windowmanager.fwin
+        column %= len(self.buffers.getBuffers())
+        self._dump(stream, fwin.start, fwin.end, [ column ])
 
         # Redraw
         self.padmanager.clear()
         self.buffers.draw(self.padmanager)
 
+def _parse_bytes(val):
+    parts = val.split(None, 1)
+    if len(parts) != 2:
+        return None
+    try:
+        offset = int(parts[0], 16)
+        data = "".join(parts[1].split()).decode("hex")
+    except (ValueError, TypeError):
+        return None
+    if offset < 0 or len(data) == 0:
+        return None
+    return offset, data
+
+def _parse_length(val):
+    parts = val.split()
+    if len(parts) != 2:
+        return None
+    try:
+        offset, length = int(parts[0], 16), int(parts[1], 16)
+    except ValueError:
+        return None
+    if offset < 0 or length <= 0:
+        return None
+    return offset, length
+
+# Whether two RunMaps collapse the same lines, where None
+#   collapses nothing
+def _same_runs(a, b):
+    a = a.hidden if a is not None else []
+    b = b.hidden if b is not None else []
+    return a == b
+
+# The text a marker shows in a column, in the spirit of the
+#   '*' in hexdump's output
+def _marker(column, first, last):
+    if column == 0:
+        return "*"
+    if column == 1:
+        return "(%d more of the same)" % (last - first)
+    return ""
+
 def _streamzip(streampairs, bufferstreams):
     assert(len(streampairs) == len(bufferstreams))
     for i in xrange(len(streampairs)):
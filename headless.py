@@ -0,0 +1,137 @@
+import curses
+import curses.ascii
+
+
+# HeadlessWindow stands in for a curses window or pad, so an
+#   EditPad can be driven without a terminal. It keeps the
+#   text of each row and counts what was asked of it, which
+#   is how much work would have gone to the terminal.
+# Keys given to feed() are returned by getch, which returns
+#   -1 once they run out, as it would in nodelay mode.
+# Text past the right edge is cut off rather than wrapped.
+class HeadlessWindow(object):
+    def __init__(self, height, width, begin_y=0, begin_x=0):
+        self.height = height
+        self.width = width
+        self.begin_y = begin_y
+        self.begin_x = begin_x
+
+        self.rows = {}
+        self.keys = []
+        self.cursor = (0, 0)
+
+        self.cells = 0
+        self.calls = 0
+        self.refreshes = 0
+
+    def feed(self, keys):
+        self.keys.extend(keys)
+
+    def getbegyx(self): return (self.begin_y, self.begin_x)
+    def getmaxyx(self): return (self.height, self.width)
+
+    def keypad(self, flag): pass
+    def scrollok(self, flag): pass
+    def nodelay(self, flag): pass
+    def timeout(self, delay): pass
+
+    def refresh(self, *args):
+        self.refreshes += 1
+
+    def noutrefresh(self, *args):
+        self.refreshes += 1
+
+    def resize(self, height, width):
+        self.height = height
+        self.width = width
+        for ypos in [ ypos for ypos in self.rows if ypos >= height ]:
+            del self.rows[ypos]
+
+    def clear(self):
+        self.rows = {}
+        self.calls += 1
+
+    erase = clear
+
+    def addstr(self, ypos, xpos, text, *attr):
+        self._check(ypos, xpos)
+        text = text[:self.width - xpos]
+        row = self.rows.get(ypos, "").ljust(xpos)
+        self.rows[ypos] = row[:xpos] + text + row[xpos + len(text):]
+        self.cursor = (ypos, xpos + len(text))
+        self.cells += len(text)
+        self.calls += 1
+
+    def addch(self, ypos, xpos, char, *attr):
+        if not isinstance(char, str):
+            char = chr(char & 0xff)
+        self.addstr(ypos, xpos, char)
+
+    def chgat(self, ypos, xpos, *args):
+        self._check(ypos, xpos)
+        self.calls += 1
+
+    def move(self, ypos, xpos):
+        self._check(ypos, xpos)
+        self.cursor = (ypos, xpos)
+
+    def clrtoeol(self):
+        ypos, xpos = self.cursor
+        row = self.rows.get(ypos)
+        if row is not None:
+            self.rows[ypos] = row[:xpos]
+        self.calls += 1
+
+    def scroll(self, lines=1):
+        self.rows = dict((ypos - lines, row)
+            for ypos, row in self.rows.iteritems()
+            if 0 <= ypos - lines < self.height)
+        self.calls += 1
+
+    def getch(self):
+        if self.keys:
+            return self.keys.pop(0)
+        return -1
+
+    # The text of every row, to compare against
+    def text(self):
+        return [ self.rows.get(ypos, "").rstrip()
+            for ypos in xrange(self.height) ]
+
+    def _check(self, ypos, xpos):
+        if not (0 <= ypos < self.height and 0 <= xpos < self.width):
+            raise curses.error("(%d, %d) is outside the window" % (ypos, xpos))
+
+
+_saved = None
+
+# Makes curses hand out HeadlessWindows instead of windows
+#   on the terminal, until uninstall is called
+def install():
+    global _saved
+    if _saved is not None:
+        return
+    _saved = dict((name, getattr(curses, name, None))
+        for name in ("newpad", "newwin", "ungetch", "unctrl",
+            "ACS_VLINE", "ACS_CKBOARD"))
+
+    curses.newpad = lambda height, width: HeadlessWindow(height, width)
+    curses.newwin = HeadlessWindow
+    curses.ungetch = lambda key: None
+    # Close to curses.unctrl, which needs a terminal too. Bytes
+    #   over 127 are shown differently.
+    curses.unctrl = curses.ascii.unctrl
+    # These only exist once curses has started up a terminal
+    curses.ACS_VLINE = ord("|")
+    curses.ACS_CKBOARD = ord("#")
+
+def uninstall():
+    global _saved
+    if _saved is None:
+        return
+    for name, value in _saved.iteritems():
+        if value is None:
+            delattr(curses, name)
+        else:
+            setattr(curses, name, value)
+    _saved = None
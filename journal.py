@@ -0,0 +1,151 @@
+import time
+import tempfile
+
+# Edits are only joined together up to this many bytes
+_MAX_COALESCE = 4096
+
+
+# Journal is the undo/redo history of a file's edits. Each
+#   edit is recorded as the bytes 'old' at 'offset' being
+#   replaced by 'new', so nothing is ever snapshotted.
+# Edits made within 'coalesce' seconds of each other that
+#   carry straight on from the last one (typing forwards, or
+#   deleting backwards) are joined into a single record.
+# Once the records hold more than 'memcap' bytes, the oldest
+#   have their bytes moved out to a temporary file, and are
+#   read back from it if they are undone.
+class Journal(object):
+    def __init__(self, memcap, coalesce=1.0):
+        self.memcap = memcap
+        self.coalesce = coalesce
+
+        self.records = []
+        # The records before this have been applied
+        self.position = 0
+        self.memory = 0
+
+        self._spill = None
+        # The records before this are in the spill file
+        self._spilled = 0
+        self._last = None
+
+    def record(self, offset, old, new):
+        self._truncate()
+
+        now = time.time()
+        if not (self._last is not None and now - self._last <= self.coalesce
+                and self._join(offset, old, new)):
+            self.records.append(_Record(offset, old, new))
+            self.memory += len(old) + len(new)
+        self.position = len(self.records)
+        self._last = now
+
+        if self.memory > self.memcap:
+            self._spill_old()
+
+    # Returns (offset, before, after) for the edit that puts
+    #   the file back how it was before the last record, or
+    #   None if there is nothing to undo
+    def undo(self):
+        if self.position == 0:
+            return None
+        self._last = None
+        self.position -= 1
+        record = self.records[self.position]
+        old, new = self._load(record)
+        return record.offset, new, old
+
+    # The same as undo, for the last record undone
+    def redo(self):
+        if self.position == len(self.records):
+            return None
+        self._last = None
+        record = self.records[self.position]
+        self.position += 1
+        old, new = self._load(record)
+        return record.offset, old, new
+
+    def close(self):
+        self.records = []
+        self.position = 0
+        self.memory = 0
+        self._spilled = 0
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    # Adds onto the last record if the edit carries on from it
+    def _join(self, offset, old, new):
+        if self.position <= self._spilled:
+            return False
+        last = self.records[-1]
+        if len(last.old) + len(last.new) + len(old) + len(new) > _MAX_COALESCE:
+            return False
+
+        if offset == last.offset + len(last.new):
+            last.old += old
+            last.new += new
+        elif (len(new) == 0 and len(last.new) == 0
+                and offset + len(old) == last.offset):
+            last.offset = offset
+            last.old = old + last.old
+        else:
+            return False
+        self.memory += len(old) + len(new)
+        return True
+
+    # Drops the records that were undone, since they can't be
+    #   redone once something else has been changed
+    def _truncate(self):
+        dropped = self.records[self.position:]
+        if len(dropped) == 0:
+            return
+        del self.records[self.position:]
+
+        if self._spilled > self.position:
+            self._spill.truncate(dropped[0].spill)
+            self._spilled = self.position
+        for record in dropped:
+            if record.spill is None:
+                self.memory -= len(record.old) + len(record.new)
+
+    # Moves the oldest records out to the spill file until
+    #   they're down to half the memory cap. The latest record
+    #   is always kept, so it can still be joined onto.
+    def _spill_old(self):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile(prefix="hexundo")
+        self._spill.seek(0, 2)
+
+        target = self.memcap // 2
+        last = len(self.records) - 1
+        while self.memory > target and self._spilled < last:
+            record = self.records[self._spilled]
+            record.spill = self._spill.tell()
+            record.oldlen = len(record.old)
+            record.newlen = len(record.new)
+            self._spill.write(record.old)
+            self._spill.write(record.new)
+            self.memory -= record.oldlen + record.newlen
+            record.old = record.new = None
+            self._spilled += 1
+
+    def _load(self, record):
+        if record.spill is None:
+            return record.old, record.new
+        self._spill.seek(record.spill)
+        old = self._spill.read(record.oldlen)
+        new = self._spill.read(record.newlen)
+        return old, new
+
+
+class _Record(object):
+    __slots__ = ("offset", "old", "new", "spill", "oldlen", "newlen")
+
+    def __init__(self, offset, old, new):
+        self.offset = offset
+        self.old = old
+        self.new = new
+        self.spill = None
+        self.oldlen = 0
+        self.newlen = 0
@@ -0,0 +1,237 @@
+from array import array
+
+
+# LayoutIndex knows how many screen rows every line of the
+#   file takes up, so that the row a line starts on, and the
+#   line at a row, can be found for the whole file rather
+#   than just the loaded window.
+# Heights are learned as lines are laid out. Lines that
+#   haven't been laid out yet are counted at the average
+#   height of the ones that have, which is exact whenever
+#   the plugin output is a fixed height.
+# The file is split into blocks of lines. Each block keeps a
+#   Fenwick tree over its lines, and a Fenwick tree over the
+#   blocks keeps their totals, so every lookup is O(log n).
+#   The trees hold the rows of the known lines and the count
+#   of unknown lines separately, and a block only gets trees
+#   for its lines once one of them is known.
+class LayoutIndex(object):
+    def __init__(self, nlines, blocksize=1024):
+        self.blocksize = blocksize
+        self.resize(nlines)
+
+    # Forgets every height, such as when the plugin changes
+    def clear(self):
+        nblocks = (self.nlines + self.blocksize - 1) // self.blocksize
+        last = self._blocklen(nblocks - 1) if nblocks else 0
+
+        self._rows = array("l", [ 0 ]) * (nblocks + 1)
+        self._unknown = _build_uniform(self.blocksize, nblocks, last)
+        self._blocks = {}
+
+        self.known = 0
+        self.known_rows = 0
+
+    def resize(self, nlines):
+        self.nlines = max(nlines, 0)
+        self.clear()
+
+    # Adds unknown lines to the end, such as when the file
+    #   grows, keeping the heights that are known. Only the new
+    #   blocks are added to the trees.
+    def grow(self, nlines):
+        if nlines < self.nlines:
+            self.resize(nlines)
+            return
+        oldblocks = len(self._rows) - 1
+        old = self.nlines
+        self.nlines = nlines
+
+        # The last block may have been short
+        if oldblocks > 0:
+            last = oldblocks - 1
+            added = self._blocklen(last) - (old - last * self.blocksize)
+            if added > 0:
+                _add(self._unknown, last, added)
+                inner = self._blocks.get(last)
+                if inner is not None:
+                    self._blocks[last] = inner.grown(self._blocklen(last))
+
+        nblocks = (nlines + self.blocksize - 1) // self.blocksize
+        if nblocks > oldblocks:
+            _extend(self._rows, [ 0 ] * (nblocks - oldblocks))
+            _extend(self._unknown, [ self._blocklen(block)
+                for block in xrange(oldblocks, nblocks) ])
+
+    # The height used for lines that haven't been laid out
+    def estimate(self):
+        if self.known == 0:
+            return 1.0
+        return float(self.known_rows) / self.known
+
+    def set_height(self, line, height):
+        if line < 0 or line >= self.nlines:
+            return
+        block, index = divmod(line, self.blocksize)
+        inner = self._inner(block)
+
+        old = inner.heights[index]
+        if old == height:
+            return
+        inner.heights[index] = height
+
+        _add(inner.rows, index, height - old)
+        _add(self._rows, block, height - old)
+        self.known_rows += height - old
+        if old == 0:
+            _add(inner.unknown, index, -1)
+            _add(self._unknown, block, -1)
+            self.known += 1
+
+    # Sets the heights of consecutive lines starting at 'line'
+    def set_heights(self, line, heights):
+        for offset, height in enumerate(heights):
+            self.set_height(line + offset, height)
+
+    # The row that the line starts on
+    def line_to_row(self, line):
+        line = min(max(line, 0), self.nlines)
+        est = self.estimate()
+        block, index = divmod(line, self.blocksize)
+
+        row = _prefix(self._rows, block) + _prefix(self._unknown, block) * est
+        inner = self._blocks.get(block)
+        if inner is None:
+            return row + index * est
+        return row + _prefix(inner.rows, index) + _prefix(inner.unknown, index) * est
+
+    # The line that the row is on
+    def row_to_line(self, row):
+        if self.nlines == 0:
+            return 0
+        est = self.estimate()
+        block, row = _search(self._rows, self._unknown, est, row)
+        if block * self.blocksize >= self.nlines:
+            return self.nlines - 1
+
+        inner = self._blocks.get(block)
+        if inner is None:
+            index = int(row // est)
+        else:
+            index, row = _search(inner.rows, inner.unknown, est, row)
+        index = min(index, self._blocklen(block) - 1)
+        return block * self.blocksize + index
+
+    def total_rows(self):
+        return self.line_to_row(self.nlines)
+
+    def _inner(self, block):
+        inner = self._blocks.get(block)
+        if inner is None:
+            inner = _Block(self._blocklen(block))
+            self._blocks[block] = inner
+        return inner
+
+    def _blocklen(self, block):
+        return min(self.blocksize, self.nlines - block * self.blocksize)
+
+
+class _Block(object):
+    __slots__ = ("heights", "rows", "unknown")
+
+    def __init__(self, size):
+        # A height of 0 means not known
+        self.heights = array("l", [ 0 ]) * size
+        self.rows = array("l", [ 0 ]) * (size + 1)
+        self.unknown = _build([ 1 ] * size)
+
+    # A copy with room for more lines, which are unknown
+    def grown(self, size):
+        block = _Block(size)
+        heights = list(self.heights) + [ 0 ] * (size - len(self.heights))
+        block.heights = array("l", heights)
+        block.rows = _build(heights)
+        block.unknown = _build([ 0 if height else 1 for height in heights ])
+        return block
+
+
+####### Fenwick Trees ########
+# Trees are arrays with an unused slot 0, so slot i holds the
+#   sum of the 'i & -i' values ending at value i - 1
+
+def _build(values):
+    tree = array("l", [ 0 ]) + array("l", values)
+    size = len(tree)
+    for i in xrange(1, size):
+        parent = i + (i & -i)
+        if parent < size:
+            tree[parent] += tree[i]
+    return tree
+
+# The same as _build for 'count' values that are all 'value'
+#   except for the last, without a loop over every one, since
+#   huge files have millions of blocks. Slot i holds 'value'
+#   times 'i & -i', so the slots after a power of two repeat
+#   the ones before it.
+def _build_uniform(value, count, last):
+    tree = array("l", [ 0, value ])
+    while len(tree) - 1 < count:
+        size = len(tree) - 1
+        tree.extend(tree[1:size + 1])
+        tree[2 * size] = 2 * size * value
+    del tree[count + 1:]
+    if count > 0:
+        tree[count] -= value - last
+    return tree
+
+def _add(tree, index, delta):
+    i = index + 1
+    size = len(tree)
+    while i < size:
+        tree[i] += delta
+        i += i & -i
+
+# Adds values onto the end of a tree. Most new slots only
+#   cover new values. The few that also cover old ones are
+#   worked out from the old prefix sums.
+def _extend(tree, values):
+    old = len(tree) - 1
+    total = _prefix(tree, old)
+    sums = [ 0 ]
+    for value in values:
+        sums.append(sums[-1] + value)
+    tree.extend(array("l", values))
+
+    for i in xrange(old + 1, len(tree)):
+        low = i - (i & -i)
+        if low >= old:
+            tree[i] = sums[i - old] - sums[low - old]
+        else:
+            tree[i] = total - _prefix(tree, low) + sums[i - old]
+
+# The sum of the first 'count' values
+def _prefix(tree, count):
+    total = 0
+    while count > 0:
+        total += tree[count]
+        count &= count - 1
+    return total
+
+# Finds the most values whose rows (known rows plus unknown
+#   lines times est) add up to no more than 'row'. Returns
+#   that count, and how far past their end 'row' is.
+def _search(rows, unknown, est, row):
+    pos = 0
+    step = 1
+    while step * 2 < len(rows):
+        step *= 2
+
+    while step > 0:
+        nxt = pos + step
+        if nxt < len(rows):
+            size = rows[nxt] + unknown[nxt] * est
+            if size <= row:
+                pos = nxt
+                row -= size
+        step //= 2
+    return pos, row
@@ -1,7 +1,9 @@
 from editconfig import bytesPerLine
+from layout import LayoutIndex
+from debugger import profiled
 
 class LineWindowManager(object):
-    def __init__(self, flen, floader, buffers, padmanager):
+    def __init__(self, flen, floader, fextender, buffers, padmanager):
 
         self.flen = flen
         self.full_win = _Window(0, flen+1)
@@ -10,28 +12,55 @@ class LineWindowManager(object):
         #   be before file_end
 
         self.floader = floader
+        self.fextender = fextender
         self.buffers = buffers
         self.padmanager = padmanager
         self.viewH = padmanager.viewH
 
+        # The most lines that are kept loaded, and how many
+        #   are loaded at once when scrolling past either end
+        self.capacity = self.viewH * 4
+        self.step = self.viewH
+
         self.fwin = _Window(0,0)
         self.vwin = _Window(0,self.viewH)
 
         self.cursor = 0
 
+        # Row heights of every line laid out so far
+        self.layout = LayoutIndex(flen + 1)
+
     def decr_cursor(self):
+        self._cursor_up()
+        self.do_hl()
+
+    def incr_cursor(self):
+        self._cursor_down()
+        self.do_hl()
+
+    # Moves the cursor down 'count' lines (up if negative),
+    #   scrolling the view as it goes, and only highlights
+    #   where it ends up
+    def move_cursor_by(self, count):
+        if self.flen < 0:
+            return
+        step = self._cursor_down if count > 0 else self._cursor_up
+        for i in xrange(abs(count)):
+            step()
+        self.do_hl()
+
+    def _cursor_up(self):
         if self.cursor <= 0:
             self.decr_vwindow()
         else:
             self.cursor -= 1
-        self.do_hl()
 
-    def incr_cursor(self):
+    def _cursor_down(self):
         if self.cursor >= self.viewH - 1:
             self.incr_vwindow()
-        else:
+        elif self.vwin.start + self.cursor + 1 < self.buffers.screenend():
+            # A file shorter than the view ends partway down it
             self.cursor += 1
-        self.do_hl()
 
     def move_cursor(self, line):
 
@@ -45,16 +74,50 @@ class LineWindowManager(object):
             self.move_vwindow(line)
             return
 
+        # A redraw can leave the view hanging past the end
+        if self.vwin.end > self.buffers.screenend():
+            self.move_vwindow(line)
+            return
+
         self.cursor = screenpos - self.vwin.start
         self.do_hl()
 
     def do_hl(self):
+        # An empty file has no line for the cursor to be on
+        if self.flen < 0:
+            return
         pos = self.cursor + self.vwin.start
         rng = self.buffers.screenToScreenRange(pos)
         lines = range(*rng)
 
         self.padmanager.highlight_lines(lines, pos)
-
+        self.padmanager.set_scrollbar(self.fraction())
+
+    # How far through the file the cursor is, by rows
+    def fraction(self):
+        total = self.layout.total_rows()
+        if total <= 0:
+            return 0.0
+        return self.layout.line_to_row(self.current_line()) / total
+
+    # Moves the cursor to the line that is 'fraction' of the
+    #   way through the file's rows
+    def move_fraction(self, fraction):
+        fraction = min(max(fraction, 0.0), 1.0)
+        row = fraction * self.layout.total_rows()
+        self.move_cursor(self.layout.row_to_line(row))
+
+    # Stores the heights of the loaded lines in [start, end)
+    #   in the layout. With no arguments, every loaded line.
+    def measure(self, start=None, end=None):
+        if start is None:
+            start, end = self.fwin.start, self.fwin.end
+        count = min(end, self.fwin.end) - start
+        if count > 0:
+            heights = self.buffers.heights(start - self.fwin.start, count)
+            self.layout.set_heights(start, heights)
+
+    @profiled("LineWindowManager.move_fwindow")
     def move_fwindow(self, start):
         margin = self.viewH * 2
         file_start = start - margin
@@ -66,54 +129,123 @@ class LineWindowManager(object):
         byte_win = self.fwin * bytesPerLine
 
         self.floader(byte_win.start, byte_win.end)
+        self.measure()
 
-    def incr_vwindow(self):
-        new_win = self.vwin + 1
+    # For when edits change the length of the file
+    def set_flen(self, flen):
+        self.flen = flen
+        self.full_win = _Window(0, flen+1)
+        self.layout.resize(flen + 1)
 
-        if new_win.end <= self.buffers.screenend():
-            self.padmanager.set_line(new_win.start)
-            self.vwin = new_win
-            return
+    # For when bytes are added to the end of the file, which
+    #   doesn't move any of the lines that are loaded
+    def grow_flen(self, flen):
+        self.flen = flen
+        self.full_win = _Window(0, flen+1)
+        self.layout.grow(flen + 1)
+
+    # Whether the cursor is on the last line of the file
+    def at_end(self):
+        return self.current_line() >= self.flen
+
+    # Puts the cursor on the last line with the view scrolled
+    #   to the bottom, when the end of the file is loaded
+    def show_end(self):
+        screen_pos = self.buffers.lineToScreen(self.flen - self.fwin.start)
+        start = max(self.buffers.screenend() - self.viewH, 0)
+        self.vwin = _Window(start, start + self.viewH)
+        self.padmanager.set_line(start)
+        self.cursor = screen_pos - start
+        self.do_hl()
 
-        if self.fwin.end >= self.flen + 1:
-            # File window can't increase past end of file
-            return
+    # Trims the file window to the file after its length
+    #   changed. Returns False if the file got shorter than
+    #   where the window was, so it had to be loaded again.
+    def fit_fwindow(self):
+        if self.fwin.start >= self.full_win.end:
+            self.move_fwindow(max(self.flen, 0))
+            return False
+        self.fwin = self.full_win.compress(self.fwin)
+        return True
+
+    # The file window is a ring of lines: scrolling past
+    #   either end loads 'step' new lines onto that end and
+    #   drops lines from the other end to stay at capacity.
+    #   Only the new lines are formatted and drawn.
+    @profiled("LineWindowManager.slide_fwindow")
+    def slide_fwindow(self, count):
+        bpl = bytesPerLine
+        if count > 0:
+            new = _Window(self.fwin.end, self.fwin.end + count)
+            new = self.full_win.compress(new)
+            self.fextender(new.start * bpl, new.end * bpl, False)
+            self.fwin = _Window(self.fwin.start, new.end)
+
+            excess = len(self.fwin) - self.capacity
+            if excess > 0:
+                rows = self.buffers.drop_front(excess, self.padmanager)
+                self.fwin = _Window(self.fwin.start + excess, self.fwin.end)
+                self.vwin = self.vwin - rows
+            self.measure(new.start, new.end)
+        else:
+            new = _Window(self.fwin.start + count, self.fwin.start)
+            new = self.full_win.compress(new)
+            rows = self.fextender(new.start * bpl, new.end * bpl, True)
+            self.fwin = _Window(new.start, self.fwin.end)
+            self.vwin = self.vwin + rows
 
-        last_line = self.fwin.end
+            excess = len(self.fwin) - self.capacity
+            if excess > 0:
+                self.buffers.drop_back(excess, self.padmanager)
+                self.fwin = _Window(self.fwin.start, self.fwin.end - excess)
+            self.measure(new.start, new.end)
 
-        current_line = self.buffers.screenToLine(self.vwin.start) + self.fwin.start
+        self.padmanager.set_line(self.vwin.start)
 
-        self.move_fwindow(current_line)
+    def incr_vwindow(self):
+        new_win = self.vwin + 1
+
+        if new_win.end > self.buffers.screenend():
+            if self.fwin.end >= self.full_win.end:
+                # File window can't increase past end of file
+                return
 
-        last_screen = self.buffers.lineToScreen(last_line - self.fwin.start)
-        start_screen = last_screen - self.viewH + 1
+            self.slide_fwindow(self.step)
+            new_win = self.vwin + 1
+            if new_win.end > self.buffers.screenend():
+                return
 
-        self.padmanager.set_line(start_screen)
-        self.vwin = _Window(start_screen, start_screen + self.viewH)
+        self.padmanager.set_line(new_win.start)
+        self.vwin = new_win
 
     def decr_vwindow(self):
         new_win = self.vwin - 1
 
-        if new_win.start >= 0:
-            self.padmanager.set_line(new_win.start)
-            self.vwin = new_win
-            return
-
-        if self.fwin.start <= 0:
-            # File window can't decrease before start of file
-            return
+        if new_win.start < 0:
+            if self.fwin.start <= 0:
+                # File window can't decrease before start of file
+                return
 
-        current_line = self.fwin.start
+            self.slide_fwindow(-self.step)
+            new_win = self.vwin - 1
+            if new_win.start < 0:
+                return
 
-        self.move_fwindow(current_line)
-
-        start_screen = self.buffers.lineToScreen(current_line - self.fwin.start)
-        self.padmanager.set_line(start_screen - 1)
-        self.vwin = _Window(start_screen - 1, start_screen + self.viewH - 1)
+        self.padmanager.set_line(new_win.start)
+        self.vwin = new_win
 
     # This will jump the view window directly to the given
     #   file line.
     def move_vwindow(self, line):
+        # An empty file has no lines to move to, so the view is
+        #   just emptied
+        if self.flen < 0:
+            self.move_fwindow(0)
+            self.vwin = _Window(0, self.viewH)
+            self.padmanager.set_line(0)
+            self.cursor = 0
+            return
+
         # If out of bounds just move to the beginning/end
         if line < 0:
             return self.move_vwindow(0)
@@ -185,12 +317,15 @@ class _Window(object):
     #   x.align_shift(y) = [2 -> 4]
     #   y.align_shift(x) = [3 -> 7]
     def align_shift(self, win):
+        if win.end > self.end:
+            win = win + (self.end - win.end)
         if win.start < self.start:
             win = win + (self.start - win.start)
-        elif win.end > self.end:
-            win = win + (self.end - win.end)
         return win
 
+    def __len__(self):
+        return self.end - self.start
+
     def __add__(self, val):
         return _Window(self.start + val, self.end + val)
 
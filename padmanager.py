@@ -1,11 +1,27 @@
 import curses
 import curses.ascii
+from debugger import profiled
 
+# Colors that rows can be marked with, by name
+_COLORS = [ "black", "red", "green", "yellow", "blue", "magenta",
+    "cyan", "white" ]
+# color name -> attribute
+_markattrs = {}
+
+# PadManager keeps a shadow of what is on the pad, and only
+#   writes the parts of rows that changed. Drawing goes into
+#   a frame, which is compared with the shadow when the pad
+#   is next refreshed, scrolled or highlighted. Clearing the
+#   pad just starts an empty frame, so a redraw of mostly
+#   the same text writes almost nothing, and the terminal
+#   is never told to repaint the whole screen.
 class PadManager(object):
     def __init__(self, refwin, padding, heightcapacity):
         ry, rx = refwin.getbegyx()
         rh, rw = refwin.getmaxyx()
 
+        self.refwin = refwin
+        self.padding = padding
         self.viewX = rx + padding
         self.viewY = ry + padding
         self.viewH = rh - 2*padding
@@ -16,13 +32,30 @@ class PadManager(object):
         self.numlines = 0
         self.cap = heightcapacity
 
-        self.pad = curses.newpad(self.cap, self.viewW)
+        self.pad = self._newpad()
         self.pad.keypad(True)
         self.pad.scrollok(False)
 
         self.hl_lines = [ 0 ]
+        self.cursor_line = 0
+        self.scrollrow = None
+        # row -> attribute, for rows marked with a color
+        self.marks = {}
+
+        # row -> text, for what is on the pad, and for what has
+        #   been drawn since the last flush
+        self.shadow = {}
+        self.frame = {}
+        # If set, rows left out of the frame are blank
+        self.cleared = False
+        self.cellswritten = 0
 
+    def _newpad(self):
+        return curses.newpad(self.cap, self.viewW)
+
+    @profiled("PadManager.refresh")
     def refresh(self):
+        self.flush()
         self.pad.refresh(self.ypos, self.xpos,
             self.viewY, self.viewX,
             self.viewY + self.viewH - 1,
@@ -30,35 +63,156 @@ class PadManager(object):
 
     def clear(self):
         self.numlines = 0
-        self.pad.clear()
+        self.frame = {}
+        self.cleared = True
 
     def drawstr(self, ypos, xpos, val):
         self._setlines(ypos)
-        self.pad.addstr(ypos, xpos, val)
+        row = self.frame.get(ypos)
+        if row is None:
+            row = "" if self.cleared else self.shadow.get(ypos, "")
+        if len(row) < xpos:
+            row = row.ljust(xpos)
+        self.frame[ypos] = row[:xpos] + val + row[xpos + len(val):]
+
+    # Writes the changes in the frame to the pad
+    def flush(self):
+        frame = self.frame
+        shadow = self.shadow
+        rows = frame.keys()
+        if self.cleared:
+            rows = set(rows).union(shadow)
+
+        hl_lines = set(self.hl_lines)
+        for ypos in rows:
+            new = frame.get(ypos, "")
+            old = shadow.get(ypos, "")
+            if new == old:
+                continue
+            self._writerow(ypos, old, new)
+            if new:
+                shadow[ypos] = new
+            else:
+                del shadow[ypos]
+
+            # Writing a row loses its highlighting
+            if ypos in hl_lines or ypos in self.marks:
+                self._highlight(ypos)
+
+        self.frame = {}
+        self.cleared = False
+
+    # Writes only the span of the row from the first to the
+    #   last character that changed
+    def _writerow(self, ypos, old, new):
+        first, text = _changedspan(old, new)
+        if len(text) == 0:
+            return
+        self.pad.addstr(ypos, first, text)
+        self.cellswritten += len(text)
+
+    # Moves everything on the pad up by 'rows' (down if it is
+    #   negative) without redrawing any of it. Rows that are
+    #   uncovered are left blank.
+    def shift(self, rows):
+        if rows == 0:
+            return
+        self.flush()
+        if rows < 0:
+            self._setlines(self.numlines - rows)
+        else:
+            self.numlines = max(self.numlines - rows, 0)
+
+        self.pad.scrollok(True)
+        self.pad.scroll(rows)
+        self.pad.scrollok(False)
+
+        # The text and highlighting moved along with it
+        self.shadow = dict((ypos - rows, row)
+            for ypos, row in self.shadow.iteritems()
+            if 0 <= ypos - rows < self.cap)
+        self.hl_lines = [ line - rows for line in self.hl_lines
+            if 0 <= line - rows < self.cap ]
+        self.marks = dict((ypos - rows, attr)
+            for ypos, attr in self.marks.iteritems()
+            if 0 <= ypos - rows < self.cap)
+        self.cursor_line -= rows
+
+    def clearrows(self, start, end):
+        for ypos in xrange(start, min(end, self.cap)):
+            self.frame[ypos] = ""
 
     def get_line(self): return self.ypos
 
     def set_line(self, line):
         self.ypos = line
 
+    # Only the rows that stop or start being highlighted are
+    #   changed, along with the old and new cursor
+    @profiled("PadManager.highlight_lines")
     def highlight_lines(self, pad_lines, cursor_line):
         assert(cursor_line in pad_lines)
+        self.flush()
 
-        # Set currently highlighted to normal
-        for line in self.hl_lines:
-            self.pad.chgat(line, 0, curses.A_NORMAL)
-
+        old = set(self.hl_lines)
+        new = set(pad_lines)
+        oldcursor = self.cursor_line
         self.hl_lines = pad_lines
+        self.cursor_line = cursor_line
 
-        # Highlight lines
-        for line in self.hl_lines:
-            self.pad.chgat(line, 0, curses.A_BOLD)
+        # Set rows that are no longer highlighted back to normal,
+        #   highlight the new rows, and move the cursor
+        changed = old ^ new
+        if oldcursor != cursor_line and oldcursor in new:
+            changed.add(oldcursor)
+        changed.add(cursor_line)
+        for line in changed:
+            self._highlight(line)
 
-        # Highlight cursor
-        self.pad.chgat(cursor_line, 0, 1,
-            curses.A_REVERSE)
         self.pad.move(cursor_line, 0)
 
+    # Marks rows with the color of each, which is a name from
+    #   _COLORS, or None for a bookmark. Only rows whose marks
+    #   changed are touched.
+    def set_marks(self, marks):
+        marks = dict((ypos, _markattr(color))
+            for ypos, color in marks.iteritems())
+        if marks == self.marks:
+            return
+        self.flush()
+
+        old = self.marks
+        self.marks = marks
+        for ypos in set(old).union(marks):
+            if old.get(ypos) != marks.get(ypos):
+                self._highlight(ypos)
+
+    # Sets the attributes of the row, from its mark and whether
+    #   it is highlighted or has the cursor
+    def _highlight(self, line):
+        attr = self.marks.get(line, curses.A_NORMAL)
+        if line in self.hl_lines:
+            attr |= curses.A_BOLD
+        self.pad.chgat(line, 0, attr)
+        if line == self.cursor_line:
+            self.pad.chgat(line, 0, 1, attr | curses.A_REVERSE)
+
+    # Marks how far through the file the view is on the right
+    #   hand border of the reference window
+    def set_scrollbar(self, fraction):
+        if self.padding <= 0:
+            return
+        row = self.padding + int(fraction * (self.viewH - 1))
+        if row == self.scrollrow:
+            return
+
+        xpos = self.refwin.getmaxyx()[1] - 1
+        if self.scrollrow is not None:
+            self.refwin.addch(self.scrollrow, xpos, curses.ACS_VLINE)
+        self.refwin.addch(row, xpos, curses.ACS_CKBOARD)
+        self.refwin.noutrefresh()
+        self.scrollrow = row
+
     def _setlines(self, linenum):
         if linenum <= self.numlines:
             return
@@ -67,3 +221,153 @@ class PadManager(object):
             self.cap = linenum*2
             self.pad.resize(self.cap, self.viewW)
 
+
+
+# VirtualPadManager never makes a pad. Text is only kept in
+#   the shadow, and each refresh copies the visible rows (with
+#   their highlighting) into a window the size of the view,
+#   rewriting only the rows that look different from last
+#   time. Scrolling just changes which rows are copied, so
+#   curses memory stays the same however many rows the file
+#   window and plugins take up.
+class VirtualPadManager(PadManager):
+    def __init__(self, refwin, padding, heightcapacity):
+        super(VirtualPadManager, self).__init__(refwin, padding,
+            heightcapacity)
+        # (text, bold, cursor, mark) for each row of the window
+        self.screen = [ None ] * self.viewH
+
+    def _newpad(self):
+        return curses.newwin(self.viewH, self.viewW, self.viewY, self.viewX)
+
+    @profiled("PadManager.refresh")
+    def refresh(self):
+        self.flush()
+        self._blit()
+        self.pad.refresh()
+
+    def flush(self):
+        shadow = self.shadow
+        if self.cleared:
+            shadow.clear()
+        for ypos, row in self.frame.iteritems():
+            if row:
+                shadow[ypos] = row
+            else:
+                shadow.pop(ypos, None)
+
+        self.frame = {}
+        self.cleared = False
+
+    def shift(self, rows):
+        if rows == 0:
+            return
+        self.flush()
+        self.numlines = max(self.numlines - rows, 0)
+
+        self.shadow = dict((ypos - rows, row)
+            for ypos, row in self.shadow.iteritems() if ypos >= rows)
+        self.hl_lines = [ line - rows for line in self.hl_lines
+            if line >= rows ]
+        self.marks = dict((ypos - rows, attr)
+            for ypos, attr in self.marks.iteritems() if ypos >= rows)
+        self.cursor_line -= rows
+
+    @profiled("PadManager.highlight_lines")
+    def highlight_lines(self, pad_lines, cursor_line):
+        assert(cursor_line in pad_lines)
+        self.hl_lines = pad_lines
+        self.cursor_line = cursor_line
+
+    def set_marks(self, marks):
+        self.marks = dict((ypos, _markattr(color))
+            for ypos, color in marks.iteritems())
+
+    def _setlines(self, linenum):
+        self.numlines = max(self.numlines, linenum)
+
+    def _blit(self):
+        hl_lines = set(self.hl_lines)
+        marks = self.marks
+        for row in xrange(self.viewH):
+            ypos = self.ypos + row
+            text = self.shadow.get(ypos, "")[self.xpos:self.xpos + self.viewW]
+            state = (text, ypos in hl_lines, ypos == self.cursor_line,
+                marks.get(ypos, curses.A_NORMAL))
+
+            old = self.screen[row]
+            if old == state:
+                continue
+            if old is not None and old[1:] == state[1:] and old[0] != text:
+                first, span = _changedspan(old[0], text)
+                self._addstr(row, first, span)
+            else:
+                self._addstr(row, 0, text)
+                if len(text) < self.viewW:
+                    self.pad.move(row, len(text))
+                    self.pad.clrtoeol()
+
+            attr = state[3]
+            if state[1]:
+                attr |= curses.A_BOLD
+            self.pad.chgat(row, 0, attr)
+            if state[2]:
+                self.pad.chgat(row, 0, 1, attr | curses.A_REVERSE)
+            self.screen[row] = state
+
+        cursor = self.cursor_line - self.ypos
+        if 0 <= cursor < self.viewH:
+            self.pad.move(cursor, 0)
+
+    def _addstr(self, row, xpos, text):
+        try:
+            self.pad.addstr(row, xpos, text)
+        except curses.error:
+            # Writing the bottom right cell moves the cursor off
+            #   the window, which curses reports after writing it
+            pass
+        self.cellswritten += len(text)
+
+
+# The attribute that rows marked with the color are drawn
+#   with: black text on the color, if the terminal has it.
+#   Bookmarks and colors it can't show are underlined.
+def _markattr(color):
+    attr = _markattrs.get(color)
+    if attr is not None:
+        return attr
+
+    attr = curses.A_UNDERLINE
+    name = color.lower() if color is not None else None
+    if name in _COLORS:
+        pair = _COLORS.index(name) + 1
+        background = getattr(curses, "COLOR_" + name.upper())
+        foreground = curses.COLOR_BLACK
+        if background == curses.COLOR_BLACK:
+            foreground = curses.COLOR_WHITE
+        try:
+            if curses.has_colors():
+                curses.init_pair(pair, foreground, background)
+                attr = curses.color_pair(pair)
+        except curses.error:
+            pass
+    _markattrs[color] = attr
+    return attr
+
+# The first column where two rows differ, and the text of
+#   'new' from there to the last column where they differ.
+#   Rows that only differ by trailing spaces look the same.
+def _changedspan(old, new):
+    width = max(len(old), len(new))
+    old = old.ljust(width)
+    new = new.ljust(width)
+
+    first = 0
+    while first < width and old[first] == new[first]:
+        first += 1
+    if first == width:
+        return first, ""
+    last = width - 1
+    while old[last] == new[last]:
+        last -= 1
+    return first, new[first:last + 1]
@@ -0,0 +1,174 @@
+import random
+
+
+# PieceTable is an editable view of a file that never
+#   changes the file itself. The file is described as a
+#   sequence of pieces, each a run of bytes from either the
+#   original file or the buffer of added bytes.
+# The pieces are kept in a treap ordered by file position,
+#   where each node knows the total length of its subtree,
+#   so finding, splitting and joining at a byte offset all
+#   take O(log n) for n pieces.
+class PieceTable(object):
+    def __init__(self, read_original, length):
+        # read_original(start, end) returns bytes of the file
+        self.read_original = read_original
+        self.original_length = length
+        self.added = bytearray()
+        self.dirty = False
+
+        self.root = None
+        if length > 0:
+            self.root = _Piece(False, 0, length)
+
+    def __len__(self):
+        return _size(self.root)
+
+    def insert(self, pos, data):
+        if len(data) == 0:
+            return
+        piece = _Piece(True, len(self.added), len(data))
+        self.added.extend(data)
+
+        left, right = _split(self.root, pos)
+        self.root = _merge(_merge(left, piece), right)
+        self.dirty = True
+
+    def delete(self, pos, length):
+        if length <= 0:
+            return
+        left, rest = _split(self.root, pos)
+        middle, right = _split(rest, length)
+        self.root = _merge(left, right)
+        self.dirty = True
+
+    # Replaces bytes starting at pos, making the file longer
+    #   if data runs past the end of it
+    def overwrite(self, pos, data):
+        self.replace(pos, min(len(data), len(self) - pos), data)
+
+    # Replaces the 'length' bytes at pos with data
+    def replace(self, pos, length, data):
+        self.delete(pos, length)
+        self.insert(pos, data)
+
+    # Returns the bytes in [start, end). Bytes from a single
+    #   piece of the original file aren't copied.
+    def read(self, start, end):
+        end = min(end, len(self))
+        if end <= start:
+            return memoryview(b'')
+
+        parts = []
+        _collect(self.root, start, end, 0, parts)
+        if len(parts) == 1 and not parts[0][0]:
+            added, pstart, pend = parts[0]
+            return self.read_original(pstart, pend)
+        return memoryview(b''.join(self._bytes(part) for part in parts))
+
+    # The pieces in file order, as (added, start, length)
+    def pieces(self):
+        out = []
+        _collect(self.root, 0, len(self), 0, out)
+        return [ (added, start, end - start) for added, start, end in out ]
+
+    # True if the original bytes are all still where they
+    #   were, so only the added bytes need to be written out
+    def aligned(self):
+        if len(self) != self.original_length:
+            return False
+        pos = 0
+        for added, start, length in self.pieces():
+            if not added and start != pos:
+                return False
+            pos += length
+        return True
+
+    def added_bytes(self, start, length):
+        return bytes(self.added[start:start + length])
+
+    def _bytes(self, part):
+        added, start, end = part
+        if added:
+            return self.added_bytes(start, end - start)
+        return self.read_original(start, end).tobytes()
+
+
+class _Piece(object):
+    __slots__ = ("added", "start", "length", "size", "priority",
+        "left", "right")
+
+    def __init__(self, added, start, length):
+        self.added = added
+        self.start = start
+        self.length = length
+        self.size = length
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+
+
+def _size(node):
+    return node.size if node is not None else 0
+
+def _update(node):
+    node.size = _size(node.left) + node.length + _size(node.right)
+
+# Splits the tree into the first 'pos' bytes and the rest,
+#   cutting a piece in two if needed
+def _split(node, pos):
+    if node is None:
+        return None, None
+
+    leftsize = _size(node.left)
+    if pos <= leftsize:
+        left, right = _split(node.left, pos)
+        node.left = right
+        _update(node)
+        return left, node
+
+    if pos >= leftsize + node.length:
+        left, right = _split(node.right, pos - leftsize - node.length)
+        node.right = left
+        _update(node)
+        return node, right
+
+    cut = pos - leftsize
+    tail = _Piece(node.added, node.start + cut, node.length - cut)
+    node.length = cut
+    right = node.right
+    node.right = None
+    _update(node)
+    return node, _merge(tail, right)
+
+def _merge(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+# Appends (added, start, end) for the parts of the pieces
+#   that overlap [start, end), where 'base' is the file
+#   offset of the subtree
+def _collect(node, start, end, base, out):
+    if node is None or end <= base or start >= base + node.size:
+        return
+
+    _collect(node.left, start, end, base, out)
+
+    pbase = base + _size(node.left)
+    lo = max(start, pbase)
+    hi = min(end, pbase + node.length)
+    if lo < hi:
+        offset = node.start - pbase
+        out.append((node.added, lo + offset, hi + offset))
+
+    _collect(node.right, start, end, pbase + node.length, out)
@@ -0,0 +1,108 @@
+####### Plugins ########
+# A plugin turns the bytes of each line into what is shown
+#   beside it: a string, a list of strings (one per row), or
+#   None to show nothing.
+#
+# The original kind of plugin is a function of a single
+#   line's token, which is also given the line's offset if
+#   it has 'want_index = True' set on it. The token is a
+#   string, unless it has 'memoryviews = True', in which case
+#   it is a memoryview of the file, as the built in
+#   formatters (see editconfig.py) take.
+#
+# A window plugin has a 'window' method (or attribute) that
+#   does a whole window of lines in one call:
+#
+#       window(view, base, start, end, width)
+#
+#   'view' is a memoryview of the file from offset 'base',
+#   and the lines wanted are the bytes [start, end) split
+#   every 'width' bytes. It returns a list with the output
+#   of each of those lines.
+#
+# Either kind can describe itself with these attributes:
+#   pure       Its output only depends on the bytes it is
+#              given, so it can run on worker processes
+#   cost       Rough seconds it takes per line, which decides
+#              whether the pool is worth using, and how many
+#              lines go in each job
+#   chunksize  Lines in each job, instead of working it out
+#   context    (before, after): bytes it needs to see on
+#              either side of the lines, such as for records
+#              that cross from one line into the next. The
+#              view starts 'before' bytes ahead of 'start'
+#              and ends 'after' bytes past 'end', where the
+#              file has them.
+#   timeout    Most seconds to wait for a window
+#   positional Whether its output depends on where a line is
+#              in the file, not just on its bytes. By default
+#              window plugins and 'want_index' ones are.
+#   memoize    False keeps its output out of the ContentCache
+#              (see rendercache.py), where lines with the same
+#              bytes share their output. By default a plugin
+#              is memoized unless it has context.
+
+
+# Plugin gives every kind of plugin the window interface and
+#   the full set of attributes, so the rest of the editor
+#   only deals with one kind. adapt() makes them.
+class Plugin(object):
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.name = getattr(plugin, "__name__", type(plugin).__name__)
+        self.pure = getattr(plugin, "pure", False)
+        self.cost = getattr(plugin, "cost", None)
+        self.chunksize = getattr(plugin, "chunksize", None)
+        self.timeout = getattr(plugin, "timeout", None)
+        self.context = tuple(getattr(plugin, "context", (0, 0)))
+        self.positional = getattr(plugin, "positional",
+            hasattr(plugin, "window") or getattr(plugin, "want_index", False))
+        self.memoize = getattr(plugin, "memoize", self.context == (0, 0))
+        self.memoryviews = getattr(plugin, "memoryviews", False)
+
+    # The plugin's own methods are looked up on each call
+    #   rather than kept, since bound methods can't be sent to
+    #   worker processes
+    def window(self, view, base, start, end, width):
+        plugin = self.plugin
+        window = getattr(plugin, "window", None)
+        if window is not None:
+            return window(view, base, start, end, width)
+
+        # One call per line for the original kind
+        offset = start - base
+        pairs = [ (view[i:i + width], start + i - offset)
+            for i in xrange(offset, offset + end - start, width) ]
+        if not self.memoryviews:
+            pairs = [ (tobytes(token), index) for token, index in pairs ]
+        batch = getattr(plugin, "batch", None)
+        if batch is not None:
+            return batch(pairs)
+        if getattr(plugin, "want_index", False):
+            return [ plugin(token, index) for token, index in pairs ]
+        return [ plugin(token) for token, index in pairs ]
+
+    # The old way of calling a plugin, for a single token
+    want_index = True
+    def __call__(self, token, index):
+        return self.window(memoryview(token), index, index,
+            index + len(token), max(len(token), 1))[0]
+
+    # How many lines (each 'width' bytes) either side of an
+    #   edited line can have their output changed by it
+    def reach(self, width):
+        before, after = self.context
+        return (after + width - 1) // width, (before + width - 1) // width
+
+# Returns the plugin as a Plugin, if it isn't one already
+def adapt(plugin):
+    if isinstance(plugin, Plugin):
+        return plugin
+    return Plugin(plugin)
+
+# The bytes of a token, which is a memoryview of the file or
+#   a string
+def tobytes(token):
+    if isinstance(token, memoryview):
+        return token.tobytes()
+    return bytes(token)
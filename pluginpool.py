@@ -0,0 +1,134 @@
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from rendercache import Uncached
+from plugin import tobytes
+
+# Shown for lines whose plugin didn't finish in time
+PLACEHOLDER = "..."
+
+# Windows that a plugin's cost says would take less than this
+#   many seconds are run straight away, and jobs are sized to
+#   take about this long
+_JOB_SECONDS = 0.005
+
+
+# PluginPool runs plugins that declare themselves pure
+#   (plugin.pure = True) across a pool of worker processes
+#   or threads. A window's lines are split into shards of
+#   'chunksize' lines (plugin.chunksize if it has one), and
+#   the results are put back together in order.
+# A window waits at most 'timeout' seconds (plugin.timeout
+#   if it has one) for the plugin. Lines that aren't done by
+#   then are shown as a placeholder that is never cached,
+#   so they are computed again next time they are loaded.
+# Window plugins are split into jobs of whole lines instead,
+#   sized by the plugin's cost if it gives one.
+class PluginPool(object):
+    def __init__(self, workers, kind="process", timeout=None,
+            chunksize=8):
+        self.workers = workers
+        self.kind = kind
+        self.timeout = timeout
+        self.chunksize = chunksize
+        self.timeouts = 0
+
+        self._pool = None
+
+    def process_batch(self, plugin, want_index, batch):
+        pool = self._getpool()
+        # Adapted plugins have both, set to None when not given
+        timeout = getattr(plugin, "timeout", None)
+        if timeout is None:
+            timeout = self.timeout
+        chunksize = getattr(plugin, "chunksize", None)
+        if chunksize is None:
+            chunksize = self.chunksize
+
+        pairs = batch
+        if self.kind == "process":
+            # memoryviews can't be sent to another process
+            pairs = [ (tobytes(token), index) for token, index in batch ]
+
+        shards = []
+        for i in xrange(0, len(pairs), chunksize):
+            shard = pairs[i:i+chunksize]
+            shards.append((len(shard), pool.apply_async(_run_plugin,
+                (plugin, want_index, shard))))
+
+        output = self._collect(shards, timeout)
+        return zip(output, [ index for token, index in batch ])
+
+    # Runs a window plugin (see plugin.py) over the lines in
+    #   [start, end) of a view starting at 'base', split into
+    #   jobs of whole lines, each with its own context bytes.
+    #   Returns the output of every line.
+    def process_window(self, plugin, view, base, start, end, width):
+        count = (end - start + width - 1) // width
+        cost = plugin.cost
+        if cost is not None and cost * count < _JOB_SECONDS:
+            return plugin.window(view, base, start, end, width)
+
+        pool = self._getpool()
+        timeout = plugin.timeout if plugin.timeout is not None else self.timeout
+        chunksize = plugin.chunksize
+        if chunksize is None:
+            chunksize = self.chunksize
+            if cost is not None:
+                chunksize = max(int(_JOB_SECONDS / cost), 1)
+        before, after = plugin.context
+        stop = base + len(view)
+
+        jobs = []
+        for first in xrange(start, end, chunksize * width):
+            last = min(first + chunksize * width, end)
+            low = max(first - before, base)
+            data = view[low - base:min(last + after, stop) - base]
+            if self.kind == "process":
+                data = tobytes(data)
+            jobs.append(((last - first + width - 1) // width,
+                pool.apply_async(_run_window,
+                    (plugin, data, low, first, last, width))))
+        return self._collect(jobs, timeout)
+
+    def _collect(self, jobs, timeout):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        output = []
+        for size, result in jobs:
+            try:
+                if deadline is None:
+                    output.extend(result.get())
+                else:
+                    wait = max(deadline - time.time(), 0)
+                    output.extend(result.get(wait))
+            except multiprocessing.TimeoutError:
+                self.timeouts += size
+                output.extend(Uncached(PLACEHOLDER) for i in xrange(size))
+        return output
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _getpool(self):
+        if self._pool is None:
+            if self.kind == "process":
+                self._pool = multiprocessing.Pool(self.workers)
+            else:
+                self._pool = ThreadPool(self.workers)
+        return self._pool
+
+
+# Runs in the worker
+def _run_plugin(plugin, want_index, shard):
+    if want_index:
+        return [ plugin(token, index) for token, index in shard ]
+    return [ plugin(token) for token, index in shard ]
+
+def _run_window(plugin, data, base, start, end, width):
+    return plugin.window(memoryview(data), base, start, end, width)
@@ -0,0 +1,161 @@
+import threading
+import time
+from Queue import Queue
+
+import editconfig
+
+# How far ahead (in seconds of scrolling at the current
+#   speed) the prefetcher tries to stay
+_HORIZON = 1.0
+
+# Scrolls further apart than this (in seconds) start the
+#   speed measurement over
+_IDLE = 0.5
+
+
+# Prefetcher formats the lines just past the loaded file
+#   window on a worker thread, while the editor is waiting
+#   for keys. Lines are run through the stream pipeline
+#   without being pushed into the column buffers, which
+#   fills the RenderCache, so that when the window slides
+#   onto them they only need to be drawn.
+# It looks further ahead the faster the view is scrolling,
+#   up to 'lookahead' steps of the window, and stops once it
+#   has added 'memcap' bytes to the cache that haven't been
+#   used yet.
+class Prefetcher(object):
+    def __init__(self, windowmanager, filedata, stream, cache,
+            lookahead, memcap):
+        self.windowmanager = windowmanager
+        self.filedata = filedata
+        self.stream = stream
+        self.cache = cache
+        self.lookahead = lookahead
+        self.memcap = memcap
+
+        self.generation = 0
+        self.direction = 0
+        self.velocity = 0.0
+        self.used = 0
+        self.fetched = 0
+        # Lines of the window are view lines, which are only
+        #   the same as file lines if no runs are collapsed
+        self.runmap = None
+
+        self._last = None
+        self._fwin = None
+        self._queued = set()
+        self._jobs = Queue()
+        self._thread = None
+        # Cleared while the editor is busy handling keys
+        self._running = threading.Event()
+        self._running.set()
+
+    def start(self):
+        if self.lookahead <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Waits for the current piece of work to finish, so the
+    #   file can be closed safely afterwards
+    def stop(self):
+        if self._thread is None:
+            return
+        self.cancel()
+        self.resume()
+        self._jobs.put(None)
+        self._thread.join()
+        self._thread = None
+
+    # Drops everything that is queued, and makes the worker
+    #   abandon anything it is in the middle of
+    def cancel(self):
+        self.generation += 1
+        self._queued.clear()
+        self.used = 0
+        self.direction = 0
+        self._last = None
+
+    # For when the view starts collapsing other runs
+    def set_runmap(self, runmap):
+        self.cancel()
+        self.runmap = runmap
+
+    # Holds the worker back between pieces of work, so it
+    #   doesn't take time from the editor
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    # Called after every scroll of 'steps' lines, to track the
+    #   direction and speed and queue up the windows ahead of
+    #   the view
+    def scrolled(self, direction, steps=1):
+        if self._thread is None:
+            return
+
+        now = time.time()
+        if (direction != self.direction or self._last is None
+                or now - self._last > _IDLE):
+            self.direction = direction
+            self.velocity = 0.0
+        else:
+            rate = steps / max(now - self._last, 0.001)
+            self.velocity = (self.velocity + rate) / 2
+        self._last = now
+
+        wm = self.windowmanager
+        fwin = (wm.fwin.start, wm.fwin.end)
+        if fwin != self._fwin:
+            # The window moved onto prefetched lines
+            self._fwin = fwin
+            self.used = 0
+            self._queued = set(piece for piece in self._queued
+                if piece[0] >= fwin[1] or piece[1] <= fwin[0])
+
+        depth = int(self.velocity * _HORIZON / wm.step) + 1
+        depth = min(depth, self.lookahead)
+
+        for i in xrange(depth):
+            if direction > 0:
+                start = fwin[1] + i * wm.step
+                end = min(start + wm.step, wm.full_win.end)
+            else:
+                end = fwin[0] - i * wm.step
+                start = max(end - wm.step, wm.full_win.start)
+            if start >= end:
+                break
+            self._queue(start, end)
+
+    def _queue(self, start, end):
+        if (start, end) in self._queued or self.used >= self.memcap:
+            return
+        self._queued.add((start, end))
+        self._jobs.put((self.generation, start, end))
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+
+            self._running.wait()
+            generation, start, end = job
+            if generation != self.generation:
+                continue
+
+            bpl = editconfig.bytesPerLine
+            before = self.cache.size
+            runmap = self.runmap
+            if runmap is None:
+                tokens = self.filedata.tokens(start * bpl, end * bpl, bpl)
+            else:
+                tokens = runmap.tokens(self.filedata, start, end, bpl)
+            self.stream.warm_batch(tokens)
+
+            self.used += max(self.cache.size - before, 0)
+            self.fetched += end - start
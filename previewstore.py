@@ -0,0 +1,198 @@
+import os
+import json
+from bisect import bisect_left, bisect_right
+from searchindex import sidecar_path
+
+STORE_VERSION = 1
+
+_SUFFIX = ".hexpreview"
+
+
+# PreviewStore holds what the preview column shows in place
+#   of its own output over ranges of bytes, which is the
+#   plugin whose output was pinned there.
+# The ranges are kept sorted and apart from each other in
+#   parallel lists, so the ones under a window of the file
+#   are found with a bisect, and a range takes up the same
+#   space however many lines it covers. Pinning over ranges
+#   replaces what was under it, and ranges that meet with
+#   the same value are joined, so pinning line after line
+#   leaves a single range.
+# It is saved to a sidecar file keyed by the file's size,
+#   inode and mtime, like the SearchIndex, with each value
+#   saved under a name.
+class PreviewStore(object):
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+        self._values = []
+
+        # Whether it changed since it was last loaded or saved
+        self.dirty = False
+
+    # The (start, end, value) ranges that overlap [start, end)
+    def overlapping(self, start, end):
+        lo = bisect_right(self._ends, start)
+        hi = bisect_left(self._starts, end)
+        return zip(self._starts[lo:hi], self._ends[lo:hi],
+            self._values[lo:hi])
+
+    # The value pinned over the byte, or None
+    def at(self, offset):
+        i = bisect_right(self._starts, offset) - 1
+        if i >= 0 and offset < self._ends[i]:
+            return self._values[i]
+        return None
+
+    # Pins 'value' over [start, end). Returns False if it
+    #   was already pinned there.
+    def pin(self, start, end, value):
+        if start >= end:
+            return False
+        pieces = self.overlapping(start, end)
+        if (len(pieces) == 1 and pieces[0][0] <= start
+                and pieces[0][1] >= end and pieces[0][2] == value):
+            return False
+        self._replace(start, end, [ (start, end, value) ])
+        return True
+
+    # Returns False if nothing was pinned in [start, end)
+    def unpin(self, start, end):
+        if start >= end or len(self.overlapping(start, end)) == 0:
+            return False
+        self._replace(start, end, [])
+        return True
+
+    def clear(self):
+        self._starts, self._ends, self._values = [], [], []
+        self.dirty = False
+
+    # Moves the ranges along with their bytes, after 'length'
+    #   bytes at 'offset' were replaced with 'newlength' bytes.
+    #   Ranges over the replaced bytes shrink with them.
+    def edited(self, offset, length, newlength):
+        first = bisect_right(self._ends, offset)
+        if length == newlength or first == len(self._ends):
+            return
+
+        def move(pos):
+            if pos <= offset:
+                return pos
+            if pos >= offset + length:
+                return pos + newlength - length
+            return offset + min(pos - offset, newlength)
+
+        pieces = [ (move(start), move(end), value) for start, end, value
+            in zip(self._starts[first:], self._ends[first:],
+                self._values[first:]) ]
+        pieces = [ piece for piece in pieces if piece[0] < piece[1] ]
+        if first > 0:
+            # It may now meet the one before
+            first -= 1
+            pieces.insert(0, (self._starts[first], self._ends[first],
+                self._values[first]))
+        self._set(first, len(self._starts), _joined(pieces))
+
+    # Replaces whatever is in [start, end) with the new ranges,
+    #   keeping the parts of old ranges that stick out of it
+    def _replace(self, start, end, new):
+        lo = bisect_right(self._ends, start)
+        hi = bisect_left(self._starts, end)
+        pieces = []
+        if lo < hi and self._starts[lo] < start:
+            pieces.append((self._starts[lo], start, self._values[lo]))
+        pieces.extend(new)
+        if lo < hi and self._ends[hi - 1] > end:
+            pieces.append((end, self._ends[hi - 1], self._values[hi - 1]))
+
+        # The ranges on either side may meet the new ones
+        if lo > 0:
+            lo -= 1
+            pieces.insert(0, (self._starts[lo], self._ends[lo],
+                self._values[lo]))
+        if hi < len(self._starts):
+            pieces.append((self._starts[hi], self._ends[hi],
+                self._values[hi]))
+            hi += 1
+        self._set(lo, hi, _joined(pieces))
+
+    def _set(self, lo, hi, pieces):
+        self._starts[lo:hi] = [ start for start, end, value in pieces ]
+        self._ends[lo:hi] = [ end for start, end, value in pieces ]
+        self._values[lo:hi] = [ value for start, end, value in pieces ]
+        self.dirty = True
+
+    # Reads the ranges saved for the file at 'path', turning
+    #   the names they were saved under back into values with
+    #   lookup(name), which returns None for ones that are
+    #   gone. Returns False if there weren't any for the file
+    #   as it is now.
+    def load(self, path, lookup):
+        self.clear()
+        path = os.path.abspath(path)
+        try:
+            infile = open(sidecar_path(path, _SUFFIX), "rb")
+        except IOError:
+            return False
+
+        with infile:
+            try:
+                if json.loads(infile.readline()) != _meta(path):
+                    return False
+                pieces = []
+                for line in infile:
+                    start, end, name = json.loads(line)
+                    value = lookup(name)
+                    if value is not None:
+                        pieces.append((start, end, value))
+            except (ValueError, TypeError):
+                return False
+
+        for start, end, value in pieces:
+            self.pin(start, end, value)
+        self.dirty = False
+        return True
+
+    # Writes the ranges beside the file at 'path', each value
+    #   under name(value), or removes the sidecar if there are
+    #   none. Errors are left to the caller.
+    def save(self, path, name):
+        path = os.path.abspath(path)
+        sidecar = sidecar_path(path, _SUFFIX)
+        if len(self._starts) == 0:
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
+            self.dirty = False
+            return
+
+        temp = sidecar + ".tmp"
+        with open(temp, "wb") as outfile:
+            outfile.write(json.dumps(_meta(path)) + "\n")
+            for start, end, value in zip(self._starts, self._ends,
+                    self._values):
+                outfile.write(json.dumps([ start, end, name(value) ]) + "\n")
+        os.rename(temp, sidecar)
+        self.dirty = False
+
+    def __len__(self):
+        return len(self._starts)
+
+
+def _meta(path):
+    info = os.stat(path)
+    return {
+        "version": STORE_VERSION,
+        "path": path,
+        "identity": [ info.st_size, info.st_ino, info.st_mtime ],
+    }
+
+# Joins the ranges in the sorted list that meet and have the
+#   same value
+def _joined(pieces):
+    joined = []
+    for start, end, value in pieces:
+        if joined and joined[-1][1] == start and joined[-1][2] == value:
+            joined[-1] = (joined[-1][0], end, value)
+        else:
+            joined.append((start, end, value))
+    return joined
@@ -0,0 +1,256 @@
+import sys
+import threading
+from plugin import tobytes
+
+# Rough bookkeeping cost of an entry on top of its value
+_ENTRY_OVERHEAD = 200
+
+# When over budget, evict down to this fraction of it so
+#   that eviction runs rarely rather than on every insert
+_SHRINK_TO = 0.75
+
+
+# Output that is shown but never cached, such as a stand in
+#   for a line that couldn't be rendered in time
+class Uncached(str):
+    pass
+
+
+# _LRUCache is what the caches below have in common: tables
+#   of entries under a lock, each entry stamped with a tick
+#   whenever it is looked up. Once the estimated size of the
+#   entries goes over the budget (in bytes), the least
+#   recently used are evicted in one go.
+# It is safe to share with a prefetching thread. The lock
+#   is not held while lines are being formatted.
+class _LRUCache(object):
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._tick = 0
+        # table key -> { key -> [val, size, tick] }
+        self._tables = {}
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+            lookups = hits + misses
+            return {
+                "hits": hits,
+                "misses": misses,
+                "evictions": self.evictions,
+                "hitrate": float(hits) / lookups if lookups else 0.0,
+                "entries": sum(len(table)
+                    for table in self._tables.itervalues()),
+                "size": self.size,
+                "budget": self.budget,
+            }
+
+    def _table(self, key):
+        table = self._tables.get(key)
+        if table is None:
+            table = {}
+            self._tables[key] = table
+        return table
+
+    # Stores the value under the key with the current tick,
+    #   counting 'extra' bytes on top of the value's size
+    def _store(self, table, key, val, extra=0):
+        if isinstance(val, Uncached):
+            return
+
+        size = _sizeof(val) + extra
+        if size > self.budget:
+            return
+
+        old = table.get(key)
+        if old is not None:
+            self.size -= old[1]
+
+        table[key] = [ val, size, self._tick ]
+        self.size += size
+
+    def _shrink(self):
+        if self.size <= self.budget:
+            return
+
+        entries = []
+        for table in self._tables.itervalues():
+            for key, entry in table.iteritems():
+                entries.append((entry[2], key, table))
+        entries.sort(key=lambda e: e[0])
+
+        target = self.budget * _SHRINK_TO
+        for tick, key, table in entries:
+            if self.size <= target:
+                break
+            self.size -= table.pop(key)[1]
+            self.evictions += 1
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(table) for table in self._tables.itervalues())
+
+
+# RenderCache is a bounded LRU cache of formatted column
+#   output, shared by the streams of an EditPad so lines
+#   survive file window moves.
+# Entries are kept per (stream, processor) and keyed by
+#   line, so a plugin switch never returns another plugin's
+#   output.
+class RenderCache(_LRUCache):
+    def __init__(self, budget, bpl):
+        super(RenderCache, self).__init__(budget)
+        self.bpl = bpl
+
+    # Processes a batch of (token, index) pairs for a stream,
+    #   only calling compute (which takes and returns a batch)
+    #   on the lines that aren't cached
+    def process_batch(self, stream, processor, batch, compute):
+        bpl = self.bpl
+        with self._lock:
+            table = self._table((stream, processor))
+            self._tick += 1
+            tick = self._tick
+
+            found = []
+            missed = []
+            for i, (token, index) in enumerate(batch):
+                entry = table.get(index // bpl)
+                if entry is None:
+                    missed.append(i)
+                    found.append(None)
+                else:
+                    entry[2] = tick
+                    found.append(entry[0])
+
+            self.hits += len(batch) - len(missed)
+            self.misses += len(missed)
+
+        if len(missed) > 0:
+            computed = compute([ batch[i] for i in missed ])
+            with self._lock:
+                table = self._table((stream, processor))
+                for i, (val, index) in zip(missed, computed):
+                    found[i] = val
+                    self._store(table, index // bpl, val)
+                self._shrink()
+
+        return zip(found, [ index for token, index in batch ])
+
+    def get(self, stream, processor, line, default=None):
+        with self._lock:
+            entry = self._table((stream, processor)).get(line)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._tick += 1
+            entry[2] = self._tick
+            self.hits += 1
+            return entry[0]
+
+    def put(self, stream, processor, line, val):
+        with self._lock:
+            self._tick += 1
+            self._store(self._table((stream, processor)), line, val)
+            self._shrink()
+
+    # Drops every entry for the lines in [start, end), for
+    #   when the bytes behind them change
+    def invalidate_lines(self, start, end):
+        with self._lock:
+            for table in self._tables.itervalues():
+                stale = [ line for line in table if start <= line < end ]
+                for line in stale:
+                    self.size -= table.pop(line)[1]
+
+
+
+# ContentCache is a bounded LRU cache of a processor's output
+#   for each distinct token, so lines with the same bytes,
+#   such as zero fill or erased flash, are only formatted
+#   once wherever they are in the file, and in any file.
+# Entries are kept per processor and keyed by the token's
+#   bytes, along with its index for processors where that
+#   matters (see _keys). Processors with 'memoize = False'
+#   aren't given one.
+# Since entries are keyed on bytes, edits never make them
+#   stale.
+class ContentCache(_LRUCache):
+    # Processes a batch of (token, index) pairs, calling
+    #   compute (which takes and returns a batch) once for
+    #   each distinct token that isn't cached
+    def process_batch(self, processor, batch, compute):
+        if len(batch) == 0:
+            return []
+        tokens, indexes = zip(*batch)
+        keys = _keys(processor, tokens, indexes)
+        # The first place each distinct key is in the batch,
+        #   since later places overwrite earlier ones
+        count = len(keys)
+        first = dict(zip(reversed(keys), xrange(count - 1, -1, -1)))
+
+        with self._lock:
+            table = self._table(processor)
+            self._tick += 1
+            tick = self._tick
+
+            found = {}
+            missed = []
+            for key, i in first.iteritems():
+                entry = table.get(key)
+                if entry is None:
+                    missed.append(i)
+                else:
+                    entry[2] = tick
+                    found[key] = entry[0]
+
+            self.hits += count - len(missed)
+            self.misses += len(missed)
+
+        if len(missed) > 0:
+            missed.sort()
+            computed = compute([ batch[i] for i in missed ])
+            vals = [ val for val, index in computed ]
+            added = [ keys[i] for i in missed ]
+            found.update(zip(added, vals))
+            with self._lock:
+                table = self._table(processor)
+                for key, val in zip(added, vals):
+                    self._store(table, key, val, sys.getsizeof(key))
+                self._shrink()
+
+        return zip(map(found.__getitem__, keys), indexes)
+
+
+def _sizeof(val):
+    size = _ENTRY_OVERHEAD + sys.getsizeof(val)
+    if isinstance(val, list):
+        size += sum(sys.getsizeof(line) for line in val)
+    return size
+
+# A processor's output can depend on where its token is if
+#   it asks for the index, unless it says otherwise with
+#   'positional = False'. Plugins (see plugin.py) always
+#   take the index, so they say which they are.
+def _keys(processor, tokens, indexes):
+    try:
+        data = map(memoryview.tobytes, tokens)
+    except TypeError:
+        data = map(tobytes, tokens)
+    positional = getattr(processor, "positional",
+        getattr(processor, "want_index", False))
+    if positional:
+        return zip(data, indexes)
+    return data
@@ -0,0 +1,317 @@
+import operator
+import threading
+from bisect import bisect_left, bisect_right
+
+# Lines in each block of the file that is scanned at once
+_BLOCK = 64 * 1024
+# Blocks are split in half until they are this many lines,
+#   so stretches of identical lines are found by comparing
+#   whole slices rather than one line at a time
+_LEAF = 1024
+# Identical lines in a row that are collapsed. The first is
+#   still shown, and the rest become a single marker row.
+_MINRUN = 3
+# A block that is all one hole in a sparse file
+_HOLE = "hole"
+
+
+# RunIndex finds the runs of identical lines in a file on a
+#   background thread, like the '*' in hexdump's output.
+# The file is scanned in blocks of lines. Before a block is
+#   read, the file is asked where its next data is, so the
+#   holes of sparse files are skipped without being read.
+# Each block keeps the runs inside it and the lines at its
+#   edges, so the runs that cross blocks are joined up when
+#   a RunMap is made, and only the blocks that an edit
+#   touched need scanning again.
+class RunIndex(object):
+    def __init__(self, filedata, bpl, nlines):
+        self.filedata = filedata
+        self.bpl = bpl
+        self.nlines = nlines
+
+        # None for blocks that haven't been scanned yet
+        self._blocks = [ None ] * _nblocks(nlines)
+        # Every block before this one is scanned
+        self._next = 0
+        # Bumped on every change to the file, so scans that
+        #   were under way are thrown away
+        self.generation = 0
+        # Bumped whenever a block is scanned
+        self.version = 0
+        self.done = nlines <= 0
+
+        self._changed = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        with self._changed:
+            self._stopped = True
+            self._changed.notify_all()
+        self._thread.join()
+        self._thread = None
+
+    # For when the lines in [first, last) changed, and the file
+    #   is now 'nlines' long. If it was resized, every line
+    #   from 'first' on may have moved.
+    def changed(self, first, last, resized, nlines):
+        with self._changed:
+            nblocks = _nblocks(nlines)
+            if resized:
+                last = nlines
+            blocks = self._blocks[:nblocks]
+            blocks.extend([ None ] * (nblocks - len(blocks)))
+            # The last block is always rescanned when the file
+            #   changes length, since it was short
+            lastline = min(self.nlines, nlines) - 1
+            if nlines != self.nlines and lastline >= 0:
+                blocks[lastline // _BLOCK] = None
+            for block in xrange(max(first, 0) // _BLOCK,
+                    min((last - 1) // _BLOCK + 1, nblocks)):
+                blocks[block] = None
+
+            self._blocks = blocks
+            self.nlines = nlines
+            self._next = 0
+            self.generation += 1
+            self.version += 1
+            self.done = False
+            self._changed.notify_all()
+
+    # A RunMap of the runs found so far
+    def runmap(self):
+        with self._changed:
+            blocks = list(self._blocks)
+            nlines = self.nlines
+        runs = _join(blocks, nlines, self.bpl)
+        hidden = [ (start + 1, end) for start, end in runs
+            if end - start >= _MINRUN ]
+        return RunMap(hidden, nlines)
+
+    def _run(self):
+        while True:
+            with self._changed:
+                block = self._find()
+                while block is None and not self._stopped:
+                    self.done = True
+                    self._changed.wait()
+                    block = self._find()
+                if self._stopped:
+                    return
+                generation = self.generation
+                nlines = self.nlines
+
+            scanned = self._scan(block, nlines)
+
+            with self._changed:
+                if generation != self.generation:
+                    continue
+                for offset, result in enumerate(scanned):
+                    self._blocks[block + offset] = result
+                self.version += 1
+
+    def _find(self):
+        blocks = self._blocks
+        for block in xrange(self._next, len(blocks)):
+            if blocks[block] is None:
+                self._next = block
+                return block
+        self._next = len(blocks)
+        return None
+
+    # Scans the block, returning its result and those of the
+    #   holes that follow it, if the file says it has any
+    def _scan(self, block, nlines):
+        bpl = self.bpl
+        start = block * _BLOCK
+        end = min(start + _BLOCK, nlines)
+        # Only blocks of whole lines are taken as holes, since
+        #   the short last line isn't a line of zeros
+        length = len(self.filedata)
+        blockbytes = _BLOCK * bpl
+        if (block + 1) * blockbytes <= length:
+            data = self.filedata.next_data(block * blockbytes)
+            if data >= (block + 1) * blockbytes:
+                # Every whole block before the data is a hole
+                holes = min(data, length) // blockbytes - block
+                return [ _HOLE ] * min(holes, len(self._blocks) - block)
+
+        view = self.filedata.read(start * bpl, end * bpl)
+        changes = []
+        _changes(view, 0, end - start, bpl, changes)
+
+        starts = [ 0 ] + changes
+        ends = changes + [ end - start ]
+        runs = [ (start + first, start + last)
+            for first, last in zip(starts, ends) if last - first >= 2 ]
+        first = view[:bpl].tobytes()
+        last = view[(end - start - 1) * bpl:].tobytes()
+        return [ (first, start + ends[0], last, start + starts[-1], runs) ]
+
+
+# Which lines of the file are shown, once runs of identical
+#   lines are collapsed. Lines are numbered two ways: the
+#   lines of the file, and the lines of the view, where each
+#   collapsed run takes up a single line.
+# 'hidden' is a sorted list of (start, end) ranges of file
+#   lines that are each shown as one marker line.
+class RunMap(object):
+    def __init__(self, hidden, nlines):
+        self.hidden = hidden
+        self.nlines = nlines
+
+        self._starts = [ start for start, end in hidden ]
+        # The view line of each marker, and how many lines are
+        #   gone from the view once past it
+        self._views = []
+        self._removed = []
+        removed = 0
+        for start, end in hidden:
+            self._views.append(start - removed)
+            removed += end - start - 1
+            self._removed.append(removed)
+
+    # The number of lines in the view
+    def view_lines(self):
+        removed = self._removed[-1] if self._removed else 0
+        return max(self.nlines - removed, 0)
+
+    # The view line that the file line is shown on
+    def to_view(self, line):
+        i = bisect_right(self._starts, line) - 1
+        if i < 0:
+            return line
+        if line < self.hidden[i][1]:
+            return self._views[i]
+        return line - self._removed[i]
+
+    # The file lines [start, end) that are shown on the view
+    #   line, which is more than one for a marker
+    def to_file(self, vline):
+        i = bisect_right(self._views, vline) - 1
+        if i < 0:
+            return vline, vline + 1
+        if vline == self._views[i]:
+            return self.hidden[i]
+        line = vline + self._removed[i]
+        return line, line + 1
+
+    def collapsed(self, vline):
+        i = bisect_right(self._views, vline) - 1
+        return i >= 0 and vline == self._views[i]
+
+    # Splits the view lines [start, end) into pieces that are
+    #   either (first, last, False) for the file lines [first,
+    #   last), or (first, last, True) for a marker that stands
+    #   for them
+    def segments(self, start, end):
+        views = self._views
+        pieces = []
+        vline = start
+        # The next marker, and the lines gone before it
+        i = bisect_left(views, start)
+        removed = self._removed[i - 1] if i > 0 else 0
+        while vline < end:
+            if i < len(views) and views[i] == vline:
+                first, last = self.hidden[i]
+                pieces.append((first, last, True))
+                removed = self._removed[i]
+                vline += 1
+                i += 1
+            else:
+                stop = min(end, views[i]) if i < len(views) else end
+                pieces.append((vline + removed, stop + removed, False))
+                vline = stop
+        return pieces
+
+    # The (token, index) pairs of the file lines shown in the
+    #   view lines [start, end), leaving out markers
+    def tokens(self, filedata, start, end, bpl):
+        tokens = []
+        for first, last, collapsed in self.segments(start, end):
+            if not collapsed:
+                tokens.extend(filedata.tokens(first * bpl, last * bpl, bpl))
+        return tokens
+
+
+def _nblocks(nlines):
+    return (max(nlines, 0) + _BLOCK - 1) // _BLOCK
+
+# Appends to 'out' each line in (start, end) of the view that
+#   isn't the same as the line before it. Stretches that are
+#   all the same line are found by comparing the bytes with
+#   themselves a line further on.
+def _changes(view, start, end, bpl, out):
+    if end - start < 2:
+        return
+    if view[(start + 1) * bpl:end * bpl] == view[start * bpl:(end - 1) * bpl]:
+        return
+    if end - start <= _LEAF:
+        data = view[start * bpl:end * bpl].tobytes()
+        lines = [ data[i:i + bpl] for i in xrange(0, len(data), bpl) ]
+        same = map(operator.eq, lines[1:], lines[:-1])
+        out.extend(start + i + 1 for i, equal in enumerate(same) if not equal)
+        return
+
+    mid = (start + end) // 2
+    _changes(view, start, mid, bpl, out)
+    if view[mid * bpl:(mid + 1) * bpl] != view[(mid - 1) * bpl:mid * bpl]:
+        out.append(mid)
+    _changes(view, mid, end, bpl, out)
+
+# Joins the runs of every block into the runs of the file,
+#   as a list of (start, end) with at least two lines each.
+#   Runs stop at blocks that haven't been scanned, though
+#   they may go on past them.
+def _join(blocks, nlines, bpl):
+    zeros = b'\0' * bpl
+    runs = []
+    # The run that goes up to the end of the last block:
+    #   [start, end, line]
+    tail = None
+    for block, result in enumerate(blocks):
+        if result is None:
+            tail = _close(runs, tail)
+            continue
+
+        start = block * _BLOCK
+        end = min(start + _BLOCK, nlines)
+        if result is _HOLE:
+            first = last = zeros
+            headend, tailstart, inner = end, start, ()
+        else:
+            first, headend, last, tailstart, inner = result
+
+        if tail is not None and tail[1] == start and tail[2] == first:
+            runstart = tail[0]
+        else:
+            tail = _close(runs, tail)
+            runstart = start
+
+        if headend == end:
+            tail = [ runstart, end, first ]
+            continue
+        if headend - runstart >= 2:
+            runs.append((runstart, headend))
+        for first_line, last_line in inner:
+            if first_line != start and last_line != end:
+                runs.append((first_line, last_line))
+        tail = [ tailstart, end, last ]
+    _close(runs, tail)
+    return runs
+
+def _close(runs, tail):
+    if tail is not None and tail[1] - tail[0] >= 2:
+        runs.append((tail[0], tail[1]))
+    return None
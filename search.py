@@ -0,0 +1,259 @@
+import re
+import mmap
+import time
+import threading
+import multiprocessing
+from bisect import bisect_left, bisect_right
+
+# Longest match that is guaranteed to be found across chunk
+#   boundaries for regex searches, whose match length isn't
+#   known ahead of time
+REGEX_OVERLAP = 4096
+
+# Files smaller than this are scanned on a single thread
+PARALLEL_THRESHOLD = 64 * 1024 * 1024
+
+
+# A search query, compiled down to a regex over bytes.
+# Queries are typed with a prefix giving their kind:
+#   x:DE AD ?? EF   hex bytes, ?? matches any byte
+#   s:text          ascii string (the default)
+#   u:text          utf-16 (little endian) string
+#   r:regex         python regex over the raw bytes
+# Fixed length patterns find overlapping matches.
+class Pattern(object):
+    def __init__(self, query):
+        kind, text = _splitquery(query)
+        if len(text) == 0:
+            raise ValueError("Empty search: %s" % query)
+        self.kind = kind
+        self.query = query
+
+        # literals are byte strings that every match contains
+        if kind == "x":
+            source, length, self.literals = _hexsource(text)
+        elif kind == "u":
+            encoded = text.decode("latin-1").encode("utf-16-le")
+            source, length = re.escape(encoded), len(encoded)
+            self.literals = [ encoded ]
+        elif kind == "r":
+            source, length = text, None
+            self.literals = []
+        else:
+            source, length = re.escape(text), len(text)
+            self.literals = [ text ]
+
+        if length is None:
+            self.source = source
+            self.overlap = REGEX_OVERLAP
+        else:
+            # A lookahead lets matches overlap each other
+            self.source = "(?=(%s))" % source
+            self.overlap = max(length - 1, 0)
+
+        self.regex = re.compile(self.source, re.DOTALL)
+
+
+def _splitquery(query):
+    if len(query) >= 2 and query[1] == ":" and query[0] in "xsur":
+        return query[0], query[2:]
+    return "s", query
+
+def _hexsource(text):
+    text = "".join(text.split())
+    if len(text) % 2 != 0:
+        raise ValueError("Odd number of hex digits: %s" % text)
+
+    parts = []
+    literals = [ "" ]
+    for i in xrange(0, len(text), 2):
+        byte = text[i:i+2]
+        if byte == "??":
+            parts.append(".")
+            literals.append("")
+        else:
+            char = chr(int(byte, 16))
+            parts.append(re.escape(char))
+            literals[-1] += char
+    literals = [ literal for literal in literals if literal ]
+    return "".join(parts), len(parts), literals
+
+
+# Search scans a FileBuffer for a Pattern on a background
+#   thread. The file is read in large chunks that overlap
+#   by the pattern's longest match. Big files on disk are
+#   split across a process pool, with each worker mapping
+#   the file itself.
+# Hits (byte offsets) are added to 'hits' in file order as
+#   chunks finish, so they can be used before the scan is.
+# Given a ready SearchIndex, only the blocks it says may hold
+#   the pattern's literals are scanned.
+# A file with unsaved edits is always scanned in process,
+#   through the FileBuffer.
+class Search(object):
+    def __init__(self, filedata, pattern, workers=1,
+            chunksize=4*1024*1024, maxhits=1000000, index=None):
+        self.filedata = filedata
+        self.pattern = pattern
+        self.workers = workers
+        self.chunksize = chunksize
+        self.maxhits = maxhits
+        self.index = index
+
+        self.hits = []
+        self.scanned = 0
+        self.done = False
+
+        self._cancelled = False
+        self._changed = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # The first hit after 'offset', waiting up to 'timeout'
+    #   seconds for the scan to get to one. None if there
+    #   isn't one (yet).
+    def next_hit(self, offset, timeout=None):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        with self._changed:
+            i = bisect_right(self.hits, offset)
+            while i >= len(self.hits) and not self.done:
+                if deadline is None:
+                    self._changed.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._changed.wait(remaining)
+                i = bisect_right(self.hits, offset)
+
+            if i < len(self.hits):
+                return self.hits[i]
+            return None
+
+    # The last hit before 'offset'. Hits are found in file
+    #   order, so this never has to wait.
+    def prev_hit(self, offset):
+        i = bisect_left(self.hits, offset)
+        if i > 0:
+            return self.hits[i - 1]
+        return None
+
+    def _run(self):
+        try:
+            for offsets, end in self._scan():
+                if self._cancelled:
+                    return
+                with self._changed:
+                    room = self.maxhits - len(self.hits)
+                    self.hits.extend(offsets[:room])
+                    self.scanned = end
+                    self._changed.notify_all()
+                if room <= len(offsets):
+                    return
+        finally:
+            with self._changed:
+                self.done = True
+                self._changed.notify_all()
+
+    # Yields (hits, end) for each chunk, in file order
+    def _scan(self):
+        flen = len(self.filedata)
+        ranges = self._indexed_ranges(flen)
+        if ranges is None:
+            ranges = [ (start, min(start + self.chunksize, flen))
+                for start in xrange(0, flen, self.chunksize) ]
+        overlap = self.pattern.overlap
+
+        path = self.filedata.path()
+        if (self.workers > 1 and path is not None
+                and flen >= PARALLEL_THRESHOLD):
+            jobs = [ (path, self.pattern.source, start, end, overlap)
+                for start, end in ranges ]
+            pool = multiprocessing.Pool(self.workers)
+            try:
+                for i, offsets in enumerate(pool.imap(_scan_path, jobs)):
+                    if self._cancelled:
+                        return
+                    yield offsets, ranges[i][1]
+            finally:
+                pool.terminate()
+            return
+
+        regex = self.pattern.regex
+        for start, end in ranges:
+            if self._cancelled:
+                return
+            stop = min(end + overlap, flen)
+            data = self.filedata.read(start, stop).tobytes()
+            yield _scan_data(regex, data, start, end - start), end
+
+
+    # The ranges of the file worth scanning according to the
+    #   index, joined into pieces of up to chunksize. None if
+    #   there is no usable index.
+    def _indexed_ranges(self, flen):
+        # The index describes the file on disk, not the edits
+        if self.index is None or self.filedata.is_dirty():
+            return None
+        blocks = self.index.candidates(self.pattern.literals)
+        if blocks is None:
+            return None
+
+        size = self.index.blocksize
+        ranges = []
+        for block in blocks:
+            start = block * size
+            end = min(start + size, flen)
+            if (ranges and ranges[-1][1] == start
+                    and end - ranges[-1][0] <= self.chunksize):
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+
+# Finds the offsets of every match that starts before
+#   'limit' bytes into data, which begins at 'base'
+def _scan_data(regex, data, base, limit):
+    offsets = []
+    for match in regex.finditer(data):
+        if match.start() >= limit:
+            break
+        offsets.append(base + match.start())
+    return offsets
+
+# Runs in the worker processes
+_regexes = {}
+
+def _scan_path(job):
+    path, source, start, end, overlap = job
+    regex = _regexes.get(source)
+    if regex is None:
+        regex = re.compile(source, re.DOTALL)
+        _regexes[source] = regex
+
+    with open(path, "rb") as infile:
+        mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            stop = min(end + overlap, len(mapped))
+            offsets = []
+            for match in regex.finditer(mapped, start, stop):
+                if match.start() >= end:
+                    break
+                offsets.append(match.start())
+            return offsets
+        finally:
+            mapped.close()
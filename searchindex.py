@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import mmap
+import time
+import threading
+import multiprocessing
+from array import array
+
+INDEX_VERSION = 1
+
+# Every block of the file gets a bitmap with one bit for
+#   each of the 65536 possible pairs of bytes
+BITMAP_SIZE = 65536 // 8
+
+_SUFFIX = ".hexidx"
+
+
+# SearchIndex is a sidecar file that records, for every
+#   fixed size block of a file, which pairs of adjacent bytes
+#   appear in it. A search for a literal only has to scan the
+#   blocks that contain every pair in it, rather than the
+#   whole file.
+# The index is keyed by the file's path, size, inode and
+#   mtime, and is thrown away and rebuilt whenever those
+#   change. It is built in the background by a process pool
+#   and written beside the file (or in ~/.cache/hexeditor if
+#   that isn't writable).
+class SearchIndex(object):
+    def __init__(self, path, blocksize=1024*1024, workers=1):
+        self.path = os.path.abspath(path)
+        self.blocksize = blocksize
+        self.workers = workers
+
+        self.ready = False
+        self.built = 0
+        self.blocks = 0
+        self.build_time = 0.0
+        self.last_query = None
+
+        self._identity = None
+        self._map = None
+        self._thread = None
+        self._cancelled = False
+
+    # Loads the index if a current one exists, otherwise
+    #   starts building it
+    def open(self):
+        self._identity = _identity(self.path)
+        if self._load():
+            return
+        # A rebuild counts its progress from nothing again
+        self.built = 0
+        self.build_time = 0.0
+        self._thread = threading.Thread(target=self._build)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._cancelled = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._unload()
+
+    # Checks that the file hasn't changed since the index was
+    #   made, and starts a rebuild if it has
+    def current(self):
+        if _identity(self.path) == self._identity:
+            return self.ready
+        self.close()
+        self._cancelled = False
+        self.ready = False
+        self.open()
+        return False
+
+    # The numbers of the blocks that may contain a match for
+    #   all of the literals, or None if the index can't help
+    def candidates(self, literals):
+        grams = set()
+        for literal in literals:
+            grams.update(_grams(literal))
+        if len(grams) == 0 or not self.current():
+            return None
+
+        start = time.time()
+        data = self._map
+        header = self._header
+        found = []
+        for block in xrange(self.blocks):
+            # A match can run on into the next block
+            base = header + block * BITMAP_SIZE
+            after = base + BITMAP_SIZE if block + 1 < self.blocks else base
+            for gram in grams:
+                offset = gram >> 3
+                bit = 1 << (gram & 7)
+                if not (ord(data[base + offset]) & bit or
+                        ord(data[after + offset]) & bit):
+                    break
+            else:
+                found.append(block)
+        self.last_query = time.time() - start
+        return found
+
+    def stats(self):
+        size = 0
+        if self.ready:
+            size = os.path.getsize(self._sidecar())
+        rate = 0.0
+        if self.build_time > 0:
+            rate = self.built * self.blocksize / self.build_time
+        return {
+            "ready": self.ready,
+            "blocks": self.blocks,
+            "built": self.built,
+            "build_rate": rate,
+            "index_size": size,
+            "query_latency": self.last_query,
+        }
+
+    def _sidecar(self):
+        return sidecar_path(self.path, _SUFFIX)
+
+    def _meta(self):
+        return {
+            "version": INDEX_VERSION,
+            "path": self.path,
+            "identity": list(self._identity),
+            "blocksize": self.blocksize,
+            "byteorder": sys.byteorder,
+        }
+
+    def _load(self):
+        sidecar = self._sidecar()
+        try:
+            infile = open(sidecar, "rb")
+        except IOError:
+            return False
+
+        with infile:
+            try:
+                meta = json.loads(infile.readline())
+            except ValueError:
+                return False
+            if meta != self._meta():
+                return False
+
+            header = infile.tell()
+            self._map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._header = header
+        self.blocks = (len(self._map) - header) // BITMAP_SIZE
+        self.built = self.blocks
+        self.ready = True
+        return True
+
+    def _unload(self):
+        self.ready = False
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _build(self):
+        flen = self._identity[0]
+        starts = range(0, flen, self.blocksize)
+        jobs = [ (self.path, start, min(start + self.blocksize, flen))
+            for start in starts ]
+
+        sidecar = self._sidecar()
+        temp = sidecar + ".tmp"
+        begin = time.time()
+
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            with open(temp, "wb") as outfile:
+                outfile.write(json.dumps(self._meta()) + "\n")
+                for bitmap in pool.imap(_block_bitmap, jobs):
+                    if self._cancelled:
+                        return
+                    outfile.write(bitmap)
+                    self.built += 1
+                    self.build_time = time.time() - begin
+        finally:
+            pool.terminate()
+            if self._cancelled and os.path.exists(temp):
+                os.remove(temp)
+
+        os.rename(temp, sidecar)
+        self._load()
+
+
+# Where the sidecar file with the suffix goes for the file
+#   at 'path': beside it, or in ~/.cache/hexeditor if that
+#   isn't writable
+def sidecar_path(path, suffix):
+    sidecar = path + suffix
+    directory = os.path.dirname(sidecar)
+    if os.access(sidecar, os.W_OK) or (not os.path.exists(sidecar)
+            and os.access(directory, os.W_OK)):
+        return sidecar
+
+    cache = os.path.join(os.path.expanduser("~"), ".cache", "hexeditor")
+    if not os.path.isdir(cache):
+        os.makedirs(cache)
+    name = path.replace(os.sep, "_") + suffix
+    return os.path.join(cache, name)
+
+def _identity(path):
+    info = os.stat(path)
+    return (info.st_size, info.st_ino, info.st_mtime)
+
+# The pairs of adjacent bytes in data, as 16 bit numbers
+def _grams(data):
+    grams = set()
+    for first in (0, 1):
+        part = data[first:]
+        part = part[:len(part) - len(part) % 2]
+        grams.update(array("H", part))
+    return grams
+
+# Runs in the worker processes
+def _block_bitmap(job):
+    path, start, end = job
+    with open(path, "rb") as infile:
+        infile.seek(start)
+        # One extra byte, for the pair that crosses into the
+        #   next block
+        data = infile.read(end - start + 1)
+
+    bitmap = bytearray(BITMAP_SIZE)
+    for gram in _grams(data):
+        bitmap[gram >> 3] |= 1 << (gram & 7)
+    return str(bitmap)